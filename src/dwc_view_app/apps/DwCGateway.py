@@ -11,8 +11,19 @@
 import logging
 from django.utils import simplejson as json
 from django.core.cache import cache
-from solrclient import SolrConnection
+from solrclient import SolrConnection, SOLRPrefetchResponseIterator, tabulateDocs, bboxFilter
+from solrclient import packColumns
+from gatewaycache import IndexVersionTracker, FieldMetadataCache, ResultCache, RefreshScheduler
+from gatewaycache import CacheSnapshot
+import dwcarchive
+from tilepyramid import TilePyramid, MAX_LATITUDE, checkTile, tileBounds, rowEdges, tileCells
+from tilepyramid import tileOf
+from spatialindex import GridIndex, thinPoints
 from datetime import datetime
+import random
+import threading
+import csv
+import StringIO
 
 class SOLRGateway:
   '''Darwin Core Views Gateway Implementation for SOLR Backends
@@ -21,11 +32,20 @@ class SOLRGateway:
   __fields = None
   __connection = None
   __json_encoder = json.JSONEncoder(encoding='utf-8', separators=(',', ':')).encode
+  # single line encoder of streamed records
+  __record_encoder = json.JSONEncoder(encoding='utf-8', separators=(',', ':')).encode
+  # formats of GetRecords
+  __record_formats = ('json', 'array', 'columns', 'f32')
   __connection = None
   __identifier = 'solr'
 
 
-  def __init__(self, host=None, basedir=None, encoder=__json_encoder, identifier=__identifier):
+  def __init__(self, host=None, basedir=None, encoder=__json_encoder, identifier=__identifier,
+               maxconnections=10, versioninterval=30, cachebudgets=None, cachecompress=0,
+               refreshttl=300, maxstale=3600, snapshot=None, snapshotinterval=600,
+               warmfields=None, warmcount=1000, warmbins=10, sharedcache=None,
+               tilezoom=5, tilecells=8, tilepoints=100, tilettl=86400,
+               spatialindex=False, spatialcellsize=1.0):
     '''SOLRGateway constructor.
     
     :param host: SOLR Server Address (i.e. "serrano.speciesanalyst.net")
@@ -34,6 +54,42 @@ class SOLRGateway:
     :type basedir: string
     :param encoder: a function that takes a Python object and encodes it into a JSON string (only used if you wish to override the default).
     :type encoder: function
+    :param maxconnections: maximum number of concurrent keep-alive connections held open to the SOLR server. Requests are served from this pool so concurrent gateway calls do not share a socket.
+    :type maxconnections: integer
+    :param versioninterval: seconds between checks of the SOLR index version.  Cached field information is refreshed when the version changes.
+    :type versioninterval: integer
+    :param cachebudgets: size in bytes of the result cache of each endpoint ("field", "values", "histogram", "histogram2d", "grid", "tiles", "records"), i.e. {"records": 33554432}.  Endpoints not listed get 8MB.
+    :type cachebudgets: dictionary
+    :param cachecompress: zlib compression level (1-9) of cached results, 0 to hold them uncompressed.  Compressed results can be sent as is to clients accepting gzip content encoding.
+    :type cachecompress: integer
+    :param refreshttl: seconds for which the summary, field listing and field statistics are fresh.  They are refreshed in the background before then and whenever the index version changes.
+    :type refreshttl: integer
+    :param maxstale: seconds for which the summary, field listing and field statistics continue to be served when they can not be refreshed
+    :type maxstale: integer
+    :param snapshot: path of an SQLite file in which the cached results are saved every snapshotinterval seconds and at exit, once the gateway is started (see start()).  When the gateway is started the saved results are served if they are of the current index version.  None, the default, for no snapshot.
+    :type snapshot: string
+    :param snapshotinterval: seconds between saves of the snapshot
+    :type snapshotinterval: integer
+    :param warmfields: names of fields whose information, values and histogram are computed by start() (see WarmUp)
+    :type warmfields: list
+    :param warmcount: number of values computed by start() for each of warmfields
+    :type warmcount: integer
+    :param warmbins: number of histogram bins computed by start() for each of warmfields
+    :type warmbins: integer
+    :param sharedcache: second tier of the result cache, shared with the other gateway processes (i.e. gatewaycache.DjangoCacheStore or gatewaycache.SQLiteStore).  Results computed by any process are written through to it and read from it on a miss of the in process cache.
+    :type sharedcache: gatewaycache.SharedStore
+    :param tilezoom: deepest zoom level of the map tiles (see GetTile) precomputed for the whole index, None to compute every tile on request.  The tiles are computed in the background by start(), or when first requested, and whenever the index version changes, with one request to SOLR for each 4096 cells of the (2^tilezoom * tilecells)^2 cells of the map, i.e. 16 requests by default.
+    :type tilezoom: integer
+    :param tilecells: number of rows and columns of cells in a map tile
+    :type tilecells: integer
+    :param tilepoints: maximum number of records in a map tile for which the records are listed
+    :type tilepoints: integer
+    :param tilettl: seconds for which the precomputed tiles and the spatial index are fresh when the index version does not change
+    :type tilettl: integer
+    :param spatialindex: if True the id, lat and lng of every record are held in memory in a spatialindex.GridIndex, read in the background by start(), or when first needed, and whenever the index version changes, from which the records of the whole index in a bounding box are counted and listed without querying SOLR (see GetRecords)
+    :type spatialindex: boolean
+    :param spatialcellsize: size in degrees of the cells of the spatial index
+    :type spatialcellsize: float
     :returns: Structure as described in https://github.com/vdave/DwC_views/wiki/GatewayAPIs
     :rtype: SOLRGateway Object Instance
     '''
@@ -41,29 +97,171 @@ class SOLRGateway:
     #if host == None || basedir == None:
     #  raise Error('You Must Specify a Host/Dir')
 
-    self.__connection = SolrConnection(host=host, solrBase=basedir)
+    self.__connection = SolrConnection(host=host, solrBase=basedir,
+                                       maxconnections=maxconnections)
     self.__json_encoder = encoder
     self.__identifier = identifier
-    
+    self.__versions = IndexVersionTracker(self.__connection, interval=versioninterval)
+    self.__field_cache = FieldMetadataCache(self.__connection, self.__versions, cache,
+                                            key=self.__identifier + '_fields')
+    self.__results = ResultCache(self.__versions, budgets=cachebudgets,
+                                 compresslevel=cachecompress, shared=sharedcache)
+    self.__refresher = RefreshScheduler(self.__versions, ttl=refreshttl, maxstale=maxstale)
+    self.__refresher.register('summary', self.__ComputeSummary)
+    self.__refresher.register('fields', self.__ComputeFields)
+    self.__tilezoom = tilezoom
+    self.__tilecells = tilecells
+    self.__tilepoints = tilepoints
+    if tilezoom is not None:
+      self.__refresher.register('tiles', self.__ComputeTilePyramid, ttl=tilettl)
+    self.__spatialcellsize = spatialcellsize
+    self.__spatialindex = spatialindex
+    if spatialindex:
+      self.__refresher.register('points', self.__ComputeSpatialIndex, ttl=tilettl)
+    self.__snapshot = None
+    if snapshot is not None:
+      self.__snapshot = CacheSnapshot(snapshot, interval=snapshotinterval)
+    self.__warmup = (warmfields, warmcount, warmbins)
+    self.__boot = None
+    self.__bootlock = threading.Lock()
+
+
+  def start(self):
+    '''Starts the background work of the gateway on a thread of its own, once: restores the snapshot, starts the scheduled refresh of the summary, field listings, tiles and spatial index, warms up the caches and starts saving the snapshot.
+
+    Nothing is started by the constructor, so creating a gateway sends no request to SOLR.  Without start() every value is computed when it is first requested.
+    '''
+    self.__bootlock.acquire()
+    try:
+      if self.__boot is not None:
+        return
+      self.__boot = threading.Thread(target=self.__Boot)
+      self.__boot.setDaemon(True)
+      self.__boot.start()
+    finally:
+      self.__bootlock.release()
+
+
+  # private function that fetches server's field information.  The listing
+  # is held in memory and refreshed in the background when the index changes.
+  def __FetchFields(self, block=False):
+    self.__fields = self.__field_cache.get(block)
+
+
+  # private function run on a background thread by start(): restores the
+  # snapshot, starts the background refresh and warms up the caches
+  def __Boot(self):
+    if self.__snapshot is not None:
+      try:
+        self.__RestoreSnapshot()
+      except Exception, e:
+        logging.warning('Unable to restore the cache snapshot: %s' % str(e))
+    self.__refresher.start()
+    try:
+      self.WarmUp(*self.__warmup)
+    except Exception, e:
+      logging.warning('Cache warm up failed: %s' % str(e))
+    if self.__snapshot is not None:
+      self.__snapshot.start(self.__CollectSnapshot)
+
+
+  def __RestoreSnapshot(self):
+    version = self.__versions.get()
+    sections = self.__snapshot.load(version)
+    if sections is None:
+      return
+    if sections.has_key('fields'):
+      self.__field_cache.restore(version, sections['fields']['listing'])
+    if sections.has_key('refresh'):
+      self.__refresher.restore(sections['refresh'])
+    if sections.has_key('results'):
+      self.__results.restore(version, sections['results'])
+    logging.info('Restored cache snapshot of index version %s' % version)
+
+
+  # private function returning the cached values of the current index version
+  def __CollectSnapshot(self):
+    version = self.__versions.current()
+    sections = {}
+    fields = self.__field_cache.dump()
+    if fields is not None and fields[0] == version:
+      sections['fields'] = {'listing': fields[1]}
+    sections['refresh'] = {}
+    for key, value in self.__refresher.dump().items():
+      if value[0] == version:
+        sections['refresh'][key] = value
+    results = self.__results.dump()
+    if results[0] == version:
+      sections['results'] = results[1]
+    return (version, sections)
+
+
+  def SaveSnapshot(self):
+    '''Saves the cached results to the snapshot file now.
+
+    :returns: True if the snapshot was saved
+    :rtype: boolean
+    '''
+
+    if self.__snapshot is None:
+      return False
+    version, sections = self.__CollectSnapshot()
+    return self.__snapshot.save(version, sections)
+
+
+  def WarmUp(self, fields=None, count=1000, nbins=10):
+    '''Computes the summary and field listing and, for each of fields, the field information, the top count values and the histogram of nbins bins for the whole index, so they are served from the caches.
+
+    :param fields: names of the fields to warm up
+    :type fields: list
+    :param count: number of values, as the count of GetFieldValues
+    :type count: integer
+    :param nbins: number of histogram bins, as the nbins of GetFieldHistogram
+    :type nbins: integer
+    '''
+
+    self.GetSummary()
+    self.GetFields()
+    for field in fields or []:
+      try:
+        self.GetField(field)
+        self.GetFieldValues(field, count=count)
+        self.GetFieldHistogram(field, nbins=nbins)
+      except Exception, e:
+        logging.warning('Unable to warm up field %s: %s' % (field, str(e)))
+
 
-  # private function that fetches server's field information
-  def __FetchFields(self):
-    if self.__fields == None:
-      self.__fields == cache.get(self.__identifier + '_fields')
-      if self.__fields == None:
-        self.__fields = self.__connection.getFields()
-        self.__CacheFields(self.__fields)
+  # private function that serves a result from the result cache, either as
+  # the EncodedResponse held in the cache or as a JSON string
+  def __cached(self, region, params, compute, encoded):
+    result = self.__results.fetch(region, params, compute)
+    if encoded:
+      return result
+    return result.data()
 
 
-  # private function that handles internel caching of fields and field values
-  def __CacheFields(self, fields):
-    cache.set(self.__identifier + '_fields', fields);
+  def GetCacheStats(self):
+    '''Provides the hit and miss counters and memory use of the result cache of each endpoint.
+
+    Identical requests arriving while the result is being computed wait for that computation instead of repeating it.  "executions" counts the computations and "coalesced" the requests that shared one.
+
+    :returns: Structure keyed by endpoint with "hits", "misses", "evictions", "entries", "bytes", "maxbytes", "executions", "coalesced" and "l1ratio" (and "l2hits", "l2misses" and "l2ratio" with a shared cache), plus "version", the index version of the cached results, and "refresh", the "age", "version", "refreshes", "errors" and last "error" of each value refreshed in the background
+    :rtype: JSON UTF-8 encoded string
+    '''
+
+    stats = self.__results.stats()
+    stats['version'] = self.__versions.current()
+    stats['refresh'] = self.__refresher.stats()
+    return self.__json_encoder(stats)
+
 
   def GetSummary(self):
     '''Provide a summary of the collection.
 
     *currentTime: It is important to note that the "currentTime" field displays the current time (as GMT) of the gateway server and not the current time of the Darwin Core backend database server.  Both machines *should* have the same time, but this is not necessarily ensured.
     *lastModified: If not supported directly by the data server, the "lastModified" field will use the max value from a "modified" field from the records themselves to determine when the database was last modified.
+
+    numRecords and lastModified are served from memory and refreshed in the background.
     
     :returns: Structure as described in https://github.com/vdave/DwC_views/wiki/GatewayAPIs
     :rtype: JSON UTF-8 encoded string
@@ -74,7 +272,15 @@ class SOLRGateway:
     # get the current system time (note, this is time on
     # localhost, not the actual solr server)
     summary_params['currentTime'] = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.0Z')
-    # get the total record and last-modified count
+    summary_params.update(self.__refresher.get('summary'))
+
+    json_dump = self.__json_encoder(summary_params)
+    return json_dump
+
+
+  # private function that gets the total record and last-modified count
+  def __ComputeSummary(self):
+    summary_params = {}
     results = self.__connection.search({"q":"*:*",
                                       "fields":"modified",
                                       "sort":"modified desc",
@@ -82,9 +288,7 @@ class SOLRGateway:
     response = results['response']
     summary_params['numRecords'] = response['numFound']
     summary_params['lastModified'] = response['docs'][0]["modified"]
-
-    json_dump = self.__json_encoder(summary_params)
-    return json_dump
+    return summary_params
 
 
   def __formatFieldAttributes(self, field):
@@ -102,24 +306,51 @@ class SOLRGateway:
     return f_attributes
 
 
-  def GetField(self, field, q='*:*', fq=None):
+  def GetField(self, field, q='*:*', fq=None, encoded=False):
     '''Provide a listing of distinct values and value counts for the given field.
+
+    For numeric fields the count, missing, sum, mean and stddev of the field
+    values are included, retrieved along with min/max in a single request.
+    Information for the whole index (the default q and fq) is served from
+    memory and refreshed in the background.
     
     :param field: The name of the field
     :type field: string
+    :param encoded: if True the cached EncodedResponse is returned instead of a string
+    :type encoded: boolean
     :returns: Structure as described in https://github.com/vdave/DwC_views/wiki/GatewayAPIs
     :rtype: JSON UTF-8 encoded string
     '''
 
+    self.__FetchFields()
+    if q == '*:*' and fq == None and self.__fields['fields'].has_key(field):
+      # statistics of the whole index are kept fresh in the background
+      result = self.__refresher.get('field/' + field,
+                                    lambda: self.__results.encode(self.__GetField(field, q, fq)))
+      if encoded:
+        return result
+      return result.data()
+    return self.__cached('field', {'field': field, 'q': q, 'fq': fq},
+                         lambda: self.__GetField(field, q, fq), encoded)
+
+
+  def __GetField(self, field, q, fq):
     self.__FetchFields();
 
     # fetch the standard field information
     f_attributes = self.__formatFieldAttributes(field)
 
-    # add min/max values to the field attributes
-    (min, max) = self.__connection.fieldMinMax(field, q, fq)
-    f_attributes['minvalue'] = min;
-    f_attributes['maxvalue'] = max;
+    # add min/max values (and statistics for numeric fields) to the field attributes
+    if self.__connection.getftype(field) in (int, float):
+      stats = self.__connection.fieldStats(field, q, fq)[field]
+      f_attributes['minvalue'] = stats['min']
+      f_attributes['maxvalue'] = stats['max']
+      for k in ['count', 'missing', 'sum', 'mean', 'stddev']:
+        f_attributes[k] = stats[k]
+    else:
+      (min, max) = self.__connection.fieldMinMax(field, q, fq)
+      f_attributes['minvalue'] = min;
+      f_attributes['maxvalue'] = max;
 
     json_dump = self.__json_encoder({ field: f_attributes })
 
@@ -128,12 +359,18 @@ class SOLRGateway:
 
   def GetFields(self):
     '''Provide a listing of different fields found within the server's records.
+
+    The listing is served from memory and refreshed in the background.
     
     :returns: Structure as described in https://github.com/vdave/DwC_views/wiki/GatewayAPIs
     :rtype: JSON UTF-8 encoded string
     '''
 
-    self.__FetchFields();
+    return self.__refresher.get('fields')
+
+
+  def __ComputeFields(self):
+    self.__FetchFields(block=True);
 
     fields = {};
     # format our field information
@@ -144,16 +381,28 @@ class SOLRGateway:
     return json_dump
 
 
-  def GetFieldValues(self, field, q="*:*", count=100):
+  def GetFieldValues(self, field, q="*:*", count=100, bbox=None, encoded=False):
     '''Provide a listing of distinct values and value counts for the given field.
     
     :param field: The name of the field
     :type field: string
+    :param bbox: [west, south, east, north] bounds of the lat and lng of the records counted, west greater than east for a box crossing the antimeridian
+    :type bbox: list
+    :param encoded: if True the cached EncodedResponse is returned instead of a string
+    :type encoded: boolean
     :returns: Structure as described in https://github.com/vdave/DwC_views/wiki/GatewayAPIs
     :rtype: JSON UTF-8 encoded string
     '''
 
-    results = self.__connection.fieldValues(field, q=q, maxvalues=count)
+    return self.__cached('values', {'field': field, 'q': q, 'count': count, 'bbox': bbox},
+                         lambda: self.__GetFieldValues(field, q, count, bbox), encoded)
+
+
+  def __GetFieldValues(self, field, q, count, bbox):
+    fq = None
+    if bbox is not None:
+      fq = bboxFilter(bbox)
+    results = self.__connection.fieldValues(field, q=q, fq=fq, maxvalues=count)
     logging.info(str(results))
     # values are wrapped in 3 levels of lists, exract the inner level
     result_values = results[field]
@@ -172,7 +421,7 @@ class SOLRGateway:
     return json_dump
 
 
-  def GetFieldHistogram(self, field, q='*:*', nbins=10):
+  def GetFieldHistogram(self, field, q='*:*', nbins=10, gap=None, bbox=None, encoded=False):
     '''Provides a histogram representing the distribution of values for a given field.
     
     :param field: The name of the field
@@ -181,18 +430,213 @@ class SOLRGateway:
     :type filter: string
     :param bins: the number of equal division into which the field values will be split
     :type bins: integer
+    :param gap: the width of each bin for numeric (i.e. "10") or date (i.e. "+1YEAR", "+6MONTHS") fields.  Overrides bins.
+    :type gap: string
+    :param bbox: [west, south, east, north] bounds of the lat and lng of the records counted, west greater than east for a box crossing the antimeridian
+    :type bbox: list
+    :param encoded: if True the cached EncodedResponse is returned instead of a string
+    :type encoded: boolean
     :returns: Structure as described in https://github.com/vdave/DwC_views/wiki/GatewayAPIs
     :rtype: JSON UTF-8 encoded string
     '''
 
-    json_dump = self.__json_encoder(self.__connection.fieldHistogram(name=field, q=q, nbins=nbins))
+    return self.__cached('histogram',
+                         {'field': field, 'q': q, 'nbins': nbins, 'gap': gap, 'bbox': bbox},
+                         lambda: self.__GetFieldHistogram(field, q, nbins, gap, bbox), encoded)
+
+
+  def __GetFieldHistogram(self, field, q, nbins, gap, bbox):
+    fq = None
+    if bbox is not None:
+      fq = bboxFilter(bbox)
+    json_dump = self.__json_encoder(self.__connection.fieldHistogram(name=field, q=q, fq=fq,
+                                                                    nbins=nbins, gap=gap))
 
     return json_dump
 
 
+  def GetFieldHistogram2d(self, colfield, rowfield, q='*:*', ncols=10, nrows=10,
+                          encoded=False):
+    '''Provides a two dimensional histogram (density grid) of the values of two numeric fields.
+    
+    :param colfield: The name of the field used for the columns (i.e. "lng")
+    :type colfield: string
+    :param rowfield: The name of the field used for the rows (i.e. "lat")
+    :type rowfield: string
+    :param q: a solr-compatible query/filter
+    :type q: string
+    :param ncols: the number of equal divisions of the column field values
+    :type ncols: integer
+    :param nrows: the number of equal divisions of the row field values
+    :type nrows: integer
+    :param encoded: if True the cached EncodedResponse is returned instead of a string
+    :type encoded: boolean
+    :returns: Structure with "colname", "rowname", "cols" and "rows" (the lower bound of each column and row), and "z", the record counts indexed as z[row][col]
+    :rtype: JSON UTF-8 encoded string
+    '''
+
+    return self.__cached('histogram2d',
+                         {'colfield': colfield, 'rowfield': rowfield, 'q': q,
+                          'ncols': ncols, 'nrows': nrows},
+                         lambda: self.__GetFieldHistogram2d(colfield, rowfield, q,
+                                                            ncols, nrows), encoded)
+
+
+  def __GetFieldHistogram2d(self, colfield, rowfield, q, ncols, nrows):
+    json_dump = self.__json_encoder(self.__connection.fieldHistogram2d(colfield, rowfield, q=q,
+                                                                      ncols=ncols, nrows=nrows))
+
+    return json_dump
+
+
+  def GetGrid(self, bbox=(-180.0, -90.0, 180.0, 90.0), q='*:*', nrows=10, ncols=10,
+              colfield='lng', rowfield='lat', encoded=False):
+    '''Provides the number of records in each cell of a regular grid over a bounding box, i.e. the density of records over a map viewport.
+
+    The grid is computed by SOLR faceting, one facet query per cell sent in a single request (see SolrConnection.fieldGrid), so the cost and the response size depend only on the size of the grid and not on the number of records.
+    
+    :param bbox: [west, south, east, north] bounds of the grid
+    :type bbox: list
+    :param q: a solr-compatible query/filter
+    :type q: string
+    :param nrows: the number of rows (divisions of south to north)
+    :type nrows: integer
+    :param ncols: the number of columns (divisions of west to east)
+    :type ncols: integer
+    :param colfield: name of the longitude field
+    :type colfield: string
+    :param rowfield: name of the latitude field
+    :type rowfield: string
+    :param encoded: if True the cached EncodedResponse is returned instead of a string
+    :type encoded: boolean
+    :returns: Structure with "bbox", "colname", "rowname", "cols" and "rows" (the lower bound of each column and row), "z", the record counts indexed as z[row][col], and "numFound", the number of records in the grid
+    :rtype: JSON UTF-8 encoded string
+    '''
+
+    bbox = [float(v) for v in bbox]
+    return self.__cached('grid',
+                         {'bbox': bbox, 'q': q, 'nrows': nrows, 'ncols': ncols,
+                          'colfield': colfield, 'rowfield': rowfield},
+                         lambda: self.__json_encoder(self.__connection.fieldGrid(colfield, rowfield,
+                                   bbox, ncols=ncols, nrows=nrows, q=q)), encoded)
+
+
+  def GetTile(self, z, x, y, q='*:*', encoded=False):
+    '''Provides the number of records in a map tile, and in each cell of a grid over the tile, from the lat and lng fields.
+
+    Tiles are addressed as z/x/y in the Web Mercator tiling scheme of web maps.  The tiles of the whole index down to zoom level tilezoom are precomputed whenever the index changes, with the records of the tiles that list them, so they are served without querying SOLR.  Tiles of a query, or deeper in the pyramid, are computed on request and cached.  Each cell holding records is listed with a representative point where a marker for the records may be drawn, and when a tile holds at most tilepoints records the records themselves are listed.
+    
+    :param z: zoom level
+    :type z: integer
+    :param x: column of the tile, from west to east
+    :type x: integer
+    :param y: row of the tile, from north to south
+    :type y: integer
+    :param q: a solr-compatible query/filter
+    :type q: string
+    :param encoded: if True the cached EncodedResponse is returned instead of a string
+    :type encoded: boolean
+    :returns: Structure with "z", "x", "y", "bbox", the [west, south, east, north] bounds of the tile, "cells", the number of rows and columns of cells, "numFound", the number of records in the tile, "counts", a list of [row, col, count, lat, lng] of the cells holding records with rows counting from north to south, and "points", a list of [id, lat, lng] of the records in the tile or null if there are more than tilepoints
+    :rtype: JSON UTF-8 encoded string
+    '''
+
+    checkTile(z, x, y)
+    params = {'z': z, 'x': x, 'y': y, 'q': q}
+    pyramid = None
+    if self.__tilezoom is not None and z <= self.__tilezoom and q.strip() in ('', '*:*'):
+      #served from the precomputed pyramid once it is available
+      pyramid = self.__refresher.get('tiles', self.__ComputeTilePyramid, wait=False)
+      if pyramid is not None:
+        params['pyramid'] = pyramid.version
+    return self.__cached('tiles', params,
+                         lambda: self.__ComputeTile(z, x, y, q, pyramid), encoded)
+
+
+  def __ComputeTile(self, z, x, y, q, pyramid):
+    bbox = tileBounds(z, x, y)
+    if pyramid is not None:
+      numFound, counts = pyramid.tile(z, x, y)
+    else:
+      cells = self.__tilecells
+      grid = self.__connection.fieldGrid('lng', 'lat', bbox, ncols=cells, nrows=cells, q=q,
+                                         rowedges=rowEdges(z, y, cells))
+      numFound, counts = tileCells(z, x, y, grid['z'])
+    points = None
+    if numFound <= self.__tilepoints:
+      points = []
+      if pyramid is not None:
+        points = pyramid.tilePoints(z, x, y)
+      elif numFound > 0:
+        params = {'q': q,
+                  'fq': ['lng:[%r TO %r]' % (bbox[0], bbox[2]),
+                         'lat:[%r TO %r]' % (bbox[1], bbox[3])],
+                  'fl': 'id,lat,lng',
+                  'rows': self.__tilepoints}
+        docs = self.__connection.search(params)['response']['docs']
+        names, points = tabulateDocs(docs, ['id', 'lat', 'lng'])
+    return self.__json_encoder({'z': z, 'x': x, 'y': y, 'bbox': bbox,
+                                'cells': self.__tilecells,
+                                'numFound': numFound,
+                                'counts': counts,
+                                'points': points})
+
+
+  # private function reading the location of every record into a spatial index
+  def __ComputeSpatialIndex(self):
+    version = self.__versions.current()
+    records = SOLRPrefetchResponseIterator(self.__connection, '*:*',
+                                           fq='lat:[* TO *] AND lng:[* TO *]',
+                                           fields='id,lat,lng', pagesize=10000, cursor=True)
+    return GridIndex(self.__Points(records), cellsize=self.__spatialcellsize, version=version)
+
+
+  # private function computing the tiles of the whole index down to tilezoom
+  def __ComputeTilePyramid(self):
+    version = self.__versions.current()
+    n = 2 ** self.__tilezoom * self.__tilecells
+    grid = self.__connection.fieldGrid('lng', 'lat', [-180.0, -MAX_LATITUDE, 180.0, MAX_LATITUDE],
+                                       ncols=n, nrows=n, maxsize=n, rowedges=rowEdges(0, 0, n))
+    pyramid = TilePyramid(self.__tilezoom, self.__tilecells, grid['z'], version)
+    #the records of the tiles that list them, fetched for batches of tiles
+    #of up to 10000 records.  Tiles include their western and southern
+    #edges as the cells of the grid do.
+    sparse = pyramid.sparseTiles(self.__tilepoints)
+    batches = [([], 0)]
+    for x, y, count in sparse:
+      boxes, total = batches[-1]
+      if total + count > 10000 or len(boxes) >= 100:
+        batches.append(([], 0))
+        boxes, total = batches[-1]
+      west, south, east, north = tileBounds(self.__tilezoom, x, y)
+      boxes.append('(lng:[%r TO %r%s AND lat:[%r TO %r%s)'
+                   % (west, east, ']' if east >= 180.0 else '}',
+                      south, north, ']' if y == 0 else '}'))
+      batches[-1] = (boxes, total + count)
+    def _points(batch):
+      boxes, total = batch
+      if total == 0:
+        return []
+      docs = self.__connection.search({'q': '*:*', 'fq': ' OR '.join(boxes), 'fl': 'id,lat,lng',
+                                       'rows': str(2 * total)})
+      return tabulateDocs(docs['response']['docs'], ['id', 'lat', 'lng'])[1]
+    sparse = set([(x, y) for x, y, count in sparse])
+    for points in self.__connection.parallelMap(_points, batches):
+      #rounding of the edges may find records of neighbouring tiles
+      pyramid.addPoints([point for point in points
+                         if tileOf(self.__tilezoom, point[1], point[2]) in sparse])
+    return pyramid
+
+
   def GetRecords(self, q="*:*", fields="*", orderby=None,
-                 order="asc", start=0, count=1000):
+                 order="asc", start=0, count=1000, cursor=None, format="json", bbox=None,
+                 thin=None, cells=(64, 64), percell=1, encoded=False):
     '''Retrieve a page of records from the SOLR service.
+
+    Deep paging with start offsets costs more the further into the result set the page is.  To walk a large result set pass cursor="*" for the first page, then the "nextCursor" value of each response for the following page.  start is ignored when a cursor is given, and the end of the results is reached when "nextCursor" equals the cursor that was sent.
+
+    With the spatial index enabled, records of the whole index (q "*:*") in a bbox are counted and listed from the index rather than SOLR when only id, lat and lng are requested, without orderby or cursor.  These records are in the order of the cells of the index and their values are not lists.
+
+    With thin="grid" the records matching the query in the bbox (the whole map by default) are thinned to at most percell records in each cell of a grid of cells over the bbox, instead of a page of them being returned, for a set of markers of bounded size spread as the records are.  The records kept in a cell are chosen by a hash of their id (see spatialindex.thinPoints), so the same query returns the same records whatever the index version.  The id, lat and lng of the records matching are read to choose them, from the spatial index if it answers the query, otherwise from SOLR in one cursor walk of pages of 10000 (a request for each 10000 records in the bbox), and only the records chosen are then retrieved with the fields requested.  start, count, orderby and cursor are ignored, and "numFound" is the number of records in the bbox.
     
     :param q: Query string
     :type q: string
@@ -206,20 +650,321 @@ class SOLRGateway:
     :type start: integer
     :param count: Number of records to return in results
     :type count: integer
+    :param cursor: Opaque paging cursor, "*" for the first page
+    :type cursor: string
+    :param format: "json" for a list of records (docs), "array" for a list of rows of values (rows) or "columns" for a list of the values of each field (columns).  The array and columns formats give the field names once in "fields", and lists of one value are replaced by the value.  "f32" packs the values of numeric fields as little-endian float32 and int32 arrays after a JSON header, 8 bytes a record for lat and lng (see solrclient.packColumns), and needs a list of fields.
+    :type format: string
+    :param bbox: [west, south, east, north] bounds of the lat and lng of the records, west greater than east for a box crossing the antimeridian
+    :type bbox: list
+    :param thin: "grid" to thin the records to at most percell in each of the cells over the bbox
+    :type thin: string
+    :param cells: (columns, rows) of the grid of cells of thin
+    :type cells: tuple
+    :param percell: maximum number of records in a cell with thin
+    :type percell: integer
+    :param encoded: if True the cached EncodedResponse is returned instead of a string
+    :type encoded: boolean
     :return: List of records as described in https://github.com/vdave/DwC_views/wiki/GatewayAPIs
-    :rtype: JSON UTF-8 encoded string
+    :rtype: JSON UTF-8 encoded string, binary with format f32
     '''
 
+    params = {'q': q, 'fields': fields, 'orderby': orderby, 'order': order,
+              'start': start, 'count': count, 'cursor': cursor, 'format': format, 'bbox': bbox}
+    if thin is not None:
+      if thin != 'grid':
+        raise ValueError('Unknown thinning: %s' % thin)
+      ncols, nrows = [int(v) for v in cells]
+      if ncols < 1 or nrows < 1 or ncols * nrows > 65536 or percell < 1:
+        raise ValueError('Thinning needs 1 to 65536 cells and percell of at least 1')
+      if bbox is None:
+        bbox = [-180.0, -90.0, 180.0, 90.0]
+      params = {'q': q, 'fields': fields, 'format': format, 'bbox': bbox,
+                'thin': thin, 'cells': [ncols, nrows], 'percell': percell}
+    index = None
+    if (self.__spatialindex and bbox is not None and q.strip() in ('', '*:*')
+        and (thin is not None or (orderby is None and cursor is None
+             and set([name.strip() for name in fields.split(',')]) <= set(['id', 'lat', 'lng'])))):
+      index = self.__refresher.get('points', self.__ComputeSpatialIndex, wait=False)
+      if index is not None:
+        params['index'] = index.version
+    if thin is not None:
+      compute = lambda: self.__GetThinnedRecords(q, fields, format, bbox, ncols, nrows,
+                                                 percell, index)
+    elif index is not None:
+      compute = lambda: self.__GetIndexedRecords(index, fields, start, count, format, bbox)
+    else:
+      compute = lambda: self.__GetRecords(q, fields, orderby, order, start,
+                                          count, cursor, format, bbox)
+    return self.__cached('records', params, compute, encoded)
+
+
+  def __GetRecords(self, q, fields, orderby, order, start, count, cursor, format, bbox=None):
+    if format not in self.__record_formats:
+      raise ValueError('Unknown records format: %s' % format)
     params = {'q': q,
               'fl': fields,
               'rows': count,
               'start': start,
              }
+    if bbox is not None:
+      params['fq'] = bboxFilter(bbox)
+    sort = None
     if orderby != None:
-      params['sort'] = "%s %s" % (orderby, order)
+      sort = "%s %s" % (orderby, order)
+      params['sort'] = sort
+    if cursor != None:
+      del params['start']
+      params['sort'] = self.__connection.cursorSort(sort)
+      params['cursorMark'] = cursor
 
     results = self.__connection.search(params)
     response = results['response']
+    if cursor != None:
+      response['nextCursor'] = results['nextCursorMark']
+    return self.__FormatRecords(response, fields, format)
+
+
+  # private function that answers a records request from the spatial index
+  def __GetIndexedRecords(self, index, fields, start, count, format, bbox):
+    if format not in self.__record_formats:
+      raise ValueError('Unknown records format: %s' % format)
+    names = [name.strip() for name in fields.split(',')]
+    numFound, points = index.search(bbox, start, count)
+    docs = []
+    for point in points:
+      doc = dict(zip(('id', 'lat', 'lng'), point))
+      docs.append(dict([(name, doc[name]) for name in names]))
+    return self.__FormatRecords({'numFound': numFound, 'start': start, 'docs': docs},
+                                fields, format)
+
+
+  # private function that answers a records request thinned to percell
+  # records in each cell of a grid over bbox
+  def __GetThinnedRecords(self, q, fields, format, bbox, ncols, nrows, percell, index):
+    if format not in self.__record_formats:
+      raise ValueError('Unknown records format: %s' % format)
+    if index is not None:
+      points = index.search(bbox, 0, len(index))[1]
+    else:
+      points = self.__Points(SOLRPrefetchResponseIterator(self.__connection, q,
+                                                          fq=bboxFilter(bbox),
+                                                          fields='id,lat,lng',
+                                                          pagesize=10000, cursor=True))
+    numFound, points = thinPoints(points, bbox, ncols, nrows, percell)
+    names = [name.strip() for name in fields.split(',')]
+    if set(names) <= set(['id', 'lat', 'lng']):
+      docs = []
+      for point in points:
+        doc = dict(zip(('id', 'lat', 'lng'), point))
+        docs.append(dict([(name, doc[name]) for name in names]))
+    else:
+      docs = self.__connection.getDocs([point[0] for point in points], fields=fields)
+      if '*' not in names and 'id' not in names:
+        for doc in docs:
+          del doc['id']
+    response = {'numFound': numFound, 'start': 0, 'docs': docs,
+                'cells': [ncols, nrows], 'percell': percell}
+    return self.__FormatRecords(response, fields, format)
+
+
+  # private generator of the (id, lat, lng) of records with a location
+  def __Points(self, records):
+    try:
+      for record in records:
+        point = [record.get(name) for name in ('id', 'lat', 'lng')]
+        point = [(v[0] if v else None) if type(v) is list else v for v in point]
+        if point[1] is not None and point[2] is not None:
+          yield point
+    finally:
+      records.close()
+
+
+  # private function that encodes a response of records in the requested format
+  def __FormatRecords(self, response, fields, format):
+    if format == 'f32':
+      if '*' in fields:
+        raise ValueError('The f32 format needs a list of fields')
+      names = [name.strip() for name in fields.split(',')]
+      names, columns = tabulateDocs(response['docs'], names, bycolumn=True)
+      types = []
+      for name in names:
+        types.append({float: 'float32', int: 'int32'}.get(self.__connection.getftype(name),
+                                                         'json'))
+      del response['docs']
+      response['fields'] = names
+      return packColumns(columns, types, response)
+    if format != 'json':
+      names = None
+      if '*' not in fields:
+        names = [name.strip() for name in fields.split(',')]
+      names, values = tabulateDocs(response['docs'], names, bycolumn=(format == 'columns'))
+      del response['docs']
+      response['fields'] = names
+      if format == 'columns':
+        response['columns'] = values
+      else:
+        response['rows'] = values
+    json_dump = self.__json_encoder(response)
+    return json_dump
+
+
+  def ExportRecords(self, q="*:*", fields="*", orderby=None, order="asc", format="ndjson",
+                    count=None, pagesize=1000, chunksize=65536):
+    '''Stream the records matching a query.
+
+    Records are fetched a page at a time with cursor paging, the following pages being fetched while the current one is written out, and are written out in chunks as they arrive.  Memory use is bounded by a few pages whatever the number of records.
+
+    Formats are:
+
+    *ndjson: one JSON object per record per line
+    *json: a JSON array of records
+    *csv: comma separated values with a header line.  Values of multivalued fields are joined with "|".  With fields="*" the columns are the stored fields of the index.
+
+    The first page is fetched before this method returns, so errors in the query are raised here rather than while streaming.
+
+    :param q: Query string
+    :type q: string
+    :param fields: Comma delimited list of field names to return
+    :type fields: string
+    :param orderby: Name of field to sort results by
+    :type orderby: string
+    :param order: Indicates order of sorting, one of "asc" or "desc"
+    :type order: string
+    :param format: one of "ndjson", "json" or "csv"
+    :type format: string
+    :param count: maximum number of records, all records if None
+    :type count: integer
+    :param pagesize: number of records fetched in each request to SOLR
+    :type pagesize: integer
+    :param chunksize: approximate size in bytes of the chunks generated
+    :type chunksize: integer
+    :returns: the UTF-8 encoded output in chunks
+    :rtype: generator of strings
+    '''
+
+    if format not in ('ndjson', 'json', 'csv'):
+      raise ValueError('Unknown export format: %s' % format)
+    columns = None
+    if format == 'csv':
+      if fields == '*':
+        self.__FetchFields()
+        columns = [name for name, field in self.__fields['fields'].items()
+                   if field['schema'][2] == 'S']
+        columns.sort()
+      else:
+        columns = [name.strip() for name in fields.split(',')]
+      fields = ','.join(columns)
+    sort = None
+    if orderby != None:
+      sort = "%s %s" % (orderby, order)
+    records = SOLRPrefetchResponseIterator(self.__connection, q, fields=fields,
+                                           pagesize=pagesize, sort=sort, cursor=True)
+    return self.__ExportChunks(records, format, columns, count, chunksize)
+
+
+  def ExportArchive(self, q="*:*", pagesize=1000, chunksize=65536):
+    '''Stream the records matching a query as a Darwin Core Archive.
+
+    The archive is a zip file holding occurrence.txt, the records as tab separated text, and meta.xml, which maps the columns to Darwin Core terms.  The columns are the stored fields of the index (see GetFields) whose name, ignoring the suffix of dynamic fields, is a Darwin Core term or a known alias of one (i.e. "genus_s", "lat").  The record identifier is the first column.
+
+    The archive is generated while the records are fetched from SOLR as for ExportRecords, so neither the records nor the archive are held in memory or on disk.
+
+    :param q: Query string
+    :type q: string
+    :param pagesize: number of records fetched in each request to SOLR
+    :type pagesize: integer
+    :param chunksize: approximate size in bytes of the chunks generated
+    :type chunksize: integer
+    :returns: the zip file in chunks
+    :rtype: generator of strings
+    '''
+
+    self.__FetchFields()
+    # the unique key of the index, as for cursor paging
+    idfield = 'id'
+    columns = []
+    for name, field in self.__fields['fields'].items():
+      term = dwcarchive.termForField(name)
+      if name != idfield and term is not None and field['schema'][2] == 'S':
+        columns.append((name, term))
+    columns.sort()
+    fields = ','.join([idfield] + [name for name, term in columns])
+    records = SOLRPrefetchResponseIterator(self.__connection, q, fields=fields,
+                                           pagesize=pagesize, cursor=True)
+    return dwcarchive.archiveChunks(records, idfield, columns, chunksize)
+
+
+  # private generator of the chunks of an export
+  def __ExportChunks(self, records, format, columns, count, chunksize):
+    encode = self.__record_encoder
+    buffer = StringIO.StringIO()
+    writer = None
+    if format == 'csv':
+      writer = csv.writer(buffer)
+      writer.writerow(columns)
+    elif format == 'json':
+      buffer.write('[')
+    n = 0
+    try:
+      for record in records:
+        if count != None and n >= count:
+          break
+        if format == 'ndjson':
+          buffer.write(encode(record))
+          buffer.write('\n')
+        elif format == 'json':
+          if n > 0:
+            buffer.write(',\n')
+          buffer.write(encode(record))
+        else:
+          writer.writerow([self.__csvValue(record.get(name)) for name in columns])
+        n += 1
+        if buffer.tell() >= chunksize:
+          yield buffer.getvalue()
+          buffer.seek(0)
+          buffer.truncate()
+      if format == 'json':
+        buffer.write(']\n')
+      yield buffer.getvalue()
+    finally:
+      records.close()
+
+
+  def __csvValue(self, value):
+    if value is None:
+      return ''
+    if isinstance(value, list):
+      return '|'.join([self.__csvValue(v) for v in value])
+    if isinstance(value, unicode):
+      return value.encode('utf-8')
+    if isinstance(value, float):
+      # repr keeps the full precision of coordinates
+      return repr(value)
+    return str(value)
+
+
+  def GetSample(self, q="*:*", fields="*", count=1000, seed=None):
+    '''Retrieve a uniform random sample of records from the SOLR service.
+
+    Every matching record is equally likely to be in the sample.  The sample is drawn by the SOLR server in a single request, so it costs about the same as retrieving a page of count records.  The same seed returns the same sample until the index changes.  This requires a "random_*" dynamic field of type solr.RandomSortField in the SOLR schema, without which a SolrException with httpcode 400 is raised (see SolrConnection.randomSort).
+    
+    :param q: Query string
+    :type q: string
+    :param fields: Comma delimited list of field names to return
+    :type fields: string
+    :param count: Number of records in the sample
+    :type count: integer
+    :param seed: Seed for the random selection.  If not provided a seed is chosen and returned in the response.
+    :type seed: integer
+    :return: Records as for GetRecords with the addition of "seed"
+    :rtype: JSON UTF-8 encoded string
+    '''
+
+    if seed == None:
+      seed = random.randint(0, 2**31 - 1)
+    results = self.__connection.sample(count, seed=seed, q=q, fields=fields)
+    response = results['response']
+    response['seed'] = seed
     json_dump = self.__json_encoder(response)
     return json_dump
 
@@ -0,0 +1,274 @@
+'''
+:mod:`dwcarchive`
+=================
+
+:Synopsis:
+  Streaming Darwin Core Archive (DwC-A) output.
+  An archive is a zip file holding the records in occurrence.txt, a tab
+  separated text file, and meta.xml, which maps its columns to Darwin Core
+  terms.  See http://rs.tdwg.org/dwc/terms/guides/text/
+
+'''
+import struct
+import time
+import zlib
+from xml.sax.saxutils import quoteattr, escape
+
+DWC_NS = 'http://rs.tdwg.org/dwc/terms/'
+DC_NS = 'http://purl.org/dc/terms/'
+
+# Darwin Core terms of occurrence records, and the namespace of each
+DWC_TERMS = {}
+for _term in ['occurrenceID', 'catalogNumber', 'recordNumber', 'recordedBy',
+              'individualCount', 'sex', 'lifeStage', 'reproductiveCondition',
+              'behavior', 'establishmentMeans', 'occurrenceStatus', 'preparations',
+              'disposition', 'otherCatalogNumbers', 'occurrenceRemarks',
+              'institutionCode', 'collectionCode', 'datasetName', 'ownerInstitutionCode',
+              'basisOfRecord', 'informationWithheld', 'dataGeneralizations',
+              'dynamicProperties', 'eventID', 'samplingProtocol', 'samplingEffort',
+              'eventDate', 'eventTime', 'startDayOfYear', 'endDayOfYear', 'year', 'month',
+              'day', 'verbatimEventDate', 'habitat', 'fieldNumber', 'fieldNotes',
+              'eventRemarks', 'locationID', 'higherGeography', 'continent', 'waterBody',
+              'islandGroup', 'island', 'country', 'countryCode', 'stateProvince',
+              'county', 'municipality', 'locality', 'verbatimLocality',
+              'minimumElevationInMeters', 'maximumElevationInMeters',
+              'minimumDepthInMeters', 'maximumDepthInMeters', 'locationRemarks',
+              'decimalLatitude', 'decimalLongitude', 'geodeticDatum',
+              'coordinateUncertaintyInMeters', 'coordinatePrecision',
+              'verbatimCoordinates', 'verbatimLatitude', 'verbatimLongitude',
+              'georeferencedBy', 'georeferenceProtocol', 'georeferenceSources',
+              'georeferenceRemarks', 'identifiedBy', 'dateIdentified',
+              'identificationQualifier', 'typeStatus', 'identificationRemarks',
+              'taxonID', 'scientificName', 'acceptedNameUsage', 'higherClassification',
+              'kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'subgenus',
+              'specificEpithet', 'infraspecificEpithet', 'taxonRank',
+              'verbatimTaxonRank', 'scientificNameAuthorship', 'vernacularName',
+              'nomenclaturalCode', 'taxonomicStatus', 'taxonRemarks']:
+  DWC_TERMS[_term.lower()] = DWC_NS + _term
+for _term in ['modified', 'language', 'license', 'rightsHolder', 'accessRights',
+              'bibliographicCitation', 'references']:
+  DWC_TERMS[_term.lower()] = DC_NS + _term
+
+# field names used by the index for Darwin Core terms
+FIELD_ALIASES = {'lat': 'decimalLatitude',
+                 'lng': 'decimalLongitude',
+                 'long': 'decimalLongitude',
+                 'lon': 'decimalLongitude',
+                 'sciname': 'scientificName',
+                 'state': 'stateProvince',
+                 'province': 'stateProvince',
+                }
+
+# suffixes of SOLR dynamic fields
+FIELD_SUFFIXES = ['_s', '_t', '_i', '_l', '_f', '_d', '_b', '_dt',
+                  '_ti', '_tl', '_tf', '_td', '_tdt']
+
+
+def termForField(name):
+  '''Returns the URI of the Darwin Core term of an index field, or None if the field is not a Darwin Core term.
+
+  The suffix of dynamic fields is ignored (i.e. "genus_s" is the genus) and names are matched without regard to case.
+
+  :param name: name of the field
+  :type name: string
+  :rtype: string
+  '''
+  base = name
+  for suffix in FIELD_SUFFIXES:
+    if base.endswith(suffix):
+      base = base[:-len(suffix)]
+      break
+  base = FIELD_ALIASES.get(base.lower(), base)
+  return DWC_TERMS.get(base.lower())
+
+
+def metaXml(idfield, columns, location='occurrence.txt'):
+  '''Returns the meta.xml of an archive.
+
+  :param idfield: name of the field in the first column, the record identifier
+  :type idfield: string
+  :param columns: (field name, term URI) of the following columns
+  :type columns: list
+  :param location: name of the records file in the archive
+  :type location: string
+  :rtype: UTF-8 encoded string
+  '''
+  lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+           '<archive xmlns="http://rs.tdwg.org/dwc/text/">',
+           '  <core encoding="UTF-8" fieldsTerminatedBy="\\t" linesTerminatedBy="\\n" '
+           'fieldsEnclosedBy="" ignoreHeaderLines="1" rowType="%sOccurrence">' % DWC_NS,
+           '    <files>',
+           '      <location>%s</location>' % escape(location),
+           '    </files>',
+           '    <id index="0"/>']
+  for i, (name, term) in enumerate(columns):
+    lines.append('    <field index="%d" term=%s/>' % (i + 1, quoteattr(term)))
+  lines.extend(['  </core>', '</archive>', ''])
+  return '\n'.join(lines)
+
+
+def textValue(value):
+  '''Returns a field value as it is written to occurrence.txt: UTF-8 encoded, with values of multivalued fields joined with "|" and tabs and line breaks replaced by spaces.'''
+  if value is None:
+    return ''
+  if isinstance(value, list):
+    return '|'.join([textValue(v) for v in value])
+  if isinstance(value, unicode):
+    value = value.encode('utf-8')
+  elif isinstance(value, float):
+    value = repr(value)
+  else:
+    value = str(value)
+  return value.replace('\t', ' ').replace('\r', ' ').replace('\n', ' ')
+
+
+class ZipStream(object):
+  '''Writes a zip archive as a sequence of strings, without seeking or holding file contents.
+
+  Each method returns the bytes of the archive it produced, to be written out in order.  Sizes and checksums of each file are written after its data (general purpose flag bit 3) and files are written in Zip64 format so they may exceed 4GB.
+  '''
+
+  _LOCAL = struct.Struct('<IHHHHHIIIHH')
+  _ZIP64_LOCAL = struct.Struct('<HHQQ')
+  _DESCRIPTOR = struct.Struct('<IIQQ')
+  _CENTRAL = struct.Struct('<IHHHHHHIIIHHHHHII')
+  _END = struct.Struct('<IHHHHIIH')
+  _ZIP64_END = struct.Struct('<IQHHIIQQQQ')
+  _ZIP64_LOCATOR = struct.Struct('<IIQI')
+  _LIMIT = 0xFFFFFFFF
+
+  def __init__(self, compresslevel=6):
+    '''
+    :param compresslevel: zlib compression level of the files
+    :type compresslevel: integer
+    '''
+    self.compresslevel = compresslevel
+    self.offset = 0
+    self._files = []
+    self._current = None
+
+
+  def _out(self, data):
+    self.offset += len(data)
+    return data
+
+
+  def open(self, name, date_time=None):
+    '''Starts a file in the archive.
+
+    :param name: name of the file
+    :type name: string
+    :param date_time: modification time of the file as (year, month, day, hour, minute, second), now if None
+    :type date_time: tuple
+    '''
+    if date_time is None:
+      date_time = time.localtime()[:6]
+    dosdate = (date_time[0] - 1980) << 9 | date_time[1] << 5 | date_time[2]
+    dostime = date_time[3] << 11 | date_time[4] << 5 | (date_time[5] // 2)
+    if isinstance(name, unicode):
+      name = name.encode('utf-8')
+    self._current = {'name': name, 'offset': self.offset, 'date': dosdate, 'time': dostime,
+                     'crc': 0, 'size': 0, 'csize': 0,
+                     'compressor': zlib.compressobj(self.compresslevel, zlib.DEFLATED,
+                                                    -zlib.MAX_WBITS)}
+    extra = self._ZIP64_LOCAL.pack(1, 16, 0, 0)
+    header = self._LOCAL.pack(0x04034b50, 45, 0x08, 8, dostime, dosdate, 0,
+                              self._LIMIT, self._LIMIT, len(name), len(extra))
+    return self._out(header + name + extra)
+
+
+  def write(self, data):
+    '''Adds data to the current file, returning the compressed output, which may be empty.'''
+    entry = self._current
+    entry['crc'] = zlib.crc32(data, entry['crc'])
+    entry['size'] += len(data)
+    out = entry['compressor'].compress(data)
+    entry['csize'] += len(out)
+    return self._out(out)
+
+
+  def closeFile(self):
+    '''Ends the current file.'''
+    entry = self._current
+    out = entry['compressor'].flush()
+    entry['csize'] += len(out)
+    entry['crc'] = entry['crc'] & 0xFFFFFFFF
+    del entry['compressor']
+    self._files.append(entry)
+    self._current = None
+    return self._out(out + self._DESCRIPTOR.pack(0x08074b50, entry['crc'], entry['csize'],
+                                                 entry['size']))
+
+
+  def close(self):
+    '''Ends the archive, returning the central directory.'''
+    start = self.offset
+    out = []
+    for entry in self._files:
+      extra = ''
+      size, csize, offset = entry['size'], entry['csize'], entry['offset']
+      large = [v for v in (size, csize, offset) if v >= self._LIMIT]
+      if large:
+        # all three values go in the Zip64 extra field
+        extra = struct.pack('<HHQQQ', 1, 24, size, csize, offset)
+        size = csize = offset = self._LIMIT
+      out.append(self._CENTRAL.pack(0x02014b50, 45, 45, 0x08, 8, entry['time'], entry['date'],
+                                    entry['crc'], csize, size, len(entry['name']), len(extra),
+                                    0, 0, 0, 0, offset) + entry['name'] + extra)
+    directory = ''.join(out)
+    count = len(self._files)
+    end = ''
+    if start >= self._LIMIT or start + len(directory) >= self._LIMIT or count >= 0xFFFF:
+      zip64end = start + len(directory)
+      end = (self._ZIP64_END.pack(0x06064b50, 44, 45, 45, 0, 0, count, count,
+                                  len(directory), start) +
+             self._ZIP64_LOCATOR.pack(0x07064b50, 0, zip64end, 1))
+      end += self._END.pack(0x06054b50, 0, 0, 0xFFFF, 0xFFFF, self._LIMIT, self._LIMIT, 0)
+    else:
+      end = self._END.pack(0x06054b50, 0, 0, count, count, len(directory), start, 0)
+    return self._out(directory + end)
+
+
+def archiveChunks(records, idfield, columns, chunksize=65536, compresslevel=6):
+  '''Generates a Darwin Core Archive of records, in chunks of about chunksize bytes.
+
+  meta.xml is written first, then occurrence.txt as the records are read.  Only one chunk is held in memory at a time.
+
+  :param records: iterable of records, dictionaries of field values
+  :param idfield: name of the field identifying each record
+  :type idfield: string
+  :param columns: (field name, term URI) of the other fields written
+  :type columns: list
+  :param chunksize: approximate size in bytes of the chunks generated
+  :type chunksize: integer
+  :param compresslevel: zlib compression level of the archive files
+  :type compresslevel: integer
+  :rtype: generator of strings
+  '''
+  archive = ZipStream(compresslevel)
+  out = [archive.open('meta.xml'), archive.write(metaXml(idfield, columns)),
+         archive.closeFile()]
+  out.append(archive.open('occurrence.txt'))
+  names = [idfield] + [name for name, term in columns]
+  lines = ['\t'.join(names) + '\n']
+  pending = len(lines[0])
+  try:
+    for record in records:
+      line = '\t'.join([textValue(record.get(name)) for name in names]) + '\n'
+      lines.append(line)
+      pending += len(line)
+      if pending >= chunksize:
+        out.append(archive.write(''.join(lines)))
+        lines = []
+        pending = 0
+        data = ''.join(out)
+        out = []
+        if data:
+          yield data
+    out.append(archive.write(''.join(lines)))
+    out.append(archive.closeFile())
+    out.append(archive.close())
+    yield ''.join(out)
+  finally:
+    if hasattr(records, 'close'):
+      records.close()
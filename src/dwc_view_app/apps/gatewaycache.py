@@ -0,0 +1,1172 @@
+'''
+:mod:`gatewaycache`
+===================
+
+:Synopsis:
+  Caching support for the Darwin Core Views Gateway.
+  Cached values are tied to the version of the SOLR index they were
+  computed from, so they are refreshed after the index changes.
+
+'''
+import atexit
+import cPickle as pickle
+import logging
+import os
+import Queue
+import sys
+import threading
+import time
+import zlib
+try:
+  import sqlite3
+except ImportError:
+  sqlite3 = None
+try:
+  from hashlib import md5
+except ImportError:
+  from md5 import new as md5
+
+
+class IndexVersionTracker(object):
+  '''Tracks the version of a SOLR index.
+
+  The version is read from the luke handler (index information only, which is cheap) at most once every interval seconds.  Only one thread checks at a time; other threads are given the last known version meanwhile.
+  '''
+
+  def __init__(self, connection, interval=30.0):
+    '''
+    :param connection: connection to the SOLR server
+    :type connection: SolrConnection
+    :param interval: seconds for which a version is trusted before it is checked again
+    :type interval: float
+    '''
+    self.logger = logging.getLogger('gatewaycache.IndexVersionTracker')
+    self.connection = connection
+    self.interval = interval
+    self._version = None
+    self._checked = 0
+    self._lock = threading.Lock()
+
+
+  def current(self):
+    '''Returns the last known version without checking the server, None if it has never been checked.'''
+    return self._version
+
+
+  def get(self):
+    '''Returns the index version, checking the server if the known version is older than interval.
+
+    :returns: opaque version string built from the index version and lastModified
+    :rtype: string
+    '''
+    if self._version is not None and time.time() - self._checked < self.interval:
+      return self._version
+    if not self._lock.acquire(False):
+      if self._version is not None:
+        return self._version
+      # nothing known yet, wait for the check in progress
+      self._lock.acquire()
+    try:
+      if self._version is None or time.time() - self._checked >= self.interval:
+        self.check()
+    finally:
+      self._lock.release()
+    return self._version
+
+
+  def check(self):
+    '''Reads the index version from the server now.  If the server can not be reached the last known version is kept.'''
+    try:
+      info = self.connection.getIndexInfo()
+      version = '%s-%s' % (info.get('version'), info.get('lastModified'))
+      if version != self._version:
+        self.logger.info('SOLR index version is now %s' % version)
+      self._version = version
+    except Exception, e:
+      if self._version is None:
+        raise
+      self.logger.warning('Unable to check the SOLR index version: %s' % str(e))
+    self._checked = time.time()
+    return self._version
+
+
+class FieldMetadataCache(object):
+  '''In memory cache of the luke field listing of a SOLR index.
+
+  The listing is served from memory.  When the index version changes it is reloaded on a background thread while the previous listing continues to be served.  The listing is also stored, with its version, in a shared cache (i.e. the django cache) so other processes can start from it instead of calling luke.
+  '''
+
+  def __init__(self, connection, versions, cache=None, key='solr_fields'):
+    '''
+    :param connection: connection to the SOLR server
+    :type connection: SolrConnection
+    :param versions: tracker of the index version
+    :type versions: IndexVersionTracker
+    :param cache: shared cache with get(key) and set(key, value) methods, or None
+    :param key: key of the listing in the shared cache
+    :type key: string
+    '''
+    self.logger = logging.getLogger('gatewaycache.FieldMetadataCache')
+    self.connection = connection
+    self.versions = versions
+    self.cache = cache
+    self.key = key
+    self._fields = None
+    self._version = None
+    self._lock = threading.Lock()
+    self._refreshing = False
+
+
+  def get(self, block=False):
+    '''Returns the field listing, as from SolrConnection.getFields().
+
+    :param block: if True a listing of an older index version is reloaded before returning rather than in the background
+    :type block: boolean
+    '''
+    version = self.versions.get()
+    if self._fields is None or (block and self._version != version):
+      self._lock.acquire()
+      try:
+        if self._fields is None or (block and self._version != version):
+          self._load(version)
+      finally:
+        self._lock.release()
+    elif self._version != version:
+      self._refreshAsync(version)
+    return self._fields
+
+
+  def version(self):
+    '''Returns the index version of the listing being served.'''
+    return self._version
+
+
+  def dump(self):
+    '''Returns (version, listing) of the listing being served, or None.'''
+    if self._fields is None:
+      return None
+    return (self._version, self._fields)
+
+
+  def restore(self, version, fields):
+    '''Serves fields, a listing of the given index version, i.e. from a snapshot.'''
+    self._lock.acquire()
+    try:
+      self.connection.setFields(fields)
+      self._fields = fields
+      self._version = version
+    finally:
+      self._lock.release()
+
+
+  def _load(self, version):
+    fields = None
+    if self.cache is not None:
+      entry = self.cache.get(self.key)
+      if entry is not None and entry[0] == version:
+        fields = entry[1]
+    if fields is None:
+      fields = self.connection.getFields(refresh=True)
+      if self.cache is not None:
+        self.cache.set(self.key, (version, fields))
+    self.connection.setFields(fields)
+    self._fields = fields
+    self._version = version
+
+
+  def _refreshAsync(self, version):
+    self._lock.acquire()
+    try:
+      if self._refreshing:
+        return
+      self._refreshing = True
+    finally:
+      self._lock.release()
+
+    def refresh():
+      try:
+        self._load(version)
+      except Exception, e:
+        self.logger.exception('Field listing refresh failed')
+      self._refreshing = False
+
+    t = threading.Thread(target=refresh)
+    t.setDaemon(True)
+    t.start()
+
+
+class LRUCache(object):
+  '''Thread safe least recently used cache of strings, bounded by the total size of the cached values in bytes.
+
+  Entries are kept in a dictionary and a circular doubly linked list ordered from the most to the least recently used, so lookups, inserts and evictions are constant time.
+  '''
+
+  # positions in a list entry
+  _PREV, _NEXT, _KEY, _VALUE, _SIZE = 0, 1, 2, 3, 4
+
+  def __init__(self, maxbytes):
+    '''
+    :param maxbytes: budget for the total size of the cached values
+    :type maxbytes: integer
+    '''
+    self.maxbytes = maxbytes
+    self.nbytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._map = {}
+    self._root = []
+    self._root[:] = [self._root, self._root, None, None, 0]
+    self._lock = threading.Lock()
+
+
+  def __len__(self):
+    return len(self._map)
+
+
+  def get(self, key):
+    '''Returns the value cached under key, or None, and counts the hit or miss.'''
+    self._lock.acquire()
+    try:
+      link = self._map.get(key)
+      if link is None:
+        self.misses += 1
+        return None
+      self._unlink(link)
+      self._linkFront(link)
+      self.hits += 1
+      return link[self._VALUE]
+    finally:
+      self._lock.release()
+
+
+  def set(self, key, value, size=None):
+    '''Caches value under key, evicting the least recently used values until the budget is met.
+
+    :param size: size of the value in bytes, len(value) if not provided
+    :type size: integer
+    :returns: False if the value is larger than the whole budget and was not cached
+    :rtype: boolean
+    '''
+    if size is None:
+      size = len(value)
+    if size > self.maxbytes:
+      return False
+    self._lock.acquire()
+    try:
+      link = self._map.pop(key, None)
+      if link is not None:
+        self._unlink(link)
+        self.nbytes -= link[self._SIZE]
+      link = [None, None, key, value, size]
+      self._linkFront(link)
+      self._map[key] = link
+      self.nbytes += size
+      while self.nbytes > self.maxbytes:
+        last = self._root[self._PREV]
+        self._unlink(last)
+        del self._map[last[self._KEY]]
+        self.nbytes -= last[self._SIZE]
+        self.evictions += 1
+      return True
+    finally:
+      self._lock.release()
+
+
+  def clear(self):
+    '''Removes all entries.  Counters are kept.'''
+    self._lock.acquire()
+    try:
+      self._map.clear()
+      self._root[:] = [self._root, self._root, None, None, 0]
+      self.nbytes = 0
+    finally:
+      self._lock.release()
+
+
+  def items(self):
+    '''Returns a list of (key, value, size) of all entries, from the least to the most recently used.'''
+    self._lock.acquire()
+    try:
+      result = []
+      link = self._root[self._PREV]
+      while link is not self._root:
+        result.append((link[self._KEY], link[self._VALUE], link[self._SIZE]))
+        link = link[self._PREV]
+      return result
+    finally:
+      self._lock.release()
+
+
+  def stats(self):
+    '''Returns a dictionary of the counters and usage of the cache.'''
+    return {'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._map),
+            'bytes': self.nbytes,
+            'maxbytes': self.maxbytes,
+           }
+
+
+  def _unlink(self, link):
+    link[self._PREV][self._NEXT] = link[self._NEXT]
+    link[self._NEXT][self._PREV] = link[self._PREV]
+
+
+  def _linkFront(self, link):
+    first = self._root[self._NEXT]
+    link[self._PREV] = self._root
+    link[self._NEXT] = first
+    first[self._PREV] = link
+    self._root[self._NEXT] = link
+
+
+class EncodedResponse(object):
+  '''An encoded gateway response held in the result cache, with its ETag.
+
+  The body may be held gzip compressed, in which case it can be sent as is to clients that accept gzip content encoding.
+  '''
+
+  # gzip format, rather than a raw zlib stream, so the body is a valid
+  # "Content-Encoding: gzip" payload
+  _WBITS = 16 + zlib.MAX_WBITS
+
+  def __init__(self, data, compresslevel=0):
+    '''
+    :param data: the encoded response
+    :type data: string
+    :param compresslevel: zlib compression level of the held body, 0 to hold it uncompressed
+    :type compresslevel: integer
+    '''
+    self.etag = '"%s"' % md5(data).hexdigest()
+    self.length = len(data)
+    if compresslevel > 0:
+      compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, self._WBITS)
+      self.body = compressor.compress(data) + compressor.flush()
+      self.compressed = True
+    else:
+      self.body = data
+      self.compressed = False
+
+
+  def __len__(self):
+    return len(self.body)
+
+
+  def data(self):
+    '''Returns the uncompressed response.'''
+    if self.compressed:
+      return zlib.decompress(self.body, self._WBITS)
+    return self.body
+
+
+class SingleFlight(object):
+  '''Coalesces concurrent identical calls.
+
+  The first caller with a given key runs the call; callers arriving with the same key while it is running wait for it and receive the same result, or the same exception, instead of repeating the work.
+  '''
+
+  class _Call(object):
+    def __init__(self):
+      self.done = threading.Event()
+      self.result = None
+      self.error = None
+
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._calls = {}
+    self._counts = {}
+
+
+  def do(self, key, func, name=None):
+    '''Returns func(), shared with any concurrent call of the same key.
+
+    :param key: identity of the call
+    :type key: string
+    :param func: function with no arguments to run
+    :type func: function
+    :param name: name under which the call is counted, i.e. the endpoint
+    :type name: string
+    '''
+    self._lock.acquire()
+    try:
+      counts = self._counts.setdefault(name, [0, 0])
+      call = self._calls.get(key)
+      leader = call is None
+      if leader:
+        call = self._calls[key] = self._Call()
+        counts[0] += 1
+      else:
+        counts[1] += 1
+    finally:
+      self._lock.release()
+
+    if leader:
+      try:
+        call.result = func()
+      except:
+        call.error = sys.exc_info()
+      self._lock.acquire()
+      try:
+        del self._calls[key]
+      finally:
+        self._lock.release()
+      call.done.set()
+    else:
+      call.done.wait()
+    if call.error is not None:
+      raise call.error[0], call.error[1], call.error[2]
+    return call.result
+
+
+  def inflight(self):
+    '''Returns the number of calls currently running.'''
+    return len(self._calls)
+
+
+  def running(self, key):
+    '''Returns True if a call of key is running.'''
+    return self._calls.has_key(key)
+
+
+  def stats(self):
+    '''Returns the number of calls run ("executions") and the number of calls that shared a running call ("coalesced"), keyed by name.'''
+    result = {}
+    for name, counts in self._counts.items():
+      result[name] = {'executions': counts[0], 'coalesced': counts[1]}
+    return result
+
+
+class SharedStore(object):
+  '''Interface of a store of cached results shared by the gateway processes, the second tier of the ResultCache.
+
+  Values are EncodedResponse instances stored with the index version they were computed from.  Implementations must not raise on failures of the underlying store, a failure is a miss.
+  '''
+
+  def get(self, key):
+    '''Returns the value stored under key or None.'''
+    raise NotImplementedError()
+
+
+  def set(self, key, value, version):
+    '''Stores value, computed from the index version, under key.'''
+    raise NotImplementedError()
+
+
+  def invalidate(self, version):
+    '''Discards values computed from index versions other than version, if the store can.'''
+    pass
+
+
+class DjangoCacheStore(SharedStore):
+  '''SharedStore held in a django cache backend, i.e. memcached.
+
+  Keys are hashed to meet the key restrictions of memcached.  Since keys include the index version, entries of other versions are never read and are left to expire.
+  '''
+
+  def __init__(self, cache, prefix='gw_', timeout=None):
+    '''
+    :param cache: django cache (django.core.cache.cache)
+    :param prefix: prefix of the keys
+    :type prefix: string
+    :param timeout: seconds an entry is held, the default of the backend if None
+    :type timeout: integer
+    '''
+    self.logger = logging.getLogger('gatewaycache.DjangoCacheStore')
+    self.cache = cache
+    self.prefix = prefix
+    self.timeout = timeout
+
+
+  def _key(self, key):
+    return self.prefix + md5(key).hexdigest()
+
+
+  def get(self, key):
+    try:
+      return self.cache.get(self._key(key))
+    except Exception, e:
+      self.logger.warning('Shared cache get failed: %s' % str(e))
+      return None
+
+
+  def set(self, key, value, version):
+    try:
+      self.cache.set(self._key(key), value, self.timeout)
+    except Exception, e:
+      self.logger.warning('Shared cache set failed: %s' % str(e))
+
+
+class SQLiteStore(SharedStore):
+  '''SharedStore held in an SQLite database file, shared by the gateway processes of a host.
+
+  The store is bounded to about maxbytes; when it is exceeded the oldest entries are deleted.  Entries of other index versions are deleted on invalidation.
+  '''
+
+  def __init__(self, path, maxbytes=256 * 1024 * 1024, timeout=5.0):
+    '''
+    :param path: path of the SQLite database file
+    :type path: string
+    :param maxbytes: budget for the total size of the stored values
+    :type maxbytes: integer
+    :param timeout: seconds to wait for a lock held by another process
+    :type timeout: float
+    '''
+    self.logger = logging.getLogger('gatewaycache.SQLiteStore')
+    self.path = path
+    self.maxbytes = maxbytes
+    self.timeout = timeout
+    self._local = threading.local()
+    self._written = 0
+    if sqlite3 is None:
+      raise ImportError('sqlite3 is required for SQLiteStore')
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+    conn = self._connection()
+    conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, version TEXT, '
+                 'value BLOB, size INTEGER, created REAL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS results_created ON results (created)')
+    conn.commit()
+
+
+  # connections can not be shared between threads, each has its own
+  def _connection(self):
+    conn = getattr(self._local, 'conn', None)
+    if conn is None:
+      conn = self._local.conn = sqlite3.connect(self.path, timeout=self.timeout)
+    return conn
+
+
+  def get(self, key):
+    try:
+      row = self._connection().execute('SELECT value FROM results WHERE key=?',
+                                        (key,)).fetchone()
+    except Exception, e:
+      self.logger.warning('Shared cache get failed: %s' % str(e))
+      return None
+    if row is None:
+      return None
+    try:
+      return pickle.loads(str(row[0]))
+    except Exception, e:
+      #a truncated or foreign value is dropped so it is recomputed
+      self.logger.warning('Shared cache value of %s is unreadable: %s' % (key, str(e)))
+      try:
+        conn = self._connection()
+        conn.execute('DELETE FROM results WHERE key=?', (key,))
+        conn.commit()
+      except Exception, e:
+        self.logger.warning('Shared cache delete failed: %s' % str(e))
+      return None
+
+
+  def set(self, key, value, version):
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    try:
+      conn = self._connection()
+      conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                   (key, version, sqlite3.Binary(data), len(data), time.time()))
+      conn.commit()
+      # check the budget after about a tenth of it has been written
+      self._written += len(data)
+      if self._written > self.maxbytes / 10:
+        self._written = 0
+        self._evict(conn)
+    except Exception, e:
+      self.logger.warning('Shared cache set failed: %s' % str(e))
+
+
+  def _evict(self, conn):
+    total = conn.execute('SELECT SUM(size) FROM results').fetchone()[0] or 0
+    if total <= self.maxbytes:
+      return
+    excess = total - self.maxbytes
+    freed = 0
+    keys = []
+    for key, size in conn.execute('SELECT key, size FROM results ORDER BY created'):
+      keys.append((key,))
+      freed += size
+      if freed >= excess:
+        break
+    conn.executemany('DELETE FROM results WHERE key=?', keys)
+    conn.commit()
+
+
+  def invalidate(self, version):
+    try:
+      conn = self._connection()
+      conn.execute('DELETE FROM results WHERE version<>?', (version,))
+      conn.commit()
+    except Exception, e:
+      self.logger.warning('Shared cache invalidation failed: %s' % str(e))
+
+
+class ResultCache(object):
+  '''Cache of gateway results, divided into regions (i.e. one per endpoint) each with its own byte budget and hit / miss counters.
+
+  Results are keyed by the region, the index version and the canonical form of the request parameters, so requests that differ only in whitespace or parameter order share an entry.  All regions are cleared when the index version changes.
+
+  Concurrent misses of the same result are coalesced, so only one of them does the work.
+
+  Results are held as EncodedResponse instances, optionally compressed, so a hit costs no decoding or encoding.  JSON responses typically compress to a fifth of their size or less, so the same budget holds several times as many compressed results.
+
+  The regions are the first tier (L1) of the cache, private to the process.  With a SharedStore as second tier (L2), a result missing from L1 is looked up in L2 before it is computed, and computed results are written to both tiers, so gateway processes share their results.
+  '''
+
+  def __init__(self, versions, budgets=None, maxbytes=8 * 1024 * 1024,
+               compresslevel=0, compressmin=1024, shared=None):
+    '''
+    :param versions: tracker of the index version
+    :type versions: IndexVersionTracker
+    :param budgets: byte budget of named regions
+    :type budgets: dictionary
+    :param maxbytes: byte budget of regions not listed in budgets
+    :type maxbytes: integer
+    :param compresslevel: zlib compression level of cached results, 0 for no compression
+    :type compresslevel: integer
+    :param compressmin: results smaller than this many bytes are not compressed
+    :type compressmin: integer
+    :param shared: second tier of the cache, shared with other processes
+    :type shared: SharedStore
+    '''
+    self.logger = logging.getLogger('gatewaycache.ResultCache')
+    self.versions = versions
+    self.maxbytes = maxbytes
+    self.compresslevel = compresslevel
+    self.compressmin = compressmin
+    self._regions = {}
+    self._flights = SingleFlight()
+    self._version = None
+    self._lock = threading.Lock()
+    self.shared = shared
+    self._sharedcounts = {}
+    if budgets is not None:
+      for name, size in budgets.items():
+        self._regions[name] = LRUCache(size)
+
+
+  def region(self, name):
+    '''Returns the LRUCache of the named region, creating it if necessary.'''
+    cache = self._regions.get(name)
+    if cache is None:
+      self._lock.acquire()
+      try:
+        cache = self._regions.setdefault(name, LRUCache(self.maxbytes))
+      finally:
+        self._lock.release()
+    return cache
+
+
+  def key(self, version, params):
+    '''Returns the canonical cache key of a set of request parameters.
+
+    Parameters are sorted by name, unicode values are utf-8 encoded, runs of whitespace in strings are collapsed and parameters that are None are dropped.
+    '''
+    parts = [str(version)]
+    names = params.keys()
+    names.sort()
+    for name in names:
+      value = params[name]
+      if value is None:
+        continue
+      if isinstance(value, unicode):
+        value = value.encode('utf-8')
+      if isinstance(value, str):
+        value = ' '.join(value.split())
+      else:
+        value = repr(value)
+      parts.append('%s=%s' % (name, value))
+    return '&'.join(parts)
+
+
+  def fetch(self, name, params, compute):
+    '''Returns the result for params from the named region, calling compute() and caching its result on a miss.
+
+    :param name: name of the region
+    :type name: string
+    :param params: the parameters that determine the result
+    :type params: dictionary
+    :param compute: function with no arguments that returns the result as a string
+    :type compute: function
+    :rtype: EncodedResponse
+    '''
+    version = self.versions.get()
+    if version != self._version:
+      self.invalidate(version)
+    cache = self.region(name)
+    key = self.key(version, params)
+    result = cache.get(key)
+    if result is None:
+      result = self._flights.do(key, lambda: self._compute(name, cache, key, version, compute),
+                                name)
+    return result
+
+
+  def _compute(self, name, cache, key, version, compute):
+    result = None
+    if self.shared is not None:
+      result = self.shared.get(key)
+      counts = self._sharedcounts.setdefault(name, [0, 0])
+      if result is None:
+        counts[1] += 1
+      else:
+        counts[0] += 1
+    if result is None:
+      result = self.encode(compute())
+      if self.shared is not None:
+        self.shared.set(key, result, version)
+    cache.set(key, result, len(key) + len(result))
+    return result
+
+
+  def encode(self, data):
+    '''Returns data as an EncodedResponse, compressed if it is at least compressmin bytes.'''
+    if isinstance(data, unicode):
+      data = data.encode('utf-8')
+    if len(data) < self.compressmin:
+      return EncodedResponse(data)
+    return EncodedResponse(data, self.compresslevel)
+
+
+  def invalidate(self, version=None):
+    '''Clears all regions, recording version as the version of the cached results.'''
+    self._lock.acquire()
+    try:
+      if self._version is not None:
+        self.logger.info('Index version changed, clearing cached results')
+      for cache in self._regions.values():
+        cache.clear()
+      self._version = version
+    finally:
+      self._lock.release()
+    if self.shared is not None and version is not None:
+      self.shared.invalidate(version)
+
+
+  def dump(self):
+    '''Returns (version, regions), where regions maps each region name to the list of its (key, value, size) entries from the least to the most recently used.'''
+    regions = {}
+    for name, cache in self._regions.items():
+      regions[name] = cache.items()
+    return (self._version, regions)
+
+
+  def restore(self, version, regions):
+    '''Adds the entries of regions, as from dump(), computed from the given index version.'''
+    if version != self._version:
+      self.invalidate(version)
+    for name, items in regions.items():
+      cache = self.region(name)
+      for key, value, size in items:
+        cache.set(key, value, size)
+
+
+  def stats(self):
+    '''Returns the counters and usage of each region, keyed by region name.
+
+    Besides the LRUCache counters of the first tier each region reports "executions", the number of misses that were looked up in the second tier or computed, "coalesced", the number of misses that shared the computation of a concurrent identical miss, and "l1ratio", the hit ratio of the first tier.  With a second tier "l2hits", "l2misses" and "l2ratio" are its counters and hit ratio.
+    '''
+    result = {}
+    flights = self._flights.stats()
+    for name, cache in self._regions.items():
+      stats = result[name] = cache.stats()
+      stats.update(flights.get(name, {'executions': 0, 'coalesced': 0}))
+      stats['l1ratio'] = self._ratio(stats['hits'], stats['misses'])
+      if self.shared is not None:
+        hits, misses = self._sharedcounts.get(name, [0, 0])
+        stats['l2hits'] = hits
+        stats['l2misses'] = misses
+        stats['l2ratio'] = self._ratio(hits, misses)
+    return result
+
+
+  def _ratio(self, hits, misses):
+    if hits + misses == 0:
+      return None
+    return float(hits) / (hits + misses)
+
+
+class RefreshScheduler(object):
+  '''Serves values from memory and refreshes them in the background before they expire (stale while revalidate).
+
+  Each value is registered under a key with the function that computes it.  A daemon thread wakes every tick seconds, checks the index version and queues the values that are older than refreshahead * ttl or were computed from an older index version, which a pool of worker threads recomputes, so a value that is slow to compute (e.g. the tile pyramid) holds up one worker rather than the refresh of every other value.  A value is queued at most once and never computed by two threads at once.  Requests are served the value in memory; a request that finds a value due for refresh queues it for the workers rather than waiting for it, so a burst of stale reads adds no threads.  The workers are started by start(), or by the first value queued before then.
+
+  If a refresh fails the last good value continues to be served, but never once it is older than maxstale: then the value is recomputed while the request waits and the error is raised if that fails too.  A request only waits on the computation when no value has been computed yet, and then shares the computation already running, if any.
+  '''
+
+  class _Entry(object):
+    def __init__(self, key, compute, ttl=None):
+      self.key = key
+      self.compute = compute
+      self.ttl = ttl
+      self.value = None
+      self.time = None
+      self.version = None
+      self.refreshes = 0
+      self.errors = 0
+      self.error = None
+
+
+  def __init__(self, versions=None, ttl=300.0, maxstale=3600.0, refreshahead=0.75, tick=None,
+               workers=3):
+    '''
+    :param versions: tracker of the index version, values are refreshed when it changes
+    :type versions: IndexVersionTracker
+    :param ttl: seconds for which a value is fresh
+    :type ttl: float
+    :param maxstale: seconds after which a value that could not be refreshed is no longer served
+    :type maxstale: float
+    :param refreshahead: fraction of ttl after which a value is refreshed
+    :type refreshahead: float
+    :param tick: seconds between checks of the scheduler thread, by default half the time between refresh and expiry
+    :type tick: float
+    :param workers: number of threads recomputing the values due for refresh
+    :type workers: integer
+    '''
+    self.logger = logging.getLogger('gatewaycache.RefreshScheduler')
+    self.versions = versions
+    self.ttl = ttl
+    self.maxstale = max(maxstale, ttl)
+    self.refreshahead = refreshahead
+    if tick is None:
+      tick = max(1.0, ttl * (1.0 - refreshahead) / 2.0)
+    self.tick = tick
+    self.workers = max(1, workers)
+    self._entries = {}
+    self._flights = SingleFlight()
+    self._lock = threading.Lock()
+    self._stop = threading.Event()
+    self._thread = None
+    self._queue = Queue.Queue()
+    self._queued = set()
+    self._workers = []
+
+
+  def register(self, key, compute, ttl=None):
+    '''Registers the function that computes the value of key, if key is not already registered.
+
+    :param key: name of the value
+    :type key: string
+    :param compute: function with no arguments that returns the value
+    :type compute: function
+    :param ttl: seconds for which the value is fresh, the ttl of the scheduler if None.  A value that is costly to compute can be given a long ttl so it is only refreshed when the index version changes.
+    :type ttl: float
+    '''
+    self._lock.acquire()
+    try:
+      entry = self._entries.get(key)
+      if entry is None:
+        entry = self._entries[key] = self._Entry(key, compute, ttl)
+      elif ttl is not None:
+        entry.ttl = ttl
+      return entry
+    finally:
+      self._lock.release()
+
+
+  def get(self, key, compute=None, wait=True):
+    '''Returns the value of key, registering compute for it if it is not registered yet.
+
+    With wait False None is returned rather than waiting for a value that has not been computed yet (or is too stale to serve), and the value is computed in the background.
+    '''
+    entry = self._entries.get(key)
+    if entry is None:
+      entry = self.register(key, compute)
+    elif entry.compute is None:
+      entry.compute = compute
+    now = time.time()
+    if entry.time is None or now - entry.time > self._maxstale(entry):
+      if not wait:
+        self._refreshAsync(entry)
+        return None
+      self._flights.do(key, lambda: self._refresh(entry))
+    elif self._due(entry, now):
+      self._refreshAsync(entry)
+    return entry.value
+
+
+  def start(self):
+    '''Starts the scheduler thread and its workers.  Registered values that have not been computed yet are computed right away.'''
+    if self._thread is not None:
+      return
+    self._stop.clear()
+    self._thread = threading.Thread(target=self._run)
+    self._thread.setDaemon(True)
+    self._thread.start()
+    self._startWorkers()
+
+
+  def stop(self):
+    '''Stops the scheduler thread and its workers.'''
+    self._stop.set()
+    self._thread = None
+    self._lock.acquire()
+    try:
+      self._workers = []
+    finally:
+      self._lock.release()
+
+
+  def dump(self):
+    '''Returns a dictionary of (version, value) of each computed value, keyed by name.'''
+    result = {}
+    for key, entry in self._entries.items():
+      if entry.time is not None:
+        result[key] = (entry.version, entry.value)
+    return result
+
+
+  def restore(self, values):
+    '''Serves values, as from dump(), as if they were computed now.  Values of keys that are not registered are served once a request registers the key.'''
+    now = time.time()
+    for key, (version, value) in values.items():
+      entry = self.register(key, None)
+      entry.value = value
+      entry.version = version
+      entry.time = now
+
+
+  def stats(self):
+    '''Returns the age in seconds, index version, refresh and error counts and last error of each value, keyed by name.'''
+    now = time.time()
+    result = {}
+    for key, entry in self._entries.items():
+      age = None
+      if entry.time is not None:
+        age = now - entry.time
+      result[key] = {'age': age,
+                     'version': entry.version,
+                     'refreshes': entry.refreshes,
+                     'errors': entry.errors,
+                     'error': entry.error,
+                    }
+    return result
+
+
+  def _ttl(self, entry):
+    if entry.ttl is None:
+      return self.ttl
+    return entry.ttl
+
+
+  def _maxstale(self, entry):
+    return max(self.maxstale, self._ttl(entry))
+
+
+  def _due(self, entry, now):
+    if entry.time is None or now - entry.time >= self._ttl(entry) * self.refreshahead:
+      return True
+    return self.versions is not None and entry.version != self.versions.current()
+
+
+  def _refresh(self, entry):
+    version = None
+    if self.versions is not None:
+      version = self.versions.current()
+    try:
+      value = entry.compute()
+    except Exception, e:
+      entry.errors += 1
+      entry.error = str(e)
+      self.logger.warning('Refresh of %s failed: %s' % (entry.key, str(e)))
+      raise
+    entry.value = value
+    entry.time = time.time()
+    entry.version = version
+    entry.refreshes += 1
+
+
+  # refreshes entry, keeping the value in memory if the refresh fails
+  def _refreshQuietly(self, entry):
+    try:
+      self._flights.do(entry.key, lambda: self._refresh(entry))
+    except Exception:
+      pass
+
+
+  def _refreshAsync(self, entry):
+    self._enqueue(entry)
+
+
+  # starts the workers, also when values are due for refresh before start()
+  def _startWorkers(self):
+    self._lock.acquire()
+    try:
+      if self._stop.isSet():
+        return
+      self._workers = [worker for worker in self._workers if worker.isAlive()]
+      while len(self._workers) < self.workers:
+        worker = threading.Thread(target=self._work)
+        worker.setDaemon(True)
+        worker.start()
+        self._workers.append(worker)
+    finally:
+      self._lock.release()
+
+
+  # queues entry for the workers unless it is queued or being refreshed already
+  def _enqueue(self, entry):
+    self._lock.acquire()
+    try:
+      if entry.key in self._queued or self._flights.running(entry.key):
+        return
+      self._queued.add(entry.key)
+    finally:
+      self._lock.release()
+    self._queue.put(entry)
+    self._startWorkers()
+
+
+  def _work(self):
+    while not self._stop.isSet():
+      try:
+        entry = self._queue.get(True, self.tick)
+      except Queue.Empty:
+        continue
+      try:
+        self._refreshQuietly(entry)
+      finally:
+        self._lock.acquire()
+        try:
+          self._queued.discard(entry.key)
+        finally:
+          self._lock.release()
+
+
+  def _run(self):
+    while not self._stop.isSet():
+      if self.versions is not None:
+        try:
+          self.versions.get()
+        except Exception, e:
+          self.logger.warning('Unable to check the SOLR index version: %s' % str(e))
+      now = time.time()
+      for entry in self._entries.values():
+        if self._stop.isSet():
+          break
+        if entry.compute is not None and self._due(entry, now):
+          self._enqueue(entry)
+      self._stop.wait(self.tick)
+
+
+class CacheSnapshot(object):
+  '''Persistent snapshot of cached gateway values, held in an SQLite database file.
+
+  The snapshot records the index version the values were computed from, and is only loaded if that is still the version of the index.  It can be saved periodically and when the process exits, from start() on; creating a snapshot opens no file and starts no thread.  Values are stored pickled, grouped in named sections.  If the sqlite3 module is not available, or the file can not be written, the snapshot is disabled and a warning logged.
+  '''
+
+  def __init__(self, path, interval=600.0):
+    '''
+    :param path: path of the SQLite database file
+    :type path: string
+    :param interval: seconds between periodic saves
+    :type interval: float
+    '''
+    self.logger = logging.getLogger('gatewaycache.CacheSnapshot')
+    self.path = path
+    self.interval = interval
+    self._collect = None
+    self._stop = threading.Event()
+    self._lock = threading.Lock()
+    self.enabled = sqlite3 is not None
+    if not self.enabled:
+      self.logger.warning('sqlite3 is not available, cache snapshots are disabled')
+
+
+  def _connect(self):
+    directory = os.path.dirname(self.path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+    conn = sqlite3.connect(self.path)
+    conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS entries (section TEXT, key TEXT, value BLOB, '
+                 'PRIMARY KEY (section, key))')
+    return conn
+
+
+  def load(self, version):
+    '''Returns the sections of the snapshot as a dictionary of dictionaries, or None if there is no snapshot of the given index version.'''
+    if not self.enabled or not os.path.exists(self.path):
+      return None
+    try:
+      conn = self._connect()
+      try:
+        row = conn.execute("SELECT value FROM meta WHERE name='version'").fetchone()
+        if row is None or row[0] != version:
+          self.logger.info('Cache snapshot is not of index version %s, ignored' % version)
+          return None
+        sections = {}
+        for section, key, value in conn.execute('SELECT section, key, value FROM entries'):
+          sections.setdefault(section, {})[key] = pickle.loads(str(value))
+        return sections
+      finally:
+        conn.close()
+    except Exception, e:
+      self.logger.warning('Unable to load cache snapshot %s: %s' % (self.path, str(e)))
+      return None
+
+
+  def save(self, version, sections):
+    '''Replaces the snapshot with sections, a dictionary of dictionaries of values computed from the given index version.'''
+    if not self.enabled or version is None:
+      return False
+    self._lock.acquire()
+    try:
+      try:
+        conn = self._connect()
+        try:
+          conn.execute('DELETE FROM entries')
+          conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+          for section, values in sections.items():
+            for key, value in values.items():
+              conn.execute('INSERT INTO entries VALUES (?, ?, ?)',
+                           (section, key,
+                            sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))))
+          conn.commit()
+        finally:
+          conn.close()
+        return True
+      except Exception, e:
+        self.logger.warning('Unable to save cache snapshot %s: %s' % (self.path, str(e)))
+        return False
+    finally:
+      self._lock.release()
+
+
+  def start(self, collect):
+    '''Saves the snapshot every interval seconds and when the process exits.
+
+    :param collect: function with no arguments returning the (version, sections) to save
+    :type collect: function
+    '''
+    if not self.enabled or self._collect is not None:
+      return
+    self._collect = collect
+    atexit.register(self._save)
+    t = threading.Thread(target=self._run)
+    t.setDaemon(True)
+    t.start()
+
+
+  def stop(self):
+    '''Stops periodic saving.'''
+    self._stop.set()
+
+
+  def _save(self):
+    version, sections = self._collect()
+    self.save(version, sections)
+
+
+  def _run(self):
+    while True:
+      self._stop.wait(self.interval)
+      if self._stop.isSet():
+        break
+      try:
+        self._save()
+      except Exception, e:
+        self.logger.warning('Cache snapshot failed: %s' % str(e))
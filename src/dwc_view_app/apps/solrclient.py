@@ -38,20 +38,33 @@
 # c.add(id='500',name='python test doc')
 # c.delete('123')
 # c.commit()
-# print c.search(q='id:[* TO *]', wt='python', rows='10',indent='on')
-# data = c.search(q='id:500', wt='python')
-# print 'first match=', eval(data)['response']['docs'][0]
+# print c.search({'q':'id:[* TO *]', 'rows':'10'})
+# data = c.search({'q':'id:500'})
+# print 'first match=', data['response']['docs'][0]
 
 
 
 import logging
 import httplib
 import socket
+import select
+import threading
+import time
 from xml.dom.minidom import parseString
 import codecs
 import urllib
 from datetime import datetime
 import random
+import math
+import Queue
+import re
+import struct
+import sys
+from array import array
+try:
+  import json
+except ImportError:
+  from django.utils import simplejson as json
 
 #===============================================================================
 
@@ -71,13 +84,382 @@ class SolrException(Exception):
 
 #===============================================================================
 
+class SolrDocs(object):
+  '''
+  The documents of a SOLR search response together with numFound and start.
+  Iterating yields the documents.
+  '''
+
+  def __init__(self, numFound=0, start=0, docs=None):
+    self.numFound = numFound
+    self.start = start
+    if docs is None:
+      docs = []
+    self.docs = docs
+
+
+  def __iter__(self):
+    return iter(self.docs)
+
+
+  def close(self):
+    pass
+
+#===============================================================================
+
+class SolrResponseDecoder(object):
+  '''
+  Base class for decoders of SOLR read responses.  A decoder names the SOLR
+  response writer it understands (wt) and turns an HTTP response into Python
+  structures.
+
+  This implementation evaluates wt=python responses, which is how responses
+  were decoded historically.  It buffers the whole body and runs it through
+  the Python compiler, so it is retained mostly for comparison.
+  '''
+  wt = 'python'
+
+  def decode(self, rsp):
+    '''
+    Returns the complete response as a dictionary.
+    '''
+    return eval( rsp.read() )
+
+
+  def decodeDocs(self, rsp):
+    '''
+    Returns a SolrDocs for the documents of a search response.  The base
+    implementation decodes the whole response first.
+    '''
+    data = self.decode(rsp)
+    response = data['response']
+    return SolrDocs(response['numFound'], response['start'], response['docs'])
+
+#===============================================================================
+
+class SolrJSONDecoder(SolrResponseDecoder):
+  '''
+  Decodes wt=json responses using the json module (C accelerated where
+  available).
+  '''
+  wt = 'json'
+
+  def decode(self, rsp):
+    return json.loads(rsp.read())
+
+#===============================================================================
+
+class SolrJSONDocStream(SolrDocs):
+  '''
+  Incrementally decodes the docs array of a wt=json search response.
+
+  numFound and start are read from the response prefix, then documents are
+  decoded one at a time as the body arrives so at most one chunk of the body
+  plus the current document are held in memory.  Anything following the docs
+  array (e.g. facet_counts) is read and discarded so the connection can be
+  reused.
+  '''
+  _docsmarker = re.compile(r'"docs"\s*:\s*\[')
+  _numfound = re.compile(r'"numFound":\s*(\d+)')
+  _start = re.compile(r'"start":\s*(\d+)')
+  _whitespace = ' \t\r\n,'
+
+  def __init__(self, rsp, chunksize=65536):
+    SolrDocs.__init__(self)
+    self._rsp = rsp
+    self._chunksize = chunksize
+    self._decoder = json.JSONDecoder()
+    self._eof = False
+    self._buf = ''
+    self._pos = 0
+    while True:
+      docs = self._docsmarker.search(self._buf)
+      if docs is not None:
+        break
+      if not self._fill():
+        raise SolrException(200, 'No docs in SOLR response', self._buf)
+    header = self._buf[:docs.start()]
+    match = self._numfound.search(header)
+    if match is not None:
+      self.numFound = int(match.group(1))
+    match = self._start.search(header)
+    if match is not None:
+      self.start = int(match.group(1))
+    self._pos = docs.end()
+
+
+  def _fill(self):
+    if self._eof:
+      return False
+    chunk = self._rsp.read(self._chunksize)
+    if not chunk:
+      self._eof = True
+      return False
+    self._buf = self._buf[self._pos:] + chunk
+    self._pos = 0
+    return True
+
+
+  def __iter__(self):
+    while True:
+      buf = self._buf
+      pos = self._pos
+      while pos < len(buf) and buf[pos] in self._whitespace:
+        pos += 1
+      self._pos = pos
+      if pos >= len(buf):
+        if not self._fill():
+          raise SolrException(200, 'Truncated SOLR response')
+        continue
+      if buf[pos] == ']':
+        self._pos = pos + 1
+        self.close()
+        return
+      try:
+        doc, end = self._decoder.raw_decode(buf, pos)
+      except ValueError:
+        #the document is incomplete, read more of the body
+        if not self._fill():
+          raise
+        continue
+      self._pos = end
+      yield doc
+
+
+  def close(self):
+    '''
+    Drain the remainder of the response so the connection returns to the pool.
+    '''
+    while self._fill():
+      self._pos = len(self._buf)
+    self._buf = ''
+    self._pos = 0
+
+#===============================================================================
+
+class SolrStreamingJSONDecoder(SolrJSONDecoder):
+  '''
+  A wt=json decoder whose decodeDocs() yields documents as they are read
+  instead of materializing the full response body.
+  '''
+
+  def __init__(self, chunksize=65536):
+    self.chunksize = chunksize
+
+
+  def decodeDocs(self, rsp):
+    return SolrJSONDocStream(rsp, self.chunksize)
+
+#===============================================================================
+
+class SolrPooledResponse(object):
+  '''
+  Wraps an httplib.HTTPResponse so that the connection it was read from is
+  returned to the pool once the body has been consumed (or the response is
+  closed).  All other attributes are delegated to the wrapped response.
+  '''
+
+  def __init__(self, pool, conn, response, reuse=True):
+    self._pool = pool
+    self._conn = conn
+    self._response = response
+    self._reuse = reuse
+
+
+  def __getattr__(self, name):
+    return getattr(self._response, name)
+
+
+  def read(self, amt=None):
+    try:
+      data = self._response.read(amt)
+    except:
+      self.release(reuse=False)
+      raise
+    if self._response.isclosed():
+      self.release()
+    return data
+
+
+  def release(self, reuse=None):
+    '''
+    Return the connection to the pool.  A connection whose response has not
+    been fully read can not be reused and is discarded instead.
+    '''
+    if self._conn is None:
+      return
+    if reuse is None:
+      reuse = self._reuse
+    if not self._response.isclosed():
+      reuse = False
+    conn = self._conn
+    self._conn = None
+    self._pool.checkin(conn, reuse=reuse)
+
+
+  def close(self):
+    self.release()
+    self._response.close()
+
+
+  def __del__(self):
+    try:
+      self.release(reuse=False)
+    except:
+      pass
+
+#===============================================================================
+
+class SolrConnectionPool(object):
+  '''
+  A bounded, thread safe pool of keep-alive HTTP connections to a single
+  SOLR host.
+
+  Connections are created lazily up to maxsize.  Idle connections are reused
+  most recently used first, connections idle for longer than maxidle seconds
+  are evicted, and a cheap health check discards connections the server has
+  already closed before they are handed out.
+  '''
+
+  def __init__(self, host, maxsize=10, maxidle=60.0, timeout=None,
+               waittimeout=30.0):
+    '''
+    Initialize.
+
+    @param host(string) host[:port] of the SOLR server
+    @param maxsize(int) Maximum number of open connections
+    @param maxidle(float) Seconds after which an idle connection is closed
+    @param timeout(float) Socket timeout for each connection, None for default
+    @param waittimeout(float) Seconds to wait for a free connection before
+      raising SolrException, None to wait forever
+    '''
+    self.logger = logging.getLogger('solrclient.SolrConnectionPool')
+    self.host = host
+    self.maxsize = maxsize
+    self.maxidle = maxidle
+    self.timeout = timeout
+    self.waittimeout = waittimeout
+    self.created = 0
+    self.evicted = 0
+    self._nopen = 0
+    self._idle = []
+    self._cond = threading.Condition(threading.Lock())
+
+
+  def __str__(self):
+    return u'SolrConnectionPool{host=%s, maxsize=%d, open=%d, idle=%d}' % \
+        (self.host, self.maxsize, self._nopen, len(self._idle))
+
+
+  def _newConnection(self):
+    if self.timeout is None:
+      return httplib.HTTPConnection(self.host)
+    return httplib.HTTPConnection(self.host, timeout=self.timeout)
+
+
+  def _isHealthy(self, conn):
+    '''
+    An idle keep-alive socket should have nothing to read.  If it is readable
+    the server has closed it (EOF) or it is out of sync, either way it can
+    not be used for another request.
+    '''
+    if conn.sock is None:
+      return True
+    try:
+      readable = select.select([conn.sock], [], [], 0)[0]
+    except (select.error, socket.error, ValueError):
+      return False
+    return len(readable) == 0
+
+
+  def _discard(self, conn):
+    self._nopen -= 1
+    try:
+      conn.close()
+    except:
+      pass
+
+
+  def _evictIdle(self, now):
+    #caller must hold the lock.  _idle is ordered oldest first.
+    while len(self._idle) > 0 and now - self._idle[0][1] > self.maxidle:
+      conn = self._idle.pop(0)[0]
+      self.evicted += 1
+      self._discard(conn)
+
+
+  def checkout(self):
+    '''
+    Returns an HTTPConnection for exclusive use by the caller, who must hand
+    it back with checkin().
+    '''
+    self._cond.acquire()
+    try:
+      deadline = None
+      if self.waittimeout is not None:
+        deadline = time.time() + self.waittimeout
+      while True:
+        self._evictIdle(time.time())
+        while len(self._idle) > 0:
+          conn = self._idle.pop()[0]
+          if self._isHealthy(conn):
+            return conn
+          self.evicted += 1
+          self._discard(conn)
+        if self._nopen < self.maxsize:
+          self._nopen += 1
+          self.created += 1
+          return self._newConnection()
+        if deadline is None:
+          self._cond.wait()
+        else:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            raise SolrException(503, 'No SOLR connection available from pool')
+          self._cond.wait(remaining)
+    finally:
+      self._cond.release()
+
+
+  def checkin(self, conn, reuse=True):
+    '''
+    Return a connection to the pool.  If reuse is False the connection is
+    closed rather than being kept for another request.
+    '''
+    self._cond.acquire()
+    try:
+      if reuse:
+        self._idle.append((conn, time.time()))
+      else:
+        self._discard(conn)
+      self._cond.notify()
+    finally:
+      self._cond.release()
+
+
+  def close(self):
+    '''
+    Close all idle connections.  Connections currently checked out are closed
+    when they are returned.
+    '''
+    self._cond.acquire()
+    try:
+      while len(self._idle) > 0:
+        self._discard(self._idle.pop()[0])
+      self._cond.notifyAll()
+    finally:
+      self._cond.release()
+
+#===============================================================================
+
 class SolrConnection:
   '''
   Provides a connection to the SOLR index.
   '''
   
   def __init__(self, host='localhost:8080', solrBase='/solr', 
-               persistent=True, postHeaders={}):
+               persistent=True, postHeaders={}, maxconnections=10,
+               maxidle=60.0, timeout=None, decoder=None):
     self.logger = logging.getLogger('solrclient.SolrConnection')
     ## Describes type conversion for fields.
     self.fieldtypes = {'t': 'text',
@@ -96,6 +478,17 @@ class SolrConnection:
                         'gid': 'string',
                         'modified': 'date',
                         'created': 'date',}
+    ## Calendar units for date histogram gaps, with their approximate length
+    self.dateunits = [('YEAR', 365.2425 * 86400),
+                      ('MONTH', 30.436875 * 86400),
+                      ('DAY', 86400),
+                      ('HOUR', 3600),
+                      ('MINUTE', 60),
+                      ('SECOND', 1)]
+    ## Prefix of the dynamic solr.RandomSortField used for random sampling
+    self.randomfield = 'random_'
+    ## Statistics reported by fieldStats
+    self.statskeys = ['min', 'max', 'count', 'missing', 'sum', 'mean', 'stddev']
     self.host = host
     self.solrBase = solrBase
     self.persistent = persistent
@@ -103,11 +496,17 @@ class SolrConnection:
     self.encoder = codecs.getencoder('utf-8')
     #responses from Solr will always be in UTF-8
     self.decoder = codecs.getdecoder('utf-8')  
-    #a real connection to the server is not opened at this point.
-    self.conn = httplib.HTTPConnection(self.host)
+    #connections to the server are opened on demand by the pool.
+    self.pool = SolrConnectionPool(self.host, maxsize=maxconnections,
+                                   maxidle=maxidle, timeout=timeout)
+    #decodes responses from read handlers, see SolrResponseDecoder
+    if decoder is None:
+      decoder = SolrStreamingJSONDecoder()
+    self.responsedecoder = decoder
     ##Cache fields
     self._fields = None
-    #self.conn.set_debuglevel(1000000)
+    ##Whether the schema has the random sort field, None until checked
+    self._randomsort = None
     self.xmlheaders = {'Content-Type': 'text/xml; charset=utf-8'}
     self.xmlheaders.update(postHeaders)
     if not self.persistent: self.xmlheaders['Connection']='close'
@@ -116,14 +515,14 @@ class SolrConnection:
 
 
   def __str__(self):
-    return u'SolrConnection{host=%s, solrBase=%s, persistent=%s, postHeaders=%s, reconnects=%s}' % \
-        (self.host, self.solrBase, self.persistent, self.xmlheaders, self.reconnects)
+    return u'SolrConnection{host=%s, solrBase=%s, persistent=%s, postHeaders=%s, reconnects=%s, pool=%s}' % \
+        (self.host, self.solrBase, self.persistent, self.xmlheaders, self.reconnects, self.pool)
 
 
-  def __reconnect(self):
+  def __reconnect(self, conn):
     self.reconnects+=1
-    self.conn.close()
-    self.conn.connect()
+    conn.close()
+    conn.connect()
 
 
   def __errcheck(self,rsp):
@@ -138,33 +537,39 @@ class SolrConnection:
 
   def close(self):
     try:
-      self.conn.close()
+      self.pool.close()
     except:
       pass
 
   def doPost(self,url,body,headers):
+    '''
+    POST a request using a connection checked out from the pool.  The
+    connection is checked back in once the returned response has been read.
+    '''
+    conn = self.pool.checkout()
     try:
-      self.conn.request('POST', url, body, headers)
-    except (socket.error,httplib.CannotSendRequest) :
-      #Reconnect in case the connection was broken from the server going down,
-      #the server timing out our persistent connection, or another
-      #network failure. Also catch httplib.CannotSendRequest because the
-      #HTTPConnection object can get in a bad state.
-      self.logger.info('SOLR connection socket error, trying to resend')
-      self.__reconnect()
-      self.conn.request('POST', url, body, headers)
-    finally:
-      if not self.persistent:
-        self.conn.close()
-    res = None
-    try:
-      res = self.__errcheck(self.conn.getresponse())
-    except httplib.BadStatusLine:
-      self.logger.exception('Received bad response from SOLR connection.  Retrying.')
-      self.__reconnect()
-      self.conn.request('POST', url, body, headers)
-      res = self.__errcheck(self.conn.getresponse())
-    return res
+      try:
+        conn.request('POST', url, body, headers)
+      except (socket.error,httplib.CannotSendRequest) :
+        #Reconnect in case the connection was broken from the server going down,
+        #the server timing out our persistent connection, or another
+        #network failure. Also catch httplib.CannotSendRequest because the
+        #HTTPConnection object can get in a bad state.
+        self.logger.info('SOLR connection socket error, trying to resend')
+        self.__reconnect(conn)
+        conn.request('POST', url, body, headers)
+      try:
+        res = conn.getresponse()
+      except httplib.BadStatusLine:
+        self.logger.exception('Received bad response from SOLR connection.  Retrying.')
+        self.__reconnect(conn)
+        conn.request('POST', url, body, headers)
+        res = conn.getresponse()
+    except:
+      self.pool.checkin(conn, reuse=False)
+      raise
+    res = SolrPooledResponse(self.pool, conn, res, reuse=self.persistent)
+    return self.__errcheck(res)
 
 
   def doUpdateXML(self, request):
@@ -363,12 +768,112 @@ class SolrConnection:
     return self.doUpdateXML(xstr)
 
 
+  def _encodeParams(self, params):
+    #urlencode can not handle unicode values, send them as utf-8
+    encoded = {}
+    for k, v in params.items():
+      if isinstance(v, (list, tuple)):
+        v = [isinstance(vi, unicode) and self.encoder(vi)[0] or vi for vi in v]
+      elif isinstance(v, unicode):
+        v = self.encoder(v)[0]
+      encoded[k] = v
+    encoded['wt'] = self.responsedecoder.wt
+    return encoded
+
+
+  def doQuery(self, params, path='/select'):
+    '''
+    POST params to a SOLR read handler and return the raw response.  List
+    values are sent as repeated parameters.  The response writer (wt) is set
+    by the decoder.
+    '''
+    request = urllib.urlencode(self._encodeParams(params), doseq=True)
+    return self.doPost(self.solrBase+path, request, self.formheaders)
+
+
   def search(self, params):
-    params['wt'] = 'python'
-    request=urllib.urlencode(params, doseq=True)
-    rsp = self.doPost(self.solrBase+'/select', request, self.formheaders)
-    data = eval( rsp.read() )
-    return data
+    '''
+    Perform a search and return the complete decoded response.
+    '''
+    rsp = self.doQuery(params)
+    return self.responsedecoder.decode(rsp)
+
+
+  def searchDocs(self, params):
+    '''
+    Perform a search and return a SolrDocs with numFound, start and the 
+    documents.  With a streaming decoder the documents are decoded as they 
+    are iterated, so the response should be consumed (or closed) promptly
+    to release the connection.
+    '''
+    rsp = self.doQuery(params)
+    return self.responsedecoder.decodeDocs(rsp)
+
+
+  def cursorSort(self, sort=None, uniquekey='id'):
+    '''
+    Returns a sort specification usable with cursorMark paging, which 
+    requires the unique key as the final sort clause.
+    '''
+    if sort is None or sort.strip() == '':
+      return '%s asc' % uniquekey
+    for clause in sort.split(','):
+      if clause.split()[0] == uniquekey:
+        return sort
+    return '%s,%s asc' % (sort, uniquekey)
+
+
+  def randomSort(self, seed=0):
+    '''
+    Returns a sort specification that orders records randomly but 
+    reproducibly for a given seed.  Requires a dynamic field of type 
+    solr.RandomSortField in the schema, named by randomfield, e.g.
+    <fieldType name="random" class="solr.RandomSortField" indexed="true" />
+    <dynamicField name="random_*" type="random" />
+    '''
+    return '%s%d asc' % (self.randomfield, int(seed))
+
+
+  def hasRandomSort(self):
+    '''
+    Returns True if the schema has the dynamic field named by randomfield
+    that randomSort needs.  The schema is read from luke when the field
+    listing is retrieved (see getFields) and remembered until it is 
+    retrieved again.
+    '''
+    if self._randomsort is None:
+      params = {'show': 'schema'}
+      rsp = self.doQuery(params, path='/admin/luke')
+      data = self.responsedecoder.decode(rsp)
+      dynamic = data.get('schema', {}).get('dynamicFields', {})
+      self._randomsort = dynamic.has_key('%s*' % self.randomfield)
+    return self._randomsort
+
+
+  def sample(self, n, seed=0, q='*:*', fq=None, fields='*'):
+    '''
+    Returns a uniform random sample of n records matching the query as a 
+    search response.  The sample is drawn by SOLR with a seeded random sort
+    in a single request, so it costs about the same as fetching n rows and
+    the same seed returns the same sample while the index is unchanged.
+
+    Raises SolrException with httpcode 400 if the schema lacks the random
+    sort field (see randomSort).
+    '''
+    if not self.hasRandomSort():
+      raise SolrException(400, reason='Random samples need a dynamic field '
+                          '"%s*" of type solr.RandomSortField in the SOLR '
+                          'schema, i.e. <fieldType name="random" '
+                          'class="solr.RandomSortField" indexed="true" /> and '
+                          '<dynamicField name="%s*" type="random" />'
+                          % (self.randomfield, self.randomfield))
+    params = {'q':q,
+              'fl':fields,
+              'rows':str(n),
+              'sort':self.randomSort(seed)}
+    if not fq is None:
+      params['fq'] = fq
+    return self.search(params)
 
 
   def count(self, q='*:*', fq=None):
@@ -396,26 +901,22 @@ class SolrConnection:
     params = {'q':query,
               'start': str(start),
               'rows': str(rows), 
-              'wt': 'python', }
+              'fl': 'id', }
     if not fq is None:
       params['fq'] = fq
-    request = urllib.urlencode(params, doseq=True)
-    data = None
     response = {'matches':0,
                 'start':start,
                 'failed': True,
                 'ids': [],}
     try:
-      rsp = self.doPost(self.solrBase+'/select', request, self.formheaders)
-      data = eval( rsp.read() )
+      docs = self.searchDocs(params)
+      for doc in docs:
+        response['ids'].append(doc['id'][0])
+      response['matches'] = docs.numFound
     except:
-      pass
-    if data is None:
+      self.logger.exception('getIds failed')
       return response
     response['failed'] = False
-    response['matches'] = data['response']['numFound']
-    for doc in data['response']['docs']:
-      response['ids'].append(doc['id'][0])
     return response
   
   
@@ -423,21 +924,73 @@ class SolrConnection:
     '''
     Retrieves the specified document.
     '''
-    params = {'q': 'id:%s' % str(id),
-              'wt': 'python'}
-    request = urllib.urlencode(params, doseq=True)
+    params = {'q': 'id:%s' % str(id)}
     data = None
     try:
-      rsp = self.doPost(self.solrBase+'/select', request, self.formheaders)
-      data = eval( rsp.read() )
+      data = self.search(params)
     except:
-      pass
+      self.logger.exception('get failed')
+      return None
     if data['response']['numFound'] > 0:
       return data['response']['docs'][0]
     return None
+
+
+  def getDocs(self, ids, fields='*', uniquekey='id', batchsize=200):
+    '''
+    Retrieves the documents with the given identifiers, batchsize to a
+    request with the requests made concurrently.
+
+    @param ids(list) Values of the unique key of the documents
+    @param fields(string) Comma delimited list of fields to return, the
+      unique key is added if not present
+    @param uniquekey(string) Name of the unique key field
+    @param batchsize(int) Number of documents retrieved per request
+    @return list of the documents found, in the order of ids
+    '''
+    names = [name.strip() for name in fields.split(',')]
+    if '*' not in names and uniquekey not in names:
+      fields = ','.join(names + [uniquekey])
+    batches = [ids[i:i + batchsize] for i in xrange(0, len(ids), batchsize)]
+
+    def _batch(batch):
+      q = ' OR '.join(['%s:"%s"' % (uniquekey, self.escapeQueryTerm(unicode(v)))
+                       for v in batch])
+      params = {'q': q, 'fl': fields, 'rows': len(batch)}
+      return self.search(params)['response']['docs']
+
+    found = {}
+    for docs in self.parallelMap(_batch, batches):
+      for doc in docs:
+        key = doc.get(uniquekey)
+        if isinstance(key, list):
+          key = key[0]
+        found[key] = doc
+    return [found[v] for v in ids if found.has_key(v)]
+
     
-    
-  def getFields(self, numTerms=1):
+  def getIndexInfo(self):
+    '''
+    Returns the index information reported by luke (numDocs, version, 
+    lastModified, ...) without the per field listing, which makes it cheap
+    enough to use for detecting changes to the index.
+    '''
+    params = {'show': 'index',
+              'numTerms': '0'}
+    rsp = self.doQuery(params, path='/admin/luke')
+    data = self.responsedecoder.decode(rsp)
+    return data['index']
+
+
+  def setFields(self, fields):
+    '''
+    Replace the cached field listing, e.g. with one retrieved from a shared 
+    cache.  See getFields.
+    '''
+    self._fields = fields
+
+
+  def getFields(self, numTerms=1, refresh=False):
     '''Retrieve a list of fields.  The response looks something like:
 {
  'responseHeader':{
@@ -474,14 +1027,13 @@ class SolrConnection:
       'histogram':['2',34,'4',34,'8',16,'16',13,'32',6,'64',3,'128',1,
        '256',2,'512',2]},
     '''
-    if not self._fields is None:
+    if not self._fields is None and not refresh:
       return self._fields
-    params = {'numTerms': str(numTerms),
-              'wt': 'python'}
-    request = urllib.urlencode(params, doseq=True)
-    rsp = self.doPost(self.solrBase+'/admin/luke', request, self.formheaders)
-    data = eval( rsp.read() )
+    params = {'numTerms': str(numTerms)}
+    rsp = self.doQuery(params, path='/admin/luke')
+    data = self.responsedecoder.decode(rsp)
     self._fields = data
+    self._randomsort = None
     return data
   
   
@@ -503,24 +1055,100 @@ class SolrConnection:
               'facet.field':name,
               'facet.limit':str(maxvalues),
               'facet.zeros':'false',
-              'wt':'python',
               'facet.sort':str(sort).lower()}
     if not fq is None:
       params['fq'] = fq
-    request = urllib.urlencode(params, doseq=True)
-    rsp = self.doPost(self.solrBase+'/select', request, self.formheaders)
-    data = eval( rsp.read() )
+    data = self.search(params)
     response = data['facet_counts']['facet_fields']
     response['numFound'] = data['response']['numFound']
     return response
     return data['facet_counts']['facet_fields']#, data['response']['numFound']
   
   
+  def fieldStats(self, names, q='*:*', fq=None):
+    '''
+    Returns summary statistics for one or more numeric fields using a single
+    request to the SOLR StatsComponent.
+    http://localhost:8080/solr/select/?q=*:*&rows=0&stats=true&stats.field=lat&stats.field=lng
+    
+    @param names(list) Names of the fields, or a single field name
+    @param q(string) Query identifying the records to summarize
+    @param fq(string) Filter restricting range of query
+    
+    @return dict of {name: {'min', 'max', 'count', 'missing', 'sum', 'mean',
+      'stddev'}, }.  Values are None for a field with no values in the 
+      result set.  min and max are int for integer fields.
+    '''
+    if isinstance(names, basestring):
+      names = [names, ]
+    params = {'q':q,
+              'rows':'0',
+              'stats':'true',
+              'stats.field':list(names)}
+    if not fq is None:
+      params['fq'] = fq
+    data = self.search(params)
+    fields = data['stats']['stats_fields']
+    res = {}
+    for name in names:
+      stats = dict.fromkeys(self.statskeys)
+      if fields.get(name) is not None:
+        for k in self.statskeys:
+          stats[k] = fields[name].get(k)
+        if self.getftype(name) == int:
+          for k in ['min', 'max']:
+            if stats[k] is not None:
+              stats[k] = int(stats[k])
+      res[name] = stats
+    return res
+
+
+  def fieldsMinMax(self, names, q='*:*', fq=None):
+    '''
+    Returns the minimum and maximum values of several fields.  All of the 
+    numeric fields are resolved with a single StatsComponent request, other
+    fields fall back to sorted searches.
+    
+    @param names(list) Names of the fields
+    @param q(string) Query identifying range of records for min and max values
+    @param fq(string) Filter restricting range of query
+    
+    @return dict of {name: [min, max], }
+    '''
+    res = {}
+    numeric = [name for name in names if self.getftype(name) in (int, float)]
+    if len(numeric) > 0:
+      try:
+        stats = self.fieldStats(numeric, q=q, fq=fq)
+        for name in numeric:
+          res[name] = [stats[name]['min'], stats[name]['max']]
+      except Exception,e:
+        self.logger.debug('Exception in fieldStats: %s' % str(e))
+    for name in names:
+      if not name in res:
+        res[name] = self.fieldMinMaxSorted(name, q=q, fq=fq)
+    return res
+
+
   def fieldMinMax(self, name, q='*:*', fq=None):
+    '''
+    Returns the minimum and maximum values of the specified field.  Numeric 
+    fields are resolved with a single StatsComponent request, see fieldStats.
+    
+    @param name(string) Name of the field
+    @param q(string) Query identifying range of records for min and max values
+    @param fq(string) Filter restricting range of query
+    
+    @return list of [min, max]
+    '''
+    return self.fieldsMinMax([name, ], q=q, fq=fq)[name]
+
+
+  def fieldMinMaxSorted(self, name, q='*:*', fq=None):
     '''
     Returns the minimum and maximum values of the specified field.
     This requires two search calls to the service, each requesting a single
-    value of a single field.
+    value of a single field.  Works for any sortable field type.
     
     @param name(string) Name of the field
     @param q(string) Query identifying range of records for min and max values
@@ -529,29 +1157,27 @@ class SolrConnection:
     @return list of [min, max]
     '''
     minmax = [None, None]
-    oldpersist = self.persistent
-    self.persistent = True
     params = {'q':q,
               'rows':1,
               'fl': name,
               'sort':'%s asc' % name,
-              'wt': 'python',
               }
     if not fq is None:
       params['fq'] = fq
+    def _value(data):
+      v = data['response']['docs'][0][name]
+      if isinstance(v, list):
+        return v[0]
+      return v
     try:
       data = self.search(params)
-      minmax[0] = data['response']['docs'][0][name][0]
+      minmax[0] = _value(data)
       params['sort'] = '%s desc' % name
       data = self.search(params)
-      minmax[1] = data['response']['docs'][0][name][0]      
+      minmax[1] = _value(data)
     except Exception,e:
       self.logger.debug('Exception in MinMax: %s' % str(e))
       pass
-    finally:
-      self.persistent = oldpersist
-      if not self.persistent:
-        self.conn.close()
     return minmax
 
   
@@ -570,15 +1196,109 @@ class SolrConnection:
       return unicode
     if fld['type'] in ['string', 'text', 'stext', 'text_ws']:
       return unicode
-    if fld['type'] in ['sint','integer','long','slong']:
+    if fld['type'] in ['sint','integer','long','slong','int','tint','tlong']:
       return int
-    if fld['type'] in ['sdouble','double','sfloat','float']:
+    if fld['type'] in ['sdouble','double','sfloat','float','tdouble','tfloat']:
       return float
     if fld['type'] in ['boolean']:
       return bool
     return fld['type']
 
 
+  def parallelMap(self, func, items, nthreads=None):
+    '''
+    Calls func(item) for each item using up to nthreads worker threads 
+    (default is the connection pool size) and returns the results in the
+    order of items.  The first exception raised by func is re-raised.
+    '''
+    items = list(items)
+    if nthreads is None:
+      nthreads = self.pool.maxsize
+    nthreads = min(nthreads, len(items))
+    if nthreads <= 1:
+      return [func(item) for item in items]
+    results = [None] * len(items)
+    errors = []
+    todo = Queue.Queue()
+    for i in xrange(0, len(items)):
+      todo.put(i)
+    def worker():
+      while len(errors) == 0:
+        try:
+          i = todo.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          results[i] = func(items[i])
+        except Exception,e:
+          errors.append(e)
+    workers = [threading.Thread(target=worker) for i in xrange(0, nthreads)]
+    for t in workers:
+      t.start()
+    for t in workers:
+      t.join()
+    if len(errors) > 0:
+      raise errors[0]
+    return results
+
+
+  def fieldTerms(self, name, q='*:*', fq=None, offset=0, limit=1):
+    '''
+    Returns up to limit distinct values of a field, in index (lexical) order
+    starting at offset, restricted to values present in records matching q.
+    
+    @return list of [value, count]
+    '''
+    params = {'q':q,
+              'rows':'0',
+              'facet':'true',
+              'facet.field':name,
+              'facet.limit':str(limit),
+              'facet.offset':str(offset),
+              'facet.mincount':'1',
+              'facet.sort':'false'}
+    if not fq is None:
+      params['fq'] = fq
+    data = self.search(params)
+    values = data['facet_counts']['facet_fields'][name]
+    return [[values[i], values[i+1]] for i in xrange(0, len(values), 2)]
+
+
+  def fieldTermCount(self, name, q='*:*', fq=None):
+    '''
+    Returns the number of distinct values of a field in records matching q
+    without retrieving the values.  For the whole index the count reported 
+    by luke is verified with a single probe, otherwise the count is found
+    by a galloping search over facet.offset probes that each return at most
+    one term, so the cost is O(log(n)) small requests.
+    '''
+    def _hasTerm(offset):
+      return len(self.fieldTerms(name, q=q, fq=fq, offset=offset, limit=1)) > 0
+    
+    if q == '*:*' and fq is None:
+      try:
+        n = int(self.getFields()['fields'][name]['distinct'])
+        if n > 0 and len(self.fieldTerms(name, offset=n-1, limit=2)) == 1:
+          return n
+      except Exception,e:
+        self.logger.debug('Luke distinct count unusable for %s: %s' % (name, str(e)))
+    if not _hasTerm(0):
+      return 0
+    lo = 0
+    hi = 1
+    while _hasTerm(hi):
+      lo = hi
+      hi = hi * 2
+    #there are more than lo terms and at most hi terms
+    while hi - lo > 1:
+      mid = (lo + hi) / 2
+      if _hasTerm(mid):
+        lo = mid
+      else:
+        hi = mid
+    return hi
+
+
   def fieldAlphaHistogram(self, name, q='*:*', fq=None, nbins=10, 
                           includequeries=True):
     '''
@@ -586,193 +1306,256 @@ class SolrConnection:
     Output is:
       [[low, high, count, query],
        ... ]
-    Bin edges is determined by equal division of the fields
+    Bin edges are quantiles of the distinct values in lexical order, so each
+    bin spans about the same number of distinct values.  Only the edge terms
+    are retrieved (see fieldTermCount), so the cost does not grow with the 
+    number of distinct values of the field.
     '''
-    oldpersist = self.persistent
-    self.persistent = True
     bins = []
     qbin = []
-    fvals = []
     try:
-      #get total number of values for the field
-      #TODO: this is a slow mechanism to retrieve the number of distinct values
-      #Need to replace this with something more efficient.
-      ## Can probably replace with a range of alpha chars - need to check on
-      ## case sensitivity
-      fvals = self.fieldValues(name, q, fq, maxvalues=-1)
-      nvalues = len(fvals[name])/2
+      nvalues = self.fieldTermCount(name, q, fq)
       if nvalues < nbins:
         nbins = nvalues
+      if nbins == 0:
+        return bins
       if nvalues == nbins:
         #Use equivalence instead of range queries to retrieve the values
-        for i in xrange(0, nbins):
-          bin = [fvals[name][i*2], fvals[name][i*2], 0]
+        for term, count in self.fieldTerms(name, q, fq, offset=0, limit=nbins):
+          bin = [term, term, 0]
           binq = u'%s:%s' % (name, self.prepareQueryTerm(name, bin[0]))
           qbin.append(binq)
           bins.append(bin)
-      else:  
-        delta = nvalues / nbins
-        if delta == 1:
-          #Use equivalence queries, except the last one which includes the 
-          # remainder of terms
-          for i in xrange(0, nbins-2):
-            bin = [fvals[name][i*2], fvals[name][i*2], 0]
-            binq = u'%s:%s' % (name, self.prepareQueryTerm(name, bin[0]))
-            qbin.append(binq)
-            bins.append(bin)
-          term = fvals[name][(nbins-1)*2]
-          bin = [term, fvals[name][((nvalues-1)*2)], 0]
-          binq = u'%s:[%s TO *]' % (name, self.prepareQueryTerm(name, term))
+      else:
+        #offsets of the first term of each bin
+        delta = float(nvalues) / float(nbins)
+        starts = [int(i * delta) for i in xrange(0, nbins)]
+        #for each bin retrieve the first term and the last term of the 
+        #preceding bin in one probe, plus the very last term.
+        probes = [(0, 1), ] + [(offset-1, 2) for offset in starts[1:]] + \
+                 [(nvalues-1, 1), ]
+        edges = self.parallelMap(lambda p: self.fieldTerms(name, q, fq, 
+                                                           offset=p[0], 
+                                                           limit=p[1]), 
+                                 probes)
+        #the index may have lost terms since they were counted, leaving
+        #probes past the end short or empty; the bins stop before them
+        if len(edges[0]) == 0:
+          return bins
+        lows = [edges[0][0][0], ]
+        highs = []
+        for e in edges[1:-1]:
+          if len(e) < 2:
+            break
+          highs.append(e[0][0])
+          lows.append(e[1][0])
+        if len(edges[-1]) > 0 and len(lows) == nbins:
+          highs.append(edges[-1][0][0])
+        else:
+          highs.append(lows[-1])
+        nbins = len(lows)
+        for i in xrange(0, nbins):
+          bin = [lows[i], highs[i], 0]
+          binq = u''
+          try:
+            #the first and last bins are open ended
+            low, high = u'*', u'*'
+            if i > 0:
+              low = self.prepareQueryTerm(name, bin[0])
+            if i < nbins-1:
+              high = self.prepareQueryTerm(name, bin[1])
+            binq = u'%s:[%s TO %s]' % (name, low, high)
+          except:
+            self.logger.exception('Exception 1 in fieldAlphaHistogram:')
           qbin.append(binq)
           bins.append(bin)
-        else:
-          #Use range for all terms
-          #now need to page through all the values and get those at the edges
-          coffset = 0.0
-          delta = float(nvalues) / float(nbins)
-          for i in xrange(0, nbins):
-            idxl = int(coffset)*2
-            idxu = (int(coffset + delta)*2) - 2
-            bin = [fvals[name][idxl], fvals[name][idxu], 0]
-            #logging.info(str(bin))
-            binq = u''
-            try:
-              if i == 0:
-                binq = u'%s:[* TO %s]' % \
-                   (name, self.prepareQueryTerm(name, bin[1]))
-              elif i == nbins-1:
-                binq = u'%s:[%s TO *]' % \
-                   (name, self.prepareQueryTerm(name, bin[0]))
-              else:
-                binq = u'%s:[%s TO %s]' % \
-                  (name, 
-                   self.prepareQueryTerm(name, bin[0]), 
-                   self.prepareQueryTerm(name, bin[1]))
-            except:
-              self.logger.exception('Exception 1 in fieldAlphaHistogram:')
-            qbin.append(binq)
-            bins.append(bin)
-            coffset = coffset + delta
       #now execute the facet query request
       params = {'q':q,
                 'rows':'0',
                 'facet':'true',
-                'facet.field':name,
-                'facet.limit':'1',
-                'facet.mincount':1,
-                'wt':'python'}
-      request = urllib.urlencode(params, doseq=True)
-      for sq in qbin:
-        try:
-          request = request + '&%s' % urllib.urlencode({'facet.query': self.encoder(sq)[0], })
-        except:
-          self.logger.exception('Exception 2 in fieldAlphaHistogram')
-      rsp = self.doPost(self.solrBase+'/select', request, self.formheaders)
-      data = eval( rsp.read() )
+                'facet.query':qbin}
+      if not fq is None:
+        params['fq'] = fq
+      data = self.search(params)
       for i in xrange(0, len(bins)):
         v = data['facet_counts']['facet_queries'][qbin[i]]
         bins[i][2] = v
         if includequeries:
           bins[i].append(qbin[i])
-    #except Exception,e:
-    #  logging.error('fieldAlphaHistogram: %s' % str(e))
-    finally:
-      self.persistent = oldpersist
-      if not self.persistent:
-        self.conn.close()
+    except Exception,e:
+      self.logger.error('fieldAlphaHistogram: %s' % str(e))
+      raise
     return bins
   
   
   def fieldHistogram(self, name, q="*:*", fq=None, nbins=10, minmax=None, 
-                     includequeries=True):
+                     includequeries=True, gap=None):
     '''
     Generates a histogram of values.      
-    Expects the field to be integer or floating point.
+    String fields are handled by fieldAlphaHistogram, integer, floating 
+    point and date fields by fieldRangeHistogram.
     
     @param name(string) Name of the field to compute
     @param q(string) The query identifying the set of records for the histogram
     @param fq(string) Filter query to restrict application of query
     @param nbins(int) Number of bins in resulting histogram
+    @param gap(string) Width of each bin for numeric and date fields, 
+      overrides nbins.  See fieldRangeHistogram.
 
     @return list of [binmin, binmax, n, binquery]
     '''
-    oldpersist = self.persistent
-    self.persistent = True
     ftype = self.getftype(name)
     if ftype == unicode:
       ##handle text histograms over here
       bins = self.fieldAlphaHistogram(name, q=q, fq=fq, nbins=nbins, 
                                       includequeries=includequeries)
-      self.persistent = oldpersist
-      if not self.persistent:
-        self.conn.close()
       return bins
+    return self.fieldRangeHistogram(name, q=q, fq=fq, nbins=nbins, gap=gap,
+                                    minmax=minmax, 
+                                    includequeries=includequeries)
+
+
+  def _dateGap(self, mindate, maxdate, nbins):
+    '''
+    Returns (unit, n) for a calendar gap of n units that divides the span
+    between two dates into about nbins bins.
+    '''
+    perbin = self._totalSeconds(maxdate - mindate) / float(nbins)
+    for unit, seconds in self.dateunits:
+      if perbin >= seconds:
+        return unit, max(1, int(round(perbin / seconds)))
+    return 'SECOND', 1
+
+
+  def _totalSeconds(self, delta):
+    return delta.days * 86400.0 + delta.seconds + delta.microseconds / 1e6
+
+
+  def _parseDate(self, value):
+    return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+  def _floorDate(self, value, unit):
+    '''
+    Rounds a datetime down to the start of the calendar unit, like SOLR's
+    "/UNIT" date math.
+    '''
+    parts = ['YEAR', 'MONTH', 'DAY', 'HOUR', 'MINUTE', 'SECOND']
+    fields = [value.year, value.month, value.day, value.hour, value.minute, 
+              value.second]
+    keep = parts.index(unit) + 1
+    floor = fields[:keep] + [1, 1, 0, 0, 0][keep-1:]
+    return datetime(*floor[:6])
+
+
+  def fieldRangeHistogram(self, name, q="*:*", fq=None, nbins=10, gap=None,
+                          minmax=None, includequeries=True, maxbins=1000):
+    '''
+    Generates a histogram of an integer, floating point or date field using
+    SOLR range faceting (facet.range), so all bins are counted by a single
+    request once the minimum and maximum are known.
+    
+    Integer bins have an integer width and are inclusive of both reported 
+    bounds.  Floating point and date bins include their lower bound only, 
+    except for the last, and their bin queries are half-open to match the 
+    counts, so a value on an edge is counted in one bin.  Date bins are 
+    aligned to calendar units: the gap is SOLR date math such as "+1YEAR" 
+    or "+3MONTHS" and if not given is chosen so that the span is divided 
+    into about nbins bins.
+    
+    @param name(string) Name of the field to compute
+    @param q(string) The query identifying the set of records for the histogram
+    @param fq(string) Filter query to restrict application of query
+    @param nbins(int) Number of bins in resulting histogram, ignored if gap 
+      is provided.
+    @param gap(string) Width of each bin, a number for numeric fields or SOLR 
+      date math for date fields.
+    @param minmax(list) [min, max] of the field if already known
+    @param maxbins(int) Upper limit on the number of bins a gap may produce
+    
+    @return list of [binmin, binmax, n, binquery]
+    '''
+    ftype = self.getftype(name)
     bins = []
-    qbin = []
-    fvals = self.fieldValues(name, q, fq, maxvalues=nbins+1)
-    if len(fvals[name]) < 3:
+    if minmax is None:
+      minmax = self.fieldMinMax(name, q=q, fq=fq)
+    if minmax[0] is None or minmax[1] is None:
       return bins
-    nvalues = len(fvals[name])/2
-    if nvalues < nbins:
-      nbins = nvalues
-    minoffset = 1
-    if ftype == float:
-      minoffset = 0.00001
-    try:
-      if minmax is None:
-        minmax = self.fieldMinMax(name, q=q, fq=fq)
-        #logging.info("MINMAX = %s" % str(minmax))
-        minmax[0] = float(minmax[0])
-        minmax[1] = float(minmax[1])
-      delta = (minmax[1] - minmax[0]) / nbins
-      for i in xrange(0, nbins):
-        binmin = minmax[0] + (i*delta)
-        bin = [binmin, binmin+delta, 0]
+    params = {'q':q,
+              'rows':'0',
+              'facet':'true',
+              'facet.range':name,
+              'facet.range.include':['lower', 'edge']}
+    if not fq is None:
+      params['fq'] = fq
+    if ftype in (int, float):
+      vmin = ftype(minmax[0])
+      vmax = ftype(minmax[1])
+      if ftype == int:
+        if gap is None:
+          gap = int(math.ceil((vmax - vmin + 1) / float(nbins)))
+        gap = max(1, int(gap))
+        end = vmax + 1
+      else:
+        if gap is None:
+          gap = (vmax - vmin) / nbins
+        gap = float(gap)
+        if gap <= 0:
+          gap = 1.0
+        end = vmax
+      if (end - vmin) / gap > maxbins:
+        raise ValueError('gap %s gives more than %d bins' % (str(gap), maxbins))
+      params['facet.range.start'] = repr(vmin)
+      params['facet.range.end'] = repr(end)
+      params['facet.range.gap'] = repr(gap)
+      params['facet.range.hardend'] = str(ftype == float).lower()
+    else:
+      #date field
+      dmin = self._parseDate(minmax[0])
+      dmax = self._parseDate(minmax[1])
+      if gap is None:
+        unit, n = self._dateGap(dmin, dmax, nbins)
+        gap = '+%d%s' % (n, unit)
+      match = re.match(r'^\+?(\d+)(YEAR|MONTH|DAY|HOUR|MINUTE|SECOND)S?$', gap)
+      if match is None:
+        raise ValueError('Unsupported date gap: %s' % gap)
+      n = int(match.group(1))
+      unit = match.group(2)
+      if n < 1:
+        raise ValueError('Unsupported date gap: %s' % gap)
+      seconds = dict(self.dateunits)[unit] * n
+      if self._totalSeconds(dmax - dmin) / seconds > maxbins:
+        raise ValueError('gap %s gives more than %d bins' % (gap, maxbins))
+      params['facet.range.start'] = self._floorDate(dmin, unit).strftime('%Y-%m-%dT%H:%M:%SZ')
+      params['facet.range.end'] = dmax.strftime('%Y-%m-%dT%H:%M:%SZ')
+      params['facet.range.gap'] = '+%d%s' % (n, unit)
+      params['facet.range.hardend'] = 'false'
+    data = self.search(params)
+    ranges = data['facet_counts']['facet_ranges'][name]
+    counts = ranges['counts']
+    lows = [counts[i] for i in xrange(0, len(counts), 2)]
+    highs = lows[1:] + [ranges['end'], ]
+    for i in xrange(0, len(lows)):
+      if ftype in (int, float):
+        low = ftype(lows[i])
+        high = ftype(highs[i])
         if ftype == int:
-          bin[0] = int(bin[0])
-          bin[1] = int(bin[1])
-          if i == 0:
-            binq = '%s:[* TO %d]' % (name, bin[1])
-          elif i == nbins-1:
-            binq = '%s:[%d TO *]' % (name, bin[0]+minoffset)
-            bin[0] = bin[0] + minoffset
-            if bin[1] < bin[0]:
-              bin[1] = bin[0]
-          else:
-            binq = '%s:[%d TO %d]' % (name, bin[0]+minoffset, bin[1])
-            bin[0] = bin[0] + minoffset
+          high = high - 1
+        bin = [low, high, counts[i*2+1]]
+      else:
+        bin = [lows[i], highs[i], counts[i*2+1]]
+      if includequeries:
+        low, high = [isinstance(v, float) and repr(v) or v for v in bin[:2]]
+        #integer bins end at high, the others before it like the counts
+        close = ftype == int and u']' or u'}'
+        if i == 0:
+          binq = u'%s:[* TO %s%s' % (name, high, close)
+        elif i == len(lows)-1:
+          binq = u'%s:[%s TO *]' % (name, low)
         else:
-          if i == 0:
-            binq = '%s:[* TO %f]' % (name, bin[1])
-          elif i == nbins-1:
-            binq = '%s:[%f TO *]' % (name, bin[0]+minoffset)
-          else:
-            binq = '%s:[%f TO %f]' % (name, bin[0]+minoffset, bin[1])
-        qbin.append(binq)
-        bins.append(bin)
-        
-      #now execute the facet query request
-      params = {'q':q,
-                'rows':'0',
-                'facet':'true',
-                'facet.field':name,
-                'facet.limit':'1',
-                'facet.mincount':1,
-                'wt':'python'}
-      request = urllib.urlencode(params, doseq=True)
-      for sq in qbin:
-        request = request + '&%s' % urllib.urlencode({'facet.query': sq, })
-      rsp = self.doPost(self.solrBase+'/select', request, self.formheaders)
-      data = eval( rsp.read() )
-      for i in xrange(0, len(bins)):
-        v = data['facet_counts']['facet_queries'][qbin[i]]
-        bins[i][2] = v
-        if includequeries:
-          bins[i].append(qbin[i])
-    finally:
-      self.persistent = oldpersist
-      if not self.persistent:
-        self.conn.close()
+          binq = u'%s:[%s TO %s%s' % (name, low, high, close)
+        bin.append(binq)
+      bins.append(bin)
     return bins
   
   
@@ -780,20 +1563,26 @@ class SolrConnection:
     '''
     Generates a 2d histogram of values.      
     Expects the field to be integer or floating point.
+
+    The min/max of both fields are retrieved with one StatsComponent request
+    and all ncols * nrows cells are then counted by a single facet request
+    containing one facet.query per cell, so the grid costs two round trips
+    regardless of its size.  Floating point bins include their lower bound
+    only, except for the first and last which are open ended.
     
-    @param name1(string) Name of field1 columns to compute
-    @param name2(string) Name of field2 rows to compute
+    @param colname(string) Name of field for columns to compute
+    @param rowname(string) Name of field for rows to compute
     @param q(string) The query identifying the set of records for the histogram
     @param fq(string) Filter query to restrict application of query
-    @param nbins1(int) Number of columns in resulting histogram
-    @param nbins2(int) Number of rows in resulting histogram
+    @param ncols(int) Number of columns in resulting histogram
+    @param nrows(int) Number of rows in resulting histogram
 
     @return dict of {colname:  name of column index
                      rowname:  name of row index
                      cols: [] list of min values for each column bin
                      rows: [] list of min values for each row bin
                      z: [[], 
-                         []] 
+                         []] counts, z[row][col]
     '''
     def _mkQterm(name, minv, maxv, isint, isfirst, islast):
       q = ''
@@ -803,20 +1592,19 @@ class SolrConnection:
         if isfirst:
           q = '%s:[* TO %d]' % (name, maxv)
         elif islast:
-          q = '%s:[%d TO *]' % (name, maxv)
+          q = '%s:[%d TO *]' % (name, minv + 1)
         else:
-          q = '%s:[%d TO %d]' % (name, minv, maxv)
+          q = '%s:[%d TO %d]' % (name, minv + 1, maxv)
       else:
+        #half-open so a value on an edge is counted in the upper bin only
         if isfirst:
-          q = '%s:[* TO %f]' % (name, maxv)
+          q = '%s:[* TO %r}' % (name, maxv)
         elif islast:
-          q = '%s:[%f TO *]' % (name, maxv)
+          q = '%s:[%r TO *]' % (name, minv)
         else:
-          q = '%s:[%f TO %f]' % (name, minv, maxv)
+          q = '%s:[%r TO %r}' % (name, minv, maxv)
       return q
-    
-    oldpersist = self.persistent
-    self.persistent = True
+
     ftype_col = self.getftype(colname)
     ftype_row = self.getftype(rowname)
     result = {'colname': colname,
@@ -824,64 +1612,138 @@ class SolrConnection:
               'cols':[],
               'rows':[],
               'z': []}
-    minoffsetcol = 1
-    minoffsetrow = 1
-    if ftype_col == float:
-      minoffsetcol = 0.00001
-    if ftype_row == float:
-      minoffsetrow = 0.00001
     try:
-      rowminmax = self.fieldMinMax(rowname, q=q, fq=fq)
+      minmax = self.fieldsMinMax([rowname, colname], q=q, fq=fq)
+      rowminmax = minmax[rowname]
+      if rowminmax[0] is None or minmax[colname][0] is None:
+        return result
       rowminmax[0] = float(rowminmax[0])
       rowminmax[1] = float(rowminmax[1])
-      colminmax = self.fieldMinMax(colname, q=q, fq=fq)
+      colminmax = minmax[colname]
       colminmax[0] = float(colminmax[0])
       colminmax[1] = float(colminmax[1])
       rowdelta = (rowminmax[1] - rowminmax[0]) / nrows
       coldelta = (colminmax[1] - colminmax[0]) / ncols
-      
+
+      #adjacent bins share their edge values
+      coledges = [colminmax[0] + (colidx*coldelta) for colidx in xrange(0, ncols + 1)]
+      rowedges = [rowminmax[0] + (rowidx*rowdelta) for rowidx in xrange(0, nrows + 1)]
+      colqs = []
+      for colidx in xrange(0, ncols):
+        cmin = coledges[colidx]
+        result['cols'].append(cmin)
+        colqs.append(_mkQterm(colname, cmin, coledges[colidx+1], (ftype_col==int),
+                              (colidx==0), (colidx==ncols-1)))
+      cellqs = []
       for rowidx in xrange(0, nrows):
-        rmin = rowminmax[0] + (rowidx*rowdelta)
+        rmin = rowedges[rowidx]
         result['rows'].append(rmin)
-        rmax = rmin + rowdelta
-        rowq = _mkQterm(rowname, rmin, rmax, (ftype_row==int), (rowidx==0), (rowidx==nrows-1))
-        qq = "%s AND %s" % (q, rowq)
-        logging.debug("row=%d, q= %s" % (rowidx, qq))
-        bins = []
-        cline = []
-        for colidx in xrange(0, ncols):
-          cmin = colminmax[0] + (colidx*coldelta)
-          result['cols'].append(cmin)
-          cmax = cmin + coldelta
-          colq = _mkQterm(colname, cmin, cmax, (ftype_col==int), (colidx==0), (colidx==ncols-1))
-          bin = [colidx, rowidx, cmin, rmin, cmax, rmax, 0, colq]
-          bins.append(bin)
-        #now execute the facet query request
-        params = {'q':qq,
-                  'rows':'0',
-                  'facet':'true',
-                  'facet.field':colname,
-                  'facet.limit':'1',
-                  'facet.mincount':1,
-                  'wt':'python'}
-        if not fq is None:
-          params['fq'] = fq
-        request = urllib.urlencode(params, doseq=True)
-        for bin in bins:
-          request = request + '&%s' % urllib.urlencode({'facet.query': bin[7], })
-        rsp = self.doPost(self.solrBase+'/select', request, self.formheaders)
-        data = eval( rsp.read() )
-        for bin in bins:
-          v = data['facet_counts']['facet_queries'][bin[7]]
-          cline.append(v)
-        result['z'].append(cline)
-    finally:
-      self.persistent = oldpersist
-      if not self.persistent:
-        self.conn.close()
+        rowq = _mkQterm(rowname, rmin, rowedges[rowidx+1], (ftype_row==int),
+                        (rowidx==0), (rowidx==nrows-1))
+        cellqs.append(['%s AND %s' % (rowq, colq) for colq in colqs])
+
+      #now execute a single facet query request for all the cells
+      params = {'q':q,
+                'rows':'0',
+                'facet':'true',
+                'facet.query':[cq for row in cellqs for cq in row]}
+      if not fq is None:
+        params['fq'] = fq
+      data = self.search(params)
+      counts = data['facet_counts']['facet_queries']
+      for row in cellqs:
+        result['z'].append([counts[cq] for cq in row])
+    except Exception,e:
+      self.logger.error('fieldHistogram2d: %s' % str(e))
+      raise
     return result
-  
-    
+
+
+  def fieldGrid(self, colname, rowname, bbox, ncols=10, nrows=10, q="*:*", fq=None,
+                maxsize=256, rowedges=None, maxqueries=4096):
+    '''
+    Counts the records in each cell of a regular grid over a bounding box,
+    e.g. the density of records over a map viewport with lng for the columns
+    and lat for the rows.  Expects the fields to be floating point.
+
+    Each cell is counted by a facet.query, as in fieldHistogram2d, and the
+    queries are sent in a single request for grids of up to maxqueries 
+    cells.  Larger grids are split into requests of maxqueries cells that 
+    are sent concurrently, e.g. the 256 x 256 cells of a tile pyramid cost
+    16 requests.  Cells include their lower bounds, the last row and 
+    column also their upper bounds.
+
+    @param colname(string) Name of field for columns, e.g. "lng"
+    @param rowname(string) Name of field for rows, e.g. "lat"
+    @param bbox(list) [colmin, rowmin, colmax, rowmax] of the grid, i.e.
+      [west, south, east, north]
+    @param ncols(int) Number of columns in the grid
+    @param nrows(int) Number of rows in the grid
+    @param q(string) The query identifying the set of records to count
+    @param fq(string) Filter query to restrict application of query
+    @param maxsize(int) Upper limit of ncols and nrows
+    @param rowedges(list) nrows + 1 ascending boundaries of the rows, in 
+      place of equal divisions of the bbox, e.g. for rows of equal height 
+      in a map projection
+    @param maxqueries(int) Number of cells counted by one request
+
+    @return dict of {colname:  name of column field
+                     rowname:  name of row field
+                     bbox: [colmin, rowmin, colmax, rowmax]
+                     cols: [] list of min values for each column
+                     rows: [] list of min values for each row
+                     z: [[], 
+                         []] counts, z[row][col]
+                     numFound: number of records in the grid}
+    '''
+    colmin, rowmin, colmax, rowmax = [float(v) for v in bbox]
+    if colmax <= colmin or rowmax <= rowmin:
+      raise ValueError('Empty bounding box: %s' % str(bbox))
+    if ncols < 1 or nrows < 1 or ncols > maxsize or nrows > maxsize:
+      raise ValueError('Grid size must be between 1 and %d' % maxsize)
+    colgap = (colmax - colmin) / ncols
+    coledges = [colmin + i * colgap for i in xrange(0, ncols)] + [colmax]
+    if rowedges is None:
+      rowgap = (rowmax - rowmin) / nrows
+      rowedges = [rowmin + i * rowgap for i in xrange(0, nrows)] + [rowmax]
+    elif len(rowedges) != nrows + 1:
+      raise ValueError('Expected %d row edges' % (nrows + 1))
+
+    def _range(name, edges, i):
+      if i == len(edges) - 2:
+        return '%s:[%r TO %r]' % (name, edges[i], edges[i + 1])
+      return '%s:[%r TO %r}' % (name, edges[i], edges[i + 1])
+
+    colqs = [_range(colname, coledges, i) for i in xrange(0, ncols)]
+    cellqs = []
+    for rowidx in xrange(0, nrows):
+      rowq = _range(rowname, rowedges, rowidx)
+      cellqs.extend(['%s AND %s' % (rowq, colq) for colq in colqs])
+
+    def _count(queries):
+      params = {'q': q,
+                'rows': '0',
+                'facet': 'true',
+                'facet.query': queries}
+      if not fq is None:
+        params['fq'] = fq
+      data = self.search(params)
+      counts = data['facet_counts']['facet_queries']
+      return [counts[cq] for cq in queries]
+
+    chunks = [cellqs[i:i + maxqueries] for i in xrange(0, len(cellqs), maxqueries)]
+    counts = []
+    for chunk in self.parallelMap(_count, chunks):
+      counts.extend(chunk)
+    z = [counts[i * ncols:(i + 1) * ncols] for i in xrange(0, nrows)]
+    return {'colname': colname,
+            'rowname': rowname,
+            'bbox': [colmin, rowmin, colmax, rowmax],
+            'cols': coledges[:ncols],
+            'rows': list(rowedges[:nrows]),
+            'z': z,
+            'numFound': sum(counts)}
+
 #===============================================================================
 
 class SOLRRecordTransformer(object):
@@ -904,22 +1766,173 @@ class SOLRArrayTransformer(SOLRRecordTransformer):
   A transformer that returns a list of values for the sepcified columns.
   '''
   
-  def __init__(self, cols=['lng', 'lat', ]):
+  def __init__(self, cols=['lng', 'lat', ], keeplists=False):
+    '''
+    @param cols(list) Names of the fields to return, in order
+    @param keeplists(boolean) Return all the values of multivalued fields as a 
+      list.  Otherwise only the first value is returned.  Lists of a single
+      value are always flattened to the value.
+    '''
     self.cols = cols
+    self.keeplists = keeplists
   
   def transform(self, record):
     res = []
     for col in self.cols:
-      try:
-        v = record[col]
-        if isinstance(v, list):
-          res.append(v[0])
-        else:
-          res.append(v)
-      except:
-        res.append(None)
+      v = record.get(col)
+      if isinstance(v, list):
+        if len(v) == 0:
+          v = None
+        elif len(v) == 1 or not self.keeplists:
+          v = v[0]
+      res.append(v)
     return res
-    
+
+  def transformColumns(self, records):
+    '''
+    Transforms a list of records at once, returning a list of the values of 
+    each column.  Equivalent to transposing [transform(r) for r in records],
+    but works a column at a time which is several times faster.
+    '''
+    columns = []
+    for col in self.cols:
+      values = [record.get(col) for record in records]
+      if self.keeplists:
+        values = [(v[0] if len(v) == 1 else (v or None)) if type(v) is list else v
+                  for v in values]
+      else:
+        values = [(v[0] if v else None) if type(v) is list else v for v in values]
+      columns.append(values)
+    return columns
+
+
+def docFields(docs):
+  '''
+  Returns the names of the fields present in docs, in order of first 
+  appearance.
+  '''
+  fields = []
+  seen = {}
+  for doc in docs:
+    for name in doc:
+      if not seen.has_key(name):
+        seen[name] = True
+        fields.append(name)
+  return fields
+
+
+def tabulateDocs(docs, fields=None, bycolumn=False):
+  '''
+  Returns the values of docs as a table without repeating field names, with
+  lists of a single value flattened.
+
+  @param docs(list) Search response documents
+  @param fields(list) Names of the fields in the table, by default those 
+    present in docs
+  @param bycolumn(boolean) Return a list of values per field instead of a list
+    of values per document
+  @return (fields, rows) or (fields, columns)
+  '''
+  if fields is None:
+    fields = docFields(docs)
+  columns = SOLRArrayTransformer(fields, keeplists=True).transformColumns(docs)
+  if bycolumn:
+    return (fields, columns)
+  return (fields, zip(*columns))
+
+
+# typecode of 32 bit integers in arrays
+INT32_TYPECODE = 'i' if array('i').itemsize == 4 else 'l'
+
+# value of missing integers in packed columns
+NULL_INT32 = -2147483648
+
+
+def packColumns(columns, types, header=None):
+  '''
+  Packs columns of numbers into a binary buffer that browsers read with typed
+  arrays (Float32Array, Int32Array) without parsing.  The buffer is:
+
+    uint32 length of the header, little-endian
+    header, JSON, padded with spaces to a multiple of 4 bytes
+    each float32 and int32 column, little-endian, in order
+
+  The header is the given header with "count", the number of values in each 
+  column, "types", the type of each column, "offsets", the byte offset of 
+  each packed column from the end of the header (null for others), 
+  "values", the values of columns of type "json" (null for others), and 
+  "nullInt32".  Missing float32 values are NaN, missing int32 values are 
+  nullInt32.  Columns are converted with array, not value by value.
+
+  @param columns(list) Lists of values of the same length, as from 
+    tabulateDocs(bycolumn=True)
+  @param types(list) Type of each column, "float32", "int32" or "json". An
+    int32 column with values out of range is given as json.
+  @param header(dict) Other values of the header
+  @return string
+  '''
+  count = 0
+  if columns:
+    count = len(columns[0])
+  header = dict(header or {})
+  types = list(types)
+  packed = []
+  offsets = []
+  values = []
+  offset = 0
+  for i in xrange(0, len(columns)):
+    column = columns[i]
+    data = None
+    if types[i] == 'float32':
+      if None in column:
+        column = [float('nan') if v is None else v for v in column]
+      data = array('f', column)
+    elif types[i] == 'int32':
+      if None in column:
+        column = [NULL_INT32 if v is None else v for v in column]
+      try:
+        data = array(INT32_TYPECODE, column)
+      except OverflowError:
+        types[i] = 'json'
+    if data is None:
+      offsets.append(None)
+      values.append(columns[i])
+      continue
+    if sys.byteorder != 'little':
+      data.byteswap()
+    packed.append(data.tostring())
+    offsets.append(offset)
+    values.append(None)
+    offset += len(packed[-1])
+  header.update({'count': count, 'types': types, 'offsets': offsets, 'values': values,
+                 'nullInt32': NULL_INT32})
+  text = json.dumps(header, separators=(',', ':'))
+  if isinstance(text, unicode):
+    text = text.encode('utf-8')
+  text += ' ' * (-len(text) % 4)
+  return struct.pack('<I', len(text)) + text + ''.join(packed)
+
+
+def bboxFilter(bbox, colname='lng', rowname='lat'):
+  '''
+  Returns a filter query restricting records to a bounding box.  Both ranges
+  are in one filter so SOLR caches the box as a single filter.  A box with
+  west greater than east crosses the antimeridian.
+
+  @param bbox(list) [west, south, east, north]
+  @param colname(string) Name of the longitude field
+  @param rowname(string) Name of the latitude field
+  @return string
+  '''
+  west, south, east, north = [float(v) for v in bbox]
+  if south > north:
+    raise ValueError('Bounding box south is greater than north: %s' % str(bbox))
+  lat = '%s:[%r TO %r]' % (rowname, south, north)
+  if west <= east:
+    return '%s:[%r TO %r] AND %s' % (colname, west, east, lat)
+  return '(%s:[%r TO 180.0] OR %s:[-180.0 TO %r]) AND %s' % (colname, west, colname,
+                                                             east, lat)
+
 
 #===============================================================================
 
@@ -930,7 +1943,7 @@ class SOLRSearchResponseIterator(object):
   '''
   
   def __init__(self, client, q, fq=None, fields='*', pagesize=100,
-               transformer=SOLRRecordTransformer()):
+               transformer=SOLRRecordTransformer(), sort=None, cursor=False):
     '''
     Initialize.
     
@@ -939,6 +1952,10 @@ class SOLRSearchResponseIterator(object):
     @param fq(string) A facet query, restricts the set of rows that q is applied to
     @param fields(string) A comma delimited list of field names to return
     @param pagesize(int) Number of rows to retrieve in each call.
+    @param sort(string) SOLR sort specification, e.g. "modified desc"
+    @param cursor(boolean) Page with cursorMark instead of start offsets.  The
+      cost of each page is then constant however deep the iteration goes.  
+      The sort is extended with the unique key as a tie breaker.
     '''
     self.logger = logging.getLogger('solrclient.SOLRSearchResponseIterator')
     self.client = client
@@ -950,25 +1967,48 @@ class SOLRSearchResponseIterator(object):
     self.res = None
     self.done = False
     self.transformer = transformer
-    self._nextPage(self.crecord)
+    self.sort = sort
+    self.cursor = cursor
+    self.cursormark = '*'
     self._numhits = 0
+    self._nextPage(self.crecord)
     self.logger.debug("Iterator hits=%s" % str(self.res['response']['numFound']))
 
     
-  def _nextPage(self, offset):
+  def _fetchPage(self, offset, cursormark):
     '''
-    Retrieves the next set of results from the service.
+    Retrieves the page of results starting at offset (or at cursormark in 
+    cursor mode) without changing the state of the iterator.
     '''
-    self.logger.debug("Iterator crecord=%s" % str(self.crecord))
     params = {'q': self.q,
-              'start':str(offset),
               'rows':str(self.pagesize),
               'fl':self.fields,
               'explainOther':'',
               'hl.fl':''}
     if not self.fq is None:
       params['fq'] = self.fq
-    self.res = self.client.search(params)
+    if self.cursor:
+      params['sort'] = self.client.cursorSort(self.sort)
+      params['cursorMark'] = cursormark
+    else:
+      params['start'] = str(offset)
+      if not self.sort is None:
+        params['sort'] = self.sort
+    res = self.client.search(params)
+    if self.cursor:
+      #cursor responses always report start=0, rebase on the record offset
+      res['response']['start'] = offset
+    return res
+
+
+  def _nextPage(self, offset):
+    '''
+    Retrieves the next set of results from the service.
+    '''
+    self.logger.debug("Iterator crecord=%s" % str(self.crecord))
+    self.res = self._fetchPage(offset, self.cursormark)
+    if self.cursor:
+      self.cursormark = self.res['nextCursorMark']
     self._numhits = int(self.res['response']['numFound'])
 
     
@@ -990,6 +2030,10 @@ class SOLRSearchResponseIterator(object):
     try:
       row = self.res['response']['docs'][idx]
     except IndexError:
+      if self.crecord >= self._numhits:
+        #no need to request a page past the end of the results
+        self.done = True
+        raise StopIteration()
       self._nextPage(self.crecord)
       idx = self.crecord - self.res['response']['start']
       try:
@@ -1002,6 +2046,147 @@ class SOLRSearchResponseIterator(object):
   
 #===============================================================================
 
+class SOLRPageFetch(threading.Thread):
+  '''
+  Fetches one page of results on a background thread.  get() waits for the
+  page and re-raises any exception raised while fetching it.
+  '''
+
+  def __init__(self, fetch, *args):
+    threading.Thread.__init__(self)
+    self.setDaemon(True)
+    self._fetch = fetch
+    self._args = args
+    self.result = None
+    self.error = None
+
+
+  def run(self):
+    try:
+      self.result = self._fetch(*self._args)
+    except Exception,e:
+      self.error = e
+    #release references, e.g. to the previous page of a cursor chain
+    self._fetch = None
+    self._args = None
+
+
+  def get(self):
+    self.join()
+    if self.error is not None:
+      raise self.error
+    return self.result
+
+#===============================================================================
+
+class SOLRPrefetchResponseIterator(SOLRSearchResponseIterator):
+  '''
+  A search response iterator that fetches the following pages on background
+  threads while the current page is being consumed, so network waits 
+  overlap with processing of the records.
+
+  At most lookahead pages are requested ahead of the page being consumed, 
+  which bounds memory to lookahead + 1 pages.  With offset paging the 
+  look-ahead pages are fetched concurrently.  With cursor paging each page
+  needs the cursor of the previous one, so the look-ahead pages are fetched
+  one after another but still ahead of the consumer.
+  '''
+
+  def __init__(self, client, q, fq=None, fields='*', pagesize=100,
+               transformer=SOLRRecordTransformer(), sort=None, cursor=False,
+               lookahead=2):
+    '''
+    Initialize.
+
+    @param lookahead(int) Number of pages to fetch ahead of the consumer.
+    
+    See SOLRSearchResponseIterator for the other parameters.
+    '''
+    self.lookahead = max(1, lookahead)
+    self._pending = []
+    self._scheduled = 0
+    self._lastfetch = None
+    SOLRSearchResponseIterator.__init__(self, client, q, fq=fq, fields=fields,
+                                        pagesize=pagesize, 
+                                        transformer=transformer, sort=sort,
+                                        cursor=cursor)
+    self.logger = logging.getLogger('solrclient.SOLRPrefetchResponseIterator')
+
+
+  def _emptyPage(self, offset):
+    return {'response': {'numFound': self._numhits,
+                         'start': offset,
+                         'docs': []},
+            'nextCursorMark': self.cursormark}
+
+
+  def _fetchCursorPage(self, offset, previous):
+    '''
+    Fetch the page at offset using the cursor returned for the previous page.
+    '''
+    cursormark = '*'
+    if previous is not None:
+      prev = previous.get()
+      if len(prev['response']['docs']) < self.pagesize:
+        return self._emptyPage(offset)
+      if prev['nextCursorMark'] == prev.get('cursorMark'):
+        return self._emptyPage(offset)
+      cursormark = prev['nextCursorMark']
+    res = self._fetchPage(offset, cursormark)
+    res['cursorMark'] = cursormark
+    return res
+
+
+  def _schedule(self):
+    '''
+    Start fetches until lookahead pages are pending or the end of the result
+    set is reached.  Until the first page arrives the size of the result set
+    is unknown, so only one page is requested.
+    '''
+    limit = self.lookahead
+    if self.res is None:
+      limit = 1
+    while len(self._pending) < limit:
+      offset = self._scheduled
+      if self.res is not None and offset >= self._numhits:
+        return
+      if self.cursor:
+        fetch = SOLRPageFetch(self._fetchCursorPage, offset, self._lastfetch)
+      else:
+        fetch = SOLRPageFetch(self._fetchPage, offset, None)
+      fetch.start()
+      self._pending.append(fetch)
+      self._lastfetch = fetch
+      self._scheduled = offset + self.pagesize
+
+
+  def _nextPage(self, offset):
+    '''
+    Takes the next page from the prefetched pages and schedules more fetches.
+    '''
+    self.logger.debug("Iterator crecord=%s" % str(self.crecord))
+    self._schedule()
+    if len(self._pending) == 0:
+      self.res = self._emptyPage(offset)
+      return
+    self.res = self._pending.pop(0).get()
+    self._numhits = int(self.res['response']['numFound'])
+    if self.cursor:
+      self.cursormark = self.res['nextCursorMark']
+    self._schedule()
+
+
+  def close(self):
+    '''
+    Stop scheduling further pages.  Fetches already in flight complete in the
+    background and are discarded.
+    '''
+    self.done = True
+    self._pending = []
+    self._lastfetch = None
+
+#===============================================================================
+
 class SOLRArrayResponseIterator(SOLRSearchResponseIterator):
   '''
   Returns an interator that operates on a SOLR result set.  The output for each
@@ -1010,11 +2195,12 @@ class SOLRArrayResponseIterator(SOLRSearchResponseIterator):
   '''
   
   def __init__(self, client, q, fq=None, pagesize=100, 
-               cols=['lng', 'lat', ]):
+               cols=['lng', 'lat', ], sort=None, cursor=False):
     transformer = SOLRArrayTransformer(cols)
     fields = ",".join(cols)
     SOLRSearchResponseIterator.__init__(self, client, q, fq, fields, pagesize, 
-                                        transformer=transformer)
+                                        transformer=transformer, sort=sort,
+                                        cursor=cursor)
     self.logger = logging.getLogger('solrclient.SOLRArrayResponseIterator')
 
 
@@ -1024,20 +2210,20 @@ class SOLRSubsampleResponseIterator(SOLRSearchResponseIterator):
   '''Returns a pseudo-random subsample of the result set.  Works by calculating
   the number of pages required for the entire data set and taking a random sample
   of pages until nsamples can be retrieved.  So pages are random, but records
-  within a page are not.
+  within a page are not.  See SOLRRandomSampleIterator for a sample of 
+  independently chosen records.
   '''
   
   def __init__(self, client, q, fq=None, fields='*', pagesize=100,
-               nsamples=10000, transformer=SOLRRecordTransformer()):
+               nsamples=10000, transformer=SOLRRecordTransformer(), seed=None):
     self._pagestarts = [0, ]
     self._cpage = 0
     SOLRSearchResponseIterator.__init__(self, client, q, fq, fields, pagesize, transformer)
     npages = self._numhits / self.pagesize
-    if npages > 0:
-      samplesize = nsamples / pagesize
-      if samplesize > npages:
-        samplesize = npages
-      self._pagestarts += random.sample( xrange(0,npages), samplesize )
+    if npages > 1:
+      samplesize = max(0, min(nsamples / pagesize - 1, npages - 1))
+      #page indexes, the first page has already been retrieved
+      self._pagestarts += random.Random(seed).sample( xrange(1,npages), samplesize )
       self._pagestarts.sort()
 
 
@@ -1054,7 +2240,7 @@ class SOLRSubsampleResponseIterator(SOLRSearchResponseIterator):
     except IndexError:
       self._cpage += 1
       try:
-        self._crecord = self._pagestarts[self._cpage]
+        self.crecord = self._pagestarts[self._cpage] * self.pagesize
         self._nextPage(self.crecord)
         idx = self.crecord - self.res['response']['start']
         row = self.res['response']['docs'][idx]
@@ -1062,10 +2248,253 @@ class SOLRSubsampleResponseIterator(SOLRSearchResponseIterator):
         self.done = True
         raise StopIteration()
     self.crecord = self.crecord + 1
-    return self.processRow(row)
+    return self.transformer.transform(row)
+
+#===============================================================================
+
+class SOLRRandomSampleIterator(SOLRSearchResponseIterator):
+  '''
+  Iterates over a uniform random sample of nsamples records of the result 
+  set.  Records are ordered by a seeded random sort field (see 
+  SolrConnection.randomSort) and the first nsamples are returned, so every 
+  record is equally likely to be chosen independently of its position in 
+  the index, and the same seed gives the same sample while the index is 
+  unchanged.  The cost is that of fetching nsamples rows.
+  '''
+
+  def __init__(self, client, q, fq=None, fields='*', pagesize=1000,
+               nsamples=10000, seed=0, transformer=SOLRRecordTransformer()):
+    self.nsamples = nsamples
+    SOLRSearchResponseIterator.__init__(self, client, q, fq, fields, 
+                                        min(pagesize, nsamples), transformer,
+                                        sort=client.randomSort(seed))
+    self.logger = logging.getLogger('solrclient.SOLRRandomSampleIterator')
+
+
+  def next(self):
+    if self.crecord >= self.nsamples:
+      self.done = True
+      raise StopIteration()
+    return SOLRSearchResponseIterator.next(self)
   
 
 
+#===============================================================================
+
+class SOLRPartitionedScanner(object):
+  '''
+  Scans a result set by splitting it into disjoint slices that are fetched
+  concurrently, each over its own pooled connection with cursor paging.
+
+  Slices are ranges of the slicing field: for a string field such as the 
+  unique key the range edges are quantiles of its terms (see fieldTerms), 
+  for an integer or floating point field they divide the range between 
+  min and max equally.  The ranges only match records that have a value
+  of the slicing field, so a last slice of the records lacking one 
+  (-field:[* TO *]) completes the result set.
+
+  The quantiles of a string field are found by nslices - 1 facet.offset
+  probes (plus those of fieldTermCount when q or fq restrict the result
+  set).  SOLR walks the terms up to the offset for each probe, so each
+  costs O(number of terms), which for the unique key is the number of
+  records.  For large result sets slice on a numeric field instead, i.e.
+  field='year_i', whose edges cost a single stats request.
+
+  Iterating the scanner yields records.  In ordered mode slices are 
+  delivered in order of the slicing field (and within a slice in order of
+  the unique key), the records lacking it last, otherwise records are
+  yielded as soon as any slice has them.  Each slice buffers at most
+  queuesize pages, so memory is bounded by nthreads * queuesize pages.
+
+  Uses half-open range queries and cursorMark, so requires SOLR 4.7 or later.
+  '''
+
+  def __init__(self, client, q='*:*', fq=None, fields='*', field='id', 
+               nslices=8, nthreads=None, pagesize=1000, ordered=False,
+               transformer=SOLRRecordTransformer(), queuesize=2):
+    '''
+    Initialize.
+    
+    @param client(SolrConnection) An instance of a solr connection to use.
+    @param q(string) The SOLR query to restrict results
+    @param fq(string) A filter query, restricts the set of rows that q is applied to
+    @param fields(string) A comma delimited list of field names to return
+    @param field(string) Name of the field used to slice the result set, a
+      numeric field for large result sets (see above)
+    @param nslices(int) Number of slices
+    @param nthreads(int) Number of slices fetched concurrently, defaults to
+      the connection pool size.
+    @param pagesize(int) Number of rows to retrieve in each call.
+    @param ordered(boolean) Deliver slices in order
+    @param queuesize(int) Pages buffered per slice
+    '''
+    self.logger = logging.getLogger('solrclient.SOLRPartitionedScanner')
+    self.client = client
+    self.q = q
+    self.fq = fq
+    self.fields = fields
+    self.field = field
+    self.nslices = nslices
+    if nthreads is None:
+      nthreads = client.pool.maxsize
+    self.nthreads = max(1, nthreads)
+    self.pagesize = pagesize
+    self.ordered = ordered
+    self.transformer = transformer
+    self.queuesize = queuesize
+    self._stop = False
+
+
+  def _rangeQuery(self, low, high):
+    if low is None:
+      low = '*'
+    if high is None:
+      return u'%s:[%s TO *]' % (self.field, low)
+    return u'%s:[%s TO %s}' % (self.field, low, high)
+
+
+  def slices(self):
+    '''
+    Returns the list of filter queries that partition the result set, the
+    last matching the records without a value of the slicing field.
+    '''
+    missing = u'-%s:[* TO *]' % self.field
+    ftype = self.client.getftype(self.field)
+    edges = []
+    if ftype in (int, float):
+      vmin, vmax = self.client.fieldMinMax(self.field, q=self.q, fq=self.fq)
+      if vmin is None:
+        return [missing, ]
+      delta = (float(vmax) - float(vmin)) / self.nslices
+      for i in xrange(1, self.nslices):
+        edge = float(vmin) + i * delta
+        if ftype == int:
+          edge = int(math.ceil(edge))
+        edges.append(repr(edge))
+    else:
+      nterms = self.client.fieldTermCount(self.field, q=self.q, fq=self.fq)
+      if nterms == 0:
+        return [missing, ]
+      delta = float(nterms) / self.nslices
+      offsets = [int(i * delta) for i in xrange(1, self.nslices)]
+      terms = self.client.parallelMap(
+          lambda offset: self.client.fieldTerms(self.field, q=self.q, 
+                                                fq=self.fq, offset=offset, 
+                                                limit=1),
+          offsets, nthreads=self.nthreads)
+      for t in terms:
+        if len(t) > 0:
+          edges.append(self.client.prepareQueryTerm(self.field, t[0][0]))
+    #drop duplicate edges so no slice is empty by construction
+    unique = []
+    for edge in edges:
+      if len(unique) == 0 or unique[-1] != edge:
+        unique.append(edge)
+    bounds = [None, ] + unique + [None, ]
+    return [self._rangeQuery(bounds[i], bounds[i+1]) 
+            for i in xrange(0, len(bounds)-1)] + [missing, ]
+
+
+  def _put(self, queue, item):
+    #put, giving up if the scan has been closed
+    while not self._stop:
+      try:
+        queue.put(item, True, 0.5)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+
+  def _scanSlice(self, slicefq, queue):
+    fq = [slicefq, ]
+    if isinstance(self.fq, (list, tuple)):
+      fq = list(self.fq) + fq
+    elif self.fq is not None:
+      fq = [self.fq, ] + fq
+    try:
+      rows = SOLRSearchResponseIterator(self.client, self.q, fq=fq, 
+                                        fields=self.fields, 
+                                        pagesize=self.pagesize,
+                                        transformer=self.transformer, 
+                                        cursor=True)
+      batch = []
+      for row in rows:
+        batch.append(row)
+        if len(batch) >= self.pagesize:
+          if not self._put(queue, ('rows', batch)):
+            return
+          batch = []
+      if len(batch) > 0:
+        if not self._put(queue, ('rows', batch)):
+          return
+      self._put(queue, ('done', None))
+    except Exception,e:
+      self.logger.exception('Exception scanning slice %s' % slicefq)
+      self._put(queue, ('error', e))
+
+
+  def __iter__(self):
+    slices = self.slices()
+    self.logger.debug('Scanning %d slices' % len(slices))
+    self._stop = False
+    if self.ordered:
+      queues = [Queue.Queue(self.queuesize) for s in slices]
+    else:
+      shared = Queue.Queue(self.queuesize * self.nthreads)
+      queues = [shared for s in slices]
+    todo = Queue.Queue()
+    for i in xrange(0, len(slices)):
+      todo.put(i)
+    def worker():
+      while not self._stop:
+        try:
+          i = todo.get_nowait()
+        except Queue.Empty:
+          return
+        self._scanSlice(slices[i], queues[i])
+    workers = []
+    for i in xrange(0, min(self.nthreads, len(slices))):
+      t = threading.Thread(target=worker)
+      t.setDaemon(True)
+      t.start()
+      workers.append(t)
+    try:
+      remaining = len(slices)
+      current = 0
+      while remaining > 0:
+        kind, value = queues[current].get()
+        if kind == 'rows':
+          for row in value:
+            yield row
+        elif kind == 'error':
+          raise value
+        else:
+          remaining -= 1
+          if self.ordered:
+            current += 1
+    finally:
+      self.close()
+
+
+  def each(self, callback):
+    '''
+    Calls callback(record) for every record of the scan, from the calling
+    thread.  Returns the number of records.
+    '''
+    n = 0
+    for row in self:
+      callback(row)
+      n += 1
+    return n
+
+
+  def close(self):
+    '''
+    Stops the workers of an abandoned scan.
+    '''
+    self._stop = True
+
 #===============================================================================
 
 class SOLRValuesResponseIterator(object):
@@ -1113,13 +2542,10 @@ class SOLRValuesResponseIterator(object):
               'facet.field':self.field,
               'facet.limit':str(self.pagesize),
               'facet.offset': str(offset),
-              'facet.zeros':'false',
-              'wt':'python'}
+              'facet.zeros':'false'}
     if not self.fq is None:
       params['fq'] = self.fq
-    request = urllib.urlencode(params, doseq=True)
-    rsp = self.client.doPost(self.client.solrBase+'/select', request, self.client.formheaders)
-    data = eval( rsp.read() )
+    data = self.client.search(params)
     try:
       self.res = data['facet_counts']['facet_fields'][self.field]
       self.logger.debug(self.res)
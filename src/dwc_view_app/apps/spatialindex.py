@@ -0,0 +1,223 @@
+'''
+:mod:`spatialindex`
+===================
+
+:Synopsis:
+  In memory index of the locations of records, answering how many and which
+  records lie in a bounding box without querying SOLR.
+  The points are held in arrays sorted by the cell of a regular latitude /
+  longitude grid that holds them, so the points of a row of cells are
+  contiguous.  The cells inside a box are counted from the offsets of the
+  cells alone and only the points of the cells on its edges are compared
+  with it.
+  Also thins points to a bounded, spatially stratified sample for display as
+  markers.
+
+'''
+import heapq
+import math
+import struct
+from array import array
+try:
+  from hashlib import md5
+except ImportError:
+  from md5 import md5
+
+
+class GridIndex(object):
+  '''Points (id, lat, lng) bucketed by cells of a regular grid of cellsize degrees.
+
+  Points are listed in the order of their cells, from south to north and west to east, so pages of the points in a box are stable while the index is.  Points are taken as given: latitudes outside -90..90 and longitudes outside -180..180 are put in the nearest cell.
+  '''
+
+  def __init__(self, points, cellsize=1.0, version=None):
+    '''
+    :param points: iterable of (id, lat, lng)
+    :param cellsize: width and height of the cells in degrees
+    :type cellsize: float
+    :param version: index version the points were read from
+    '''
+    self.cellsize = float(cellsize)
+    self.version = version
+    self.ncols = int(math.ceil(360.0 / self.cellsize))
+    self.nrows = int(math.ceil(180.0 / self.cellsize))
+    keyed = []
+    for point in points:
+      keyed.append((self._cell(point[1], point[2]), point))
+    keyed.sort(key=lambda item: item[0])
+    self.ids = [point[0] for cell, point in keyed]
+    self.lats = array('d', [point[1] for cell, point in keyed])
+    self.lngs = array('d', [point[2] for cell, point in keyed])
+    self.offsets = array('l', [0]) * (self.nrows * self.ncols + 1)
+    for cell, point in keyed:
+      self.offsets[cell + 1] += 1
+    for i in xrange(1, len(self.offsets)):
+      self.offsets[i] += self.offsets[i - 1]
+
+
+  def __len__(self):
+    return len(self.ids)
+
+
+  def _row(self, lat):
+    return min(max(int((lat + 90.0) / self.cellsize), 0), self.nrows - 1)
+
+
+  def _col(self, lng):
+    return min(max(int((lng + 180.0) / self.cellsize), 0), self.ncols - 1)
+
+
+  def _cell(self, lat, lng):
+    return self._row(lat) * self.ncols + self._col(lng)
+
+
+  # (start, end, check) spans of the points that may be in the box, in order,
+  # where check is False for spans of cells that lie entirely in the box
+  def _spans(self, bbox):
+    west, south, east, north = [float(v) for v in bbox]
+    if west > east:
+      #crosses the antimeridian
+      boxes = [(west, south, 180.0, north), (-180.0, south, east, north)]
+    else:
+      boxes = [(west, south, east, north)]
+    size = self.cellsize
+    offsets = self.offsets
+    spans = []
+    for row in xrange(self._row(south), self._row(north) + 1):
+      base = row * self.ncols
+      rowin = south <= row * size - 90.0 and (row + 1) * size - 90.0 <= north
+      for boxwest, boxsouth, boxeast, boxnorth in boxes:
+        first, last = self._col(boxwest), self._col(boxeast)
+        #columns first..last overlap the box, columns inner..outer - 1 lie in it
+        inner, outer = first, last + 1
+        if boxwest > first * size - 180.0:
+          inner += 1
+        if boxeast < (last + 1) * size - 180.0:
+          outer -= 1
+        if not rowin or inner >= outer:
+          inner = outer = last + 1
+        for start, end, check in ((offsets[base + first], offsets[base + inner], True),
+                                  (offsets[base + inner], offsets[base + outer], False),
+                                  (offsets[base + outer], offsets[base + last + 1], True)):
+          if start < end:
+            spans.append((start, end, check))
+    return spans, boxes
+
+
+  def _matches(self, start, end, boxes):
+    lats, lngs = self.lats, self.lngs
+    for i in xrange(start, end):
+      lat, lng = lats[i], lngs[i]
+      for west, south, east, north in boxes:
+        if south <= lat <= north and west <= lng <= east:
+          yield i
+          break
+
+
+  def count(self, bbox):
+    '''Returns the number of points in a box, edges included.
+
+    :param bbox: [west, south, east, north], west greater than east for a box crossing the antimeridian
+    :type bbox: list
+    :rtype: integer
+    '''
+    spans, boxes = self._spans(bbox)
+    total = 0
+    for start, end, check in spans:
+      if check:
+        for i in self._matches(start, end, boxes):
+          total += 1
+      else:
+        total += end - start
+    return total
+
+
+  def search(self, bbox, start=0, count=100):
+    '''Returns the number of points in a box and a page of them.
+
+    :param bbox: [west, south, east, north], west greater than east for a box crossing the antimeridian
+    :type bbox: list
+    :param start: zero based index of the first point of the page
+    :type start: integer
+    :param count: number of points in the page
+    :type count: integer
+    :returns: (numFound, [(id, lat, lng), ...])
+    :rtype: tuple
+    '''
+    spans, boxes = self._spans(bbox)
+    found = 0
+    page = []
+    stop = start + count
+    for first, end, check in spans:
+      if check:
+        indexes = self._matches(first, end, boxes)
+      elif found + end - first <= start or found >= stop:
+        found += end - first
+        continue
+      else:
+        indexes = xrange(first, end)
+      for i in indexes:
+        if start <= found < stop:
+          page.append((self.ids[i], self.lats[i], self.lngs[i]))
+        found += 1
+    return found, page
+
+
+def pointHash(id):
+  '''Returns a number from the identifier of a point, the same in every process and run.'''
+  if isinstance(id, unicode):
+    id = id.encode('utf-8')
+  return struct.unpack('>Q', md5(str(id)).digest()[:8])[0]
+
+
+def thinPoints(points, bbox, ncols=64, nrows=64, percell=1):
+  '''Returns at most percell points in each cell of a grid over a box.
+
+  The points kept in a cell are those with the lowest pointHash() of their identifier, so the same points are chosen whatever the order they are read in, and the points chosen for a percell are among those chosen for any larger one.
+
+  :param points: iterable of (id, lat, lng)
+  :param bbox: [west, south, east, north], west greater than east for a box crossing the antimeridian
+  :type bbox: list
+  :param ncols: number of columns of the grid
+  :type ncols: integer
+  :param nrows: number of rows of the grid
+  :type nrows: integer
+  :param percell: maximum number of points kept in a cell
+  :type percell: integer
+  :returns: (number of points in the box, [(id, lat, lng), ...]) with the points in the order of their cells, from south to north and west to east
+  :rtype: tuple
+  '''
+  west, south, east, north = [float(v) for v in bbox]
+  width = east - west
+  if width < 0:
+    width += 360.0
+  height = north - south
+  if width <= 0 or height <= 0:
+    raise ValueError('Empty bounding box: %s' % str(bbox))
+  total = 0
+  cells = {}
+  for point in points:
+    lat, lng = point[1], point[2]
+    x = lng - west
+    if x < 0:
+      x += 360.0
+    if not (south <= lat <= north and x <= width):
+      continue
+    total += 1
+    cell = min(int((lat - south) / height * nrows), nrows - 1) * ncols + \
+           min(int(x / width * ncols), ncols - 1)
+    #a heap of the lowest hashes in the cell, with the highest on top
+    item = (-pointHash(point[0]), point)
+    heap = cells.get(cell)
+    if heap is None:
+      cells[cell] = [item]
+    elif len(heap) < percell:
+      heapq.heappush(heap, item)
+    elif item[0] > heap[0][0]:
+      heapq.heapreplace(heap, item)
+  selected = []
+  for cell in sorted(cells.keys()):
+    heap = cells[cell]
+    heap.sort(reverse=True)
+    selected.extend([point for key, point in heap])
+  return total, selected
@@ -0,0 +1,170 @@
+'''
+:mod:`tilepyramid`
+==================
+
+:Synopsis:
+  Map tiles of record counts.
+  Tiles are addressed as z/x/y in the Web Mercator tiling scheme of web maps
+  (OpenStreetMap, Google Maps): zoom level z has 2^z by 2^z tiles, x counting
+  from west to east from 180W and y from north to south from 85.0511N.  Each
+  tile is divided into a grid of cells by cells, with rows of equal height on
+  the map, and holds the number of records in each cell.
+
+'''
+import math
+
+# latitude of the northern edge of the tiles, where the map is square
+MAX_LATITUDE = 85.0511287798066
+
+# deepest zoom level of a tile
+MAX_ZOOM = 22
+
+
+def tileLongitude(x, n):
+  '''Returns the longitude of the western edge of column x of n columns of tiles or cells.'''
+  return x * 360.0 / n - 180.0
+
+
+def tileLatitude(y, n):
+  '''Returns the latitude of the northern edge of row y of n rows of tiles or cells.'''
+  return math.degrees(math.atan(math.sinh(math.pi * (1.0 - 2.0 * y / n))))
+
+
+def tileOf(z, lat, lng):
+  '''Returns the (x, y) of the tile of zoom level z holding a point.
+
+  Tiles include their western and southern edges, as the cells of SolrConnection.fieldGrid do, and points beyond the northern and southern edges of the map are put in the nearest tile.
+  '''
+  n = 2 ** z
+  lat = math.radians(min(max(lat, -MAX_LATITUDE), MAX_LATITUDE))
+  x = int(math.floor((lng + 180.0) / 360.0 * n))
+  y = int(math.ceil((1.0 - math.log(math.tan(lat) + 1.0 / math.cos(lat)) / math.pi) / 2.0 * n)) - 1
+  return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def checkTile(z, x, y):
+  '''Raises ValueError if z/x/y is not a tile.'''
+  if z < 0 or z > MAX_ZOOM:
+    raise ValueError('Zoom level must be between 0 and %d' % MAX_ZOOM)
+  n = 2 ** z
+  if x < 0 or x >= n or y < 0 or y >= n:
+    raise ValueError('No tile %d/%d/%d' % (z, x, y))
+
+
+def tileBounds(z, x, y):
+  '''Returns the [west, south, east, north] bounds of a tile.'''
+  n = 2 ** z
+  return [tileLongitude(x, n), tileLatitude(y + 1, n),
+          tileLongitude(x + 1, n), tileLatitude(y, n)]
+
+
+def rowEdges(z, y, cells):
+  '''Returns the cells + 1 latitudes of the edges of the rows of cells of a tile, from south to north.'''
+  n = 2 ** z * cells
+  return [tileLatitude((y + 1) * cells - i, n) for i in xrange(0, cells + 1)]
+
+
+def tileCells(z, x, y, counts):
+  '''Returns the number of records in a tile and the list of its cells holding records, from the counts of a grid over the tile.
+
+  Each cell is given as [row, col, count, lat, lng] where rows count from north to south and lat, lng is the centre of the cell.
+
+  :param counts: counts of the cells indexed as counts[row][col], rows counting from south to north as computed by SolrConnection.fieldGrid
+  :type counts: list
+  :rtype: (integer, list)
+  '''
+  cells = len(counts)
+  n = 2 ** z * cells
+  result = []
+  total = 0
+  for row in xrange(0, cells):
+    for col in xrange(0, cells):
+      count = counts[cells - 1 - row][col]
+      if count:
+        total += count
+        result.append([row, col, count,
+                       tileLatitude(y * cells + row + 0.5, n),
+                       tileLongitude(x * cells + col + 0.5, n)])
+  return total, result
+
+
+class TilePyramid(object):
+  '''Counts of the cells of every tile from zoom level 0 to maxzoom.
+
+  The pyramid is built from a single grid of the whole map at the resolution of the cells of maxzoom, each level above holding the sums of the cells below it.  A cell holds its count and the sums of the latitude and longitude of the centres of the cells of maxzoom it covers, weighted by their counts, so the representative point of a cell is the centre of the records in it at that resolution.  Only cells holding records are stored.
+
+  The records of sparse tiles can be stored too (see sparseTiles and addPoints), so the tiles that list their records are also served from the pyramid.  Any tile holding at most limit records is made of tiles of maxzoom that do, so only the records of those are stored.
+  '''
+
+  def __init__(self, maxzoom, cells, counts, version=None):
+    '''
+    :param maxzoom: deepest zoom level of the pyramid
+    :type maxzoom: integer
+    :param cells: number of rows and columns of cells of a tile
+    :type cells: integer
+    :param counts: counts of the cells of the map at maxzoom, 2^maxzoom * cells rows counting from south to north, as computed by SolrConnection.fieldGrid
+    :type counts: list
+    :param version: index version the counts were computed from
+    '''
+    self.maxzoom = maxzoom
+    self.cells = cells
+    self.version = version
+    self.points = {}
+    total, fine = tileCells(0, 0, 0, counts)
+    self.total = total
+    level = {}
+    for row, col, count, lat, lng in fine:
+      level[(row, col)] = (count, lat * count, lng * count)
+    self.levels = [level]
+    for z in xrange(maxzoom - 1, -1, -1):
+      above = {}
+      for (row, col), (count, lats, lngs) in level.items():
+        key = (row // 2, col // 2)
+        cell = above.get(key)
+        if cell is not None:
+          count, lats, lngs = count + cell[0], lats + cell[1], lngs + cell[2]
+        above[key] = (count, lats, lngs)
+      level = above
+      self.levels.insert(0, level)
+
+
+  def tile(self, z, x, y):
+    '''Returns the number of records in a tile and the list of its cells holding records, as tileCells().'''
+    level = self.levels[z]
+    top = y * self.cells
+    left = x * self.cells
+    result = []
+    total = 0
+    for row in xrange(0, self.cells):
+      for col in xrange(0, self.cells):
+        cell = level.get((top + row, left + col))
+        if cell is not None:
+          count, lats, lngs = cell
+          total += count
+          result.append([row, col, count, lats / count, lngs / count])
+    return total, result
+
+
+  def sparseTiles(self, limit):
+    '''Returns the list of (x, y, count) of the tiles of maxzoom holding between 1 and limit records.'''
+    counts = {}
+    for (row, col), cell in self.levels[self.maxzoom].items():
+      key = (col // self.cells, row // self.cells)
+      counts[key] = counts.get(key, 0) + cell[0]
+    return [(x, y, count) for (x, y), count in sorted(counts.items()) if count <= limit]
+
+
+  def addPoints(self, points):
+    '''Stores records of the sparse tiles, [id, lat, lng] as listed by tiles.'''
+    for point in points:
+      self.points.setdefault(tileOf(self.maxzoom, point[1], point[2]), []).append(point)
+
+
+  def tilePoints(self, z, x, y):
+    '''Returns the stored records of a tile, a list of [id, lat, lng].'''
+    span = 2 ** (self.maxzoom - z)
+    result = []
+    for ty in xrange(y * span, (y + 1) * span):
+      for tx in xrange(x * span, (x + 1) * span):
+        result.extend(self.points.get((tx, ty), []))
+    return result
@@ -118,6 +118,67 @@ CACHE_BACKEND = 'locmem://?timeout=86400' # 24 hours (60 * 60 * 24)
 #CACHE_BACKEND = 'file:///' + ROOT_PATH + '/tmp/django_cache?timeout=86400' # 24 hours (60 * 60 * 24)
 #CACHE_BACKEND = 'file:///tmp/django_cache?timeout=86400' # 24 hours (60 * 60 * 24)
 
+# SOLR Connection Options
+# Maximum number of keep-alive connections the gateway holds open to SOLR.
+# Should be at least the number of worker threads serving gateway requests.
+SOLR_MAX_CONNECTIONS = 10
+# Seconds between checks of the SOLR index version.  Cached gateway data is
+# refreshed when the index version changes.
+SOLR_VERSION_CHECK_INTERVAL = 30
+# Size in bytes of the in memory cache of gateway results for each endpoint.
+# Cached results are discarded when the SOLR index version changes.
+GATEWAY_CACHE_BUDGETS = {
+  'field': 1024 * 1024,
+  'values': 8 * 1024 * 1024,
+  'histogram': 8 * 1024 * 1024,
+  'histogram2d': 8 * 1024 * 1024,
+  'grid': 8 * 1024 * 1024,
+  'tiles': 16 * 1024 * 1024,
+  'records': 32 * 1024 * 1024,
+}
+# zlib compression level (1-9) of cached gateway results, 0 for none.
+# Compressed results are sent as is to clients accepting gzip encoding.
+GATEWAY_CACHE_COMPRESS = 6
+# Seconds for which the summary, field listing and field statistics are fresh.
+# They are refreshed in the background before they expire, and served for up
+# to GATEWAY_MAX_STALE seconds while they can not be refreshed.
+GATEWAY_REFRESH_TTL = 300
+GATEWAY_MAX_STALE = 3600
+# Start the gateway's background work (scheduled refresh, warm up, tile
+# precomputation, spatial index and snapshot saves) on the first gateway
+# request.  False where background threads are not available, i.e. on App
+# Engine; values are then computed when they are first requested.
+GATEWAY_START = True
+# SQLite file holding a snapshot of the gateway caches, or None.  Once the
+# gateway is started it is loaded if it is of the current SOLR index version,
+# and saved every GATEWAY_SNAPSHOT_INTERVAL seconds and at exit.  Needs a
+# writable filesystem and sqlite3, which App Engine does not provide.
+GATEWAY_SNAPSHOT = None
+#GATEWAY_SNAPSHOT = os.path.join(ROOT_PATH, 'tmp', 'gateway_snapshot.db')
+GATEWAY_SNAPSHOT_INTERVAL = 600
+# Cache of gateway results shared by the gateway processes, in addition to
+# the in memory cache of each process: None, 'django' to use CACHE_BACKEND
+# (i.e. memcached), or the path of an SQLite file shared by the processes
+# of a host.
+GATEWAY_SHARED_CACHE = None
+#GATEWAY_SHARED_CACHE = 'django'
+#GATEWAY_SHARED_CACHE = os.path.join(ROOT_PATH, 'tmp', 'gateway_results.db')
+# Fields whose information, values and histogram are computed when the
+# gateway starts (see GATEWAY_START).
+GATEWAY_WARM_FIELDS = []
+#GATEWAY_WARM_FIELDS = ['phylum_s', 'genus_s', 'stateProvince_s']
+# Map tiles of the whole index are precomputed down to this zoom level when
+# the index changes (None to compute every tile on request).  Each tile has
+# GATEWAY_TILE_CELLS x GATEWAY_TILE_CELLS cells, and lists its records when
+# it holds at most GATEWAY_TILE_POINTS.
+GATEWAY_TILE_ZOOM = 5
+GATEWAY_TILE_CELLS = 8
+GATEWAY_TILE_POINTS = 100
+# Hold the id, lat and lng of every record in memory to count and list the
+# records in a bbox without querying SOLR.  Costs about 150 bytes a record.
+GATEWAY_SPATIAL_INDEX = False
+GATEWAY_SPATIAL_CELLSIZE = 1.0
+
 #####################################################
 # JSON Encoding/Output Option:
 # These can be used to increase JSON human
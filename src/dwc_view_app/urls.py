@@ -15,11 +15,17 @@ urlpatterns = patterns('',
       {'document_root': settings.MEDIA_ROOT, 'show_indexes': False}),
     # Darwin Core Views Gateway Web Services
     (r'^gateway/$', 'views.getSummary'),
+    (r'^gateway/cache$', 'views.getCacheStats'),
     (r'^gateway/fields$', 'views.getFields'),
     (r'^gateway/fields/(?P<field>[A-Za-z0-9_]+)$', 'views.getField'),
     (r'^gateway/fields/(?P<field>[A-Za-z0-9_]+)/values$', 'views.getFieldValues'),
     (r'^gateway/fields/(?P<field>[A-Za-z0-9_]+)/histogram$', 'views.getFieldHistogram'),
+    (r'^gateway/fields/(?P<colfield>[A-Za-z0-9_]+)/(?P<rowfield>[A-Za-z0-9_]+)/histogram2d$', 'views.getFieldHistogram2d'),
+    (r'^gateway/grid$', 'views.getGrid'),
+    (r'^gateway/tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)$', 'views.getTile'),
     (r'^gateway/records$', 'views.getRecords'),
+    (r'^gateway/records/sample$', 'views.getSample'),
+    (r'^gateway/records/export$', 'views.exportRecords'),
     (r'^gateway/record/(?P<record_id>.+)$', 'views.getRecord'),
     # Test Page
     (r'^$', 'views.index'),
@@ -7,13 +7,16 @@
 
 '''
 from string import atoi
+from functools import wraps
 from django.conf import settings
 from django.shortcuts import render_to_response, get_object_or_404
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified
 from django.core.servers.basehttp import FileWrapper
 from django.utils.simplejson import JSONEncoder
-from django.views.decorators.cache import cache_page
+from django.core.cache import cache
 from apps.DwCGateway import SOLRGateway
+from apps.gatewaycache import DjangoCacheStore, SQLiteStore
+from apps.solrclient import SolrException
 
 def index(request):
   '''Default "index" view
@@ -31,8 +34,78 @@ def pcss(request, stylefile):
 ### Darwin Core Views Gateway Web Services ###
 # use the encoder specified in the settings file
 encoder=settings.JSON_ENCODER
-gateway = SOLRGateway(host="serrano.speciesanalyst.net", basedir="/solr", encoder=encoder, identifier="MySolrID")
+# results shared by the gateway processes
+sharedcache = None
+if settings.GATEWAY_SHARED_CACHE == 'django':
+  sharedcache = DjangoCacheStore(cache)
+elif settings.GATEWAY_SHARED_CACHE != None:
+  sharedcache = SQLiteStore(settings.GATEWAY_SHARED_CACHE)
+gateway = SOLRGateway(host="serrano.speciesanalyst.net", basedir="/solr", encoder=encoder, identifier="MySolrID",
+                      maxconnections=settings.SOLR_MAX_CONNECTIONS,
+                      versioninterval=settings.SOLR_VERSION_CHECK_INTERVAL,
+                      cachebudgets=settings.GATEWAY_CACHE_BUDGETS,
+                      cachecompress=settings.GATEWAY_CACHE_COMPRESS,
+                      refreshttl=settings.GATEWAY_REFRESH_TTL,
+                      maxstale=settings.GATEWAY_MAX_STALE,
+                      snapshot=settings.GATEWAY_SNAPSHOT,
+                      snapshotinterval=settings.GATEWAY_SNAPSHOT_INTERVAL,
+                      warmfields=settings.GATEWAY_WARM_FIELDS,
+                      sharedcache=sharedcache,
+                      tilezoom=settings.GATEWAY_TILE_ZOOM,
+                      tilecells=settings.GATEWAY_TILE_CELLS,
+                      tilepoints=settings.GATEWAY_TILE_POINTS,
+                      spatialindex=settings.GATEWAY_SPATIAL_INDEX,
+                      spatialcellsize=settings.GATEWAY_SPATIAL_CELLSIZE)
 
+def gatewayView(view):
+  '''Decorator of the gateway views starting the gateway's background work on the first request, if settings.GATEWAY_START is True
+
+  Without it every gateway value is computed when it is first requested.
+  '''
+  @wraps(view)
+  def startGateway(request, *args, **kwargs):
+    if settings.GATEWAY_START:
+      gateway.start()
+    return view(request, *args, **kwargs)
+  return startGateway
+
+def badRequest(description):
+  '''Output a 400 Bad Request response describing what is wrong with the request
+
+  :param description: Why the request can not be answered
+  :type description: string
+  '''
+  error = encoder({'name': 'Bad Request', 'description': description})
+  return HttpResponse(error, status=400, mimetype='application/json')
+
+def encodedResponse(request, response, mimetype='application/json'):
+  '''Output a cached gateway response without decoding or encoding it
+
+  The response carries an ETag, and a request whose If-None-Match header
+  matches it is answered with 304 Not Modified.  A compressed response is
+  sent as is to clients that accept gzip content encoding.
+
+  :param response: The response from the gateway result cache
+  :type response: EncodedResponse
+  '''
+  etag = response.etag
+  gzip = response.compressed and 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+  if gzip:
+    # the gzip representation gets its own entity tag
+    etag = etag[:-1] + '-gzip"'
+  matches = [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]
+  if etag in matches:
+    result = HttpResponseNotModified()
+  elif gzip:
+    result = HttpResponse(response.body, mimetype=mimetype)
+    result['Content-Encoding'] = 'gzip'
+  else:
+    result = HttpResponse(response.data(), mimetype=mimetype)
+  result['ETag'] = etag
+  result['Vary'] = 'Accept-Encoding'
+  return result
+
+@gatewayView
 def getSummary(request):
   '''Output a general summary of the Darwin Core Database Server
 
@@ -42,7 +115,17 @@ def getSummary(request):
   summary = gateway.GetSummary()
   return HttpResponse(summary, mimetype='application/json')
 
-@cache_page()
+@gatewayView
+def getCacheStats(request):
+  '''Output the hit and miss counters and memory use of the gateway result cache of each endpoint
+
+  :returns: JSON structure from the GetCacheStats() function
+  :rtype: json
+  '''
+  stats = gateway.GetCacheStats()
+  return HttpResponse(stats, mimetype='application/json')
+
+@gatewayView
 def getFields(request):
   '''Output a listing of all fields found within the server's documents 
   :returns: JSON structure from the getFields() function as described in https://github.com/vdave/DwC_views/wiki/GatewayAPIs
@@ -51,6 +134,7 @@ def getFields(request):
   fields = gateway.GetFields()
   return HttpResponse(fields, mimetype='application/json')
 
+@gatewayView
 def getField(request, field):
   '''Output general information about the requested field
   
@@ -60,9 +144,21 @@ def getField(request, field):
   :rtype: json
   '''
 
-  field = gateway.GetField(field)
-  return HttpResponse(field, mimetype='application/json')
+  field = gateway.GetField(field, encoded=True)
+  return encodedResponse(request, field)
 
+def parseBBox(value):
+  '''Parse a bounding box parameter, "west,south,east,north" in decimal degrees
+
+  :returns: [west, south, east, north]
+  :rtype: list of float
+  '''
+  bbox = [float(v) for v in value.split(',')]
+  if len(bbox) != 4:
+    raise ValueError('bbox must be west,south,east,north')
+  return bbox
+
+@gatewayView
 def getFieldValues(request, field):
   '''Output a listing of unique values and their occurance count for the given field
   
@@ -80,12 +176,21 @@ def getFieldValues(request, field):
     params['count'] = atoi(request.GET['count'])
   else:
     params['count'] = 1000
-  values = gateway.GetFieldValues(field, **params)
-  return HttpResponse(values, mimetype='application/json')
+  if request.GET.has_key('bbox'):
+    params['bbox'] = parseBBox(request.GET['bbox'])
+  values = gateway.GetFieldValues(field, encoded=True, **params)
+  return encodedResponse(request, values)
 
+@gatewayView
 def getFieldHistogram(request, field):
   '''Output a listing of unique values and their occurance count for the given field
   
+  Query paramaters are passed as standard GET style variables in the URL:
+  *filter: The SOLR query (i.e. the default: "*.*").
+  *nbins: Number of bins (default: "10")
+  *gap: Width of each bin for numeric (i.e. "10") or date (i.e. "+1YEAR") fields.  Overrides nbins.
+  *bbox: Bounds of the lat and lng of the records counted as "west,south,east,north" in decimal degrees.
+
   :param field: The name of the field
   :type field: string
   :returns: JSON structure from the getFieldValues() function as described in https://github.com/vdave/DwC_views/wiki/GatewayAPIs
@@ -101,10 +206,106 @@ def getFieldHistogram(request, field):
     params['nbins'] = atoi(request.GET['nbins'])
   else:
     params['nbins'] = 10
+  if request.GET.has_key('gap'):
+    params['gap'] = request.GET['gap']
+  else:
+    params['gap'] = None
+  if request.GET.has_key('bbox'):
+    params['bbox'] = parseBBox(request.GET['bbox'])
+
+  values = gateway.GetFieldHistogram(field, encoded=True, **params)
+  return encodedResponse(request, values)
+
+@gatewayView
+def getFieldHistogram2d(request, colfield, rowfield):
+  '''Output a two dimensional histogram (density grid) of the values of two numeric fields
+
+  Query paramaters are passed as standard GET style variables in the URL:
+  *filter: The SOLR query (i.e. the default: "*.*").
+  *ncols: Number of columns the colfield values are divided into (default: "10")
+  *nrows: Number of rows the rowfield values are divided into (default: "10")
+
+  :param colfield: The name of the field used for the columns (i.e. "lng")
+  :type colfield: string
+  :param rowfield: The name of the field used for the rows (i.e. "lat")
+  :type rowfield: string
+  :returns: JSON structure from the GetFieldHistogram2d() function
+  :rtype: json
+  '''
+  params = {}
+  if request.GET.has_key('filter'):
+    params['q'] = request.GET['filter']
+  else:
+    params['q'] = "*:*"
+  if request.GET.has_key('ncols'):
+    params['ncols'] = atoi(request.GET['ncols'])
+  else:
+    params['ncols'] = 10
+  if request.GET.has_key('nrows'):
+    params['nrows'] = atoi(request.GET['nrows'])
+  else:
+    params['nrows'] = 10
+
+  values = gateway.GetFieldHistogram2d(colfield, rowfield, encoded=True, **params)
+  return encodedResponse(request, values)
+
+@gatewayView
+def getGrid(request):
+  '''Output the number of records in each cell of a grid over a bounding box
+
+  Query paramaters are passed as standard GET style variables in the URL:
+  *bbox: Bounds of the grid as "west,south,east,north" in decimal degrees (default: "-180,-90,180,90")
+  *rows: Number of rows, divisions of south to north (default: "10")
+  *cols: Number of columns, divisions of west to east (default: "10")
+  *filter: The SOLR query (i.e. the default: "*.*").
+
+  :returns: JSON structure from the GetGrid() function
+  :rtype: json
+  '''
+  params = {}
+  if request.GET.has_key('bbox'):
+    params['bbox'] = parseBBox(request.GET['bbox'])
+  else:
+    params['bbox'] = [-180.0, -90.0, 180.0, 90.0]
+  if request.GET.has_key('rows'):
+    params['nrows'] = atoi(request.GET['rows'])
+  else:
+    params['nrows'] = 10
+  if request.GET.has_key('cols'):
+    params['ncols'] = atoi(request.GET['cols'])
+  else:
+    params['ncols'] = 10
+  if request.GET.has_key('filter'):
+    params['q'] = request.GET['filter']
+  else:
+    params['q'] = "*:*"
+  grid = gateway.GetGrid(encoded=True, **params)
+  return encodedResponse(request, grid)
+
+@gatewayView
+def getTile(request, z, x, y):
+  '''Output the number of records in a map tile and in each cell of the tile
+
+  The tile is addressed in the URL as /gateway/tiles/{z}/{x}/{y}.  Query paramaters are passed as standard GET style variables in the URL:
+  *filter: The SOLR query (i.e. the default: "*.*").
+
+  :returns: JSON structure from the GetTile() function
+  :rtype: json
+  '''
+  params = {}
+  if request.GET.has_key('filter'):
+    params['q'] = request.GET['filter']
+  else:
+    params['q'] = "*:*"
+  tile = gateway.GetTile(atoi(z), atoi(x), atoi(y), encoded=True, **params)
+  return encodedResponse(request, tile)
 
-  values = gateway.GetFieldHistogram(field, **params)
-  return HttpResponse(values, mimetype='application/json')
+RECORD_MIMETYPES = {'json': 'application/json',
+                    'array': 'application/json',
+                    'columns': 'application/json',
+                    'f32': 'application/octet-stream'}
 
+@gatewayView
 def getRecords(request):
   '''Output a listing of all records found given the defined query parameters
   
@@ -115,6 +316,14 @@ def getRecords(request):
   *order: Direction of sort order (i.e. "asc" or "desc").  The default is "asc".  Only used if the 'orderby' parameter is supplied.
   *start: First record of the result set to display (default "0").  Used for paging.
   *count: Maximum number of records to return (default: "1000")
+  *cursor: Paging cursor, "*" for the first page then the "nextCursor" value of the previous response.  Replaces start for walking deep into large result sets.
+  *format: "json" (default) for a list of records, "array" for the field names and a list of rows of values, "columns" for the field names and a list of the values of each field, or "f32" for the values of numeric fields packed as little-endian float32 and int32 arrays after a JSON header (i.e. with fields "lat,lng" for a marker layer).
+  *bbox: Bounds of the lat and lng of the records as "west,south,east,north" in decimal degrees, west greater than east for a box crossing the antimeridian.
+  *thin: "grid" to return at most per_cell of the records in each cell of a grid over the bbox (or the whole map) instead of a page of them.
+  *cells: Columns and rows of the grid of thin, as "64x64" (the default).
+  *per_cell: Maximum number of records in a cell with thin (default: "1").
+
+  Responds with 400 Bad Request to an unknown format or thin, or a malformed bbox, cells or per_cell.
 
   A proper request might look something like:
 
@@ -149,9 +358,137 @@ def getRecords(request):
     params['count'] = atoi(request.GET['count'])
   else:
     params['count'] = 1000
-  results = gateway.GetRecords(**params)
+  if request.GET.has_key('cursor'):
+    params['cursor'] = request.GET['cursor']
+  else:
+    params['cursor'] = None
+  if request.GET.has_key('format'):
+    params['format'] = request.GET['format'].lower()
+  else:
+    params['format'] = "json"
+  if not RECORD_MIMETYPES.has_key(params['format']):
+    return badRequest('Unknown records format: %s' % params['format'])
+  if params['format'] == 'f32' and '*' in params['fields']:
+    return badRequest('The f32 format needs a list of fields')
+  try:
+    if request.GET.has_key('bbox'):
+      params['bbox'] = parseBBox(request.GET['bbox'])
+    if request.GET.has_key('cells'):
+      params['cells'] = [atoi(v) for v in request.GET['cells'].lower().split('x')]
+    if request.GET.has_key('per_cell'):
+      params['percell'] = atoi(request.GET['per_cell'])
+  except ValueError, e:
+    return badRequest(str(e))
+  if request.GET.has_key('thin'):
+    params['thin'] = request.GET['thin'].lower()
+    if params['thin'] != 'grid':
+      return badRequest('Unknown thinning: %s' % params['thin'])
+  results = gateway.GetRecords(encoded=True, **params)
+  return encodedResponse(request, results, RECORD_MIMETYPES[params['format']])
+
+EXPORT_MIMETYPES = {'ndjson': 'application/x-ndjson',
+                    'json': 'application/json',
+                    'csv': 'text/csv',
+                    'dwca': 'application/zip'}
+
+@gatewayView
+def exportRecords(request):
+  '''Stream all records matching the query
+
+  The response is generated while the records are fetched from SOLR, so
+  result sets of any size can be downloaded without the gateway holding
+  them in memory.
+
+  Query paramaters are passed as standard GET style variables in the URL:
+  *filter: The SOLR query (i.e. the default: "*.*").
+  *fields: Comma delineated list of fields to return in each record (i.e. "lng,lat").  The default is "*", which returns all fields.
+  *orderby: name of the field by which the record set will be sorted (i.e. "phylum_s").
+  *order: Direction of sort order (i.e. "asc" or "desc").  The default is "asc".
+  *format: One of "ndjson" (one JSON record per line, the default), "json" (a JSON array of records), "csv" or "dwca" (a Darwin Core Archive of the records, a zip file, for which fields, orderby and count are ignored).
+  *count: Maximum number of records to return (default: all)
+
+  Responds with 400 Bad Request to an unknown format.
+
+  :returns: the records in the requested format
+  '''
+  params = {}
+  if request.GET.has_key('filter'):
+    params['q'] = request.GET['filter']
+  else:
+    params['q'] = "*:*"
+  if request.GET.has_key('fields'):
+    params['fields'] = request.GET['fields']
+  else:
+    params['fields'] = "*"
+  if request.GET.has_key('orderby'):
+    params['orderby'] = request.GET['orderby']
+  else:
+    params['orderby'] = None
+  if request.GET.has_key('order'):
+    params['order'] = request.GET['order'].lower()
+  else:
+    params['order'] = "asc"
+  if request.GET.has_key('format'):
+    params['format'] = request.GET['format'].lower()
+  else:
+    params['format'] = "ndjson"
+  if not EXPORT_MIMETYPES.has_key(params['format']):
+    return badRequest('Unknown export format: %s' % params['format'])
+  if request.GET.has_key('count'):
+    params['count'] = atoi(request.GET['count'])
+  else:
+    params['count'] = None
+  if params['format'] == 'dwca':
+    chunks = gateway.ExportArchive(params['q'])
+    filename = 'dwca.zip'
+  else:
+    chunks = gateway.ExportRecords(**params)
+    filename = 'records.%s' % params['format']
+  response = HttpResponse(chunks, mimetype=EXPORT_MIMETYPES[params['format']])
+  response['Content-Disposition'] = 'attachment; filename=%s' % filename
+  return response
+
+@gatewayView
+def getSample(request):
+  '''Output a uniform random sample of the records matching the query
+
+  Query paramaters are passed as standard GET style variables in the URL:
+  *filter: The SOLR query (i.e. the default: "*.*").
+  *fields: Comma delineated list of fields to return in each record (i.e. "lng,lat").  The default is "*", which returns all fields.
+  *n: Number of records in the sample (default: "1000")
+  *seed: Integer seed of the random selection.  Requests with the same seed return the same sample.  If not provided, a seed is chosen and returned in the response.
+
+  Responds with 400 Bad Request if the SOLR schema has no random sort field.
+
+  :returns: JSON structure from the GetSample() function
+  :rtype: json
+  '''
+  params = {}
+  if request.GET.has_key('filter'):
+    params['q'] = request.GET['filter']
+  else:
+    params['q'] = "*:*"
+  if request.GET.has_key('fields'):
+    params['fields'] = request.GET['fields']
+  else:
+    params['fields'] = "*"
+  if request.GET.has_key('n'):
+    params['count'] = atoi(request.GET['n'])
+  else:
+    params['count'] = 1000
+  if request.GET.has_key('seed'):
+    params['seed'] = atoi(request.GET['seed'])
+  else:
+    params['seed'] = None
+  try:
+    results = gateway.GetSample(**params)
+  except SolrException, e:
+    if e.httpcode != 400:
+      raise
+    return badRequest(e.reason)
   return HttpResponse(results, mimetype='application/json')
 
+@gatewayView
 def getRecord(request, record_id):
   '''Output a server record as identified by its record_id
   
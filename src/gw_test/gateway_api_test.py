@@ -26,6 +26,10 @@ import logging
 import urllib
 import urllib2
 import urlparse
+import zipfile
+import StringIO
+import struct
+from array import array
 import simplejson as json
 import restclient
 
@@ -132,6 +136,39 @@ class TestGatewayApi(unittest.TestCase):
     self.assertTrue(err.has_key('description'))
     
     
+  def testGetFieldHistogramDateGap(self):
+    fieldname = "modified"
+    params = {'gap':'+1YEAR'}
+    url = urlparse.urljoin(self.serviceUrl,"fields/%s/histogram" % fieldname)
+    logging.debug("getfieldhistogram url = %s" % url)
+    response = self.cli.GET(url, url_params=params)
+    self.assertEqual(response.status, 200)
+    bins = json.loads(response.read(), 'utf-8')
+    self.assertTrue(isinstance(bins, list))
+    for bin in bins:
+      #[binmin, binmax, count, query], bins start on a year boundary
+      self.assertEqual(len(bin), 4)
+      self.assertTrue(bin[0].endswith('-01-01T00:00:00Z'))
+
+
+  def testGetFieldHistogram2d(self):
+    params = {'ncols':5,
+              'nrows':4,
+              'filter':'*:*'}
+    url = urlparse.urljoin(self.serviceUrl,"fields/lng/lat/histogram2d")
+    logging.debug("getfieldhistogram2d url = %s" % url)
+    response = self.cli.GET(url, url_params=params)
+    self.assertEqual(response.status, 200)
+    hist = json.loads(response.read(), 'utf-8')
+    self.assertEqual(hist['colname'], 'lng')
+    self.assertEqual(hist['rowname'], 'lat')
+    self.assertEqual(len(hist['cols']), 5)
+    self.assertEqual(len(hist['rows']), 4)
+    self.assertEqual(len(hist['z']), 4)
+    for row in hist['z']:
+      self.assertEqual(len(row), 5)
+
+
   def testGetRecords(self):
     params = {'start':0,
               'count':10,
@@ -152,6 +189,255 @@ class TestGatewayApi(unittest.TestCase):
     self.assertTrue(rec0.has_key('genus_s'))
     
 
+  def testGetRecordsColumns(self):
+    params = {'start':0,
+              'count':10,
+              'fields':'id,lat,lng',
+              'filter':'*:*'}
+    url = urlparse.urljoin(self.serviceUrl,"records")
+    response = self.cli.GET(url, url_params=params)
+    records = json.loads(response.read(), 'utf-8')
+    params['format'] = 'columns'
+    logging.debug("get records columns url = %s" % url)
+    response = self.cli.GET(url, url_params=params)
+    self.assertEqual(response.status, 200)
+    table = json.loads(response.read(), 'utf-8')
+    self.assertEqual(table['fields'], ['id', 'lat', 'lng'])
+    self.assertEqual(len(table['columns']), 3)
+    #the same records as the default format, lists of one value flattened
+    for i in xrange(0, len(records['docs'])):
+      self.assertEqual(records['docs'][i]['id'], table['columns'][0][i])
+    params['format'] = 'array'
+    response = self.cli.GET(url, url_params=params)
+    table = json.loads(response.read(), 'utf-8')
+    self.assertEqual(len(table['rows']), len(records['docs']))
+    self.assertEqual(len(table['rows'][0]), 3)
+
+
+  def testGetGrid(self):
+    params = {'bbox':'-20,-40,60,40',
+              'rows':8,
+              'cols':16,
+              'filter':'*:*'}
+    url = urlparse.urljoin(self.serviceUrl,"grid")
+    logging.debug("get grid url = %s" % url)
+    response = self.cli.GET(url, url_params=params)
+    self.assertEqual(response.status, 200)
+    grid = json.loads(response.read(), 'utf-8')
+    self.assertEqual(len(grid['z']), 8)
+    self.assertEqual(len(grid['z'][0]), 16)
+    #the cells hold every record in the bounding box
+    url = urlparse.urljoin(self.serviceUrl,"records")
+    response = self.cli.GET(url, url_params={'count':0,
+                            'filter':'lng:[-20 TO 60] AND lat:[-40 TO 40]'})
+    records = json.loads(response.read(), 'utf-8')
+    self.assertEqual(grid['numFound'], records['numFound'])
+
+
+  def testGetRecordsBBox(self):
+    url = urlparse.urljoin(self.serviceUrl,"records")
+    logging.debug("get records bbox url = %s" % url)
+    response = self.cli.GET(url, url_params={'bbox':'-20,-40,60,40',
+                                             'fields':'id,lat,lng',
+                                             'count':1000})
+    self.assertEqual(response.status, 200)
+    records = json.loads(response.read(), 'utf-8')
+    #the same records as the equivalent range queries
+    response = self.cli.GET(url, url_params={'filter':'lng:[-20 TO 60] AND lat:[-40 TO 40]',
+                                             'fields':'id',
+                                             'count':0})
+    expected = json.loads(response.read(), 'utf-8')
+    self.assertEqual(records['numFound'], expected['numFound'])
+    for doc in records['docs']:
+      lat, lng = doc['lat'], doc['lng']
+      if isinstance(lat, list):
+        lat, lng = lat[0], lng[0]
+      self.assertTrue(-40 <= lat <= 40 and -20 <= lng <= 60)
+    url = urlparse.urljoin(self.serviceUrl,"fields/lat/histogram")
+    response = self.cli.GET(url, url_params={'bbox':'-20,-40,60,40'})
+    self.assertEqual(response.status, 200)
+
+
+  def testGetRecordsThin(self):
+    params = {'fields':'id,lat,lng',
+              'thin':'grid',
+              'cells':'16x8',
+              'per_cell':2}
+    url = urlparse.urljoin(self.serviceUrl,"records")
+    logging.debug("get records thin url = %s" % url)
+    response = self.cli.GET(url, url_params=params)
+    self.assertEqual(response.status, 200)
+    records = json.loads(response.read(), 'utf-8')
+    self.assertTrue(len(records['docs']) <= 16 * 8 * 2)
+    self.assertTrue(len(records['docs']) <= records['numFound'])
+    #the records chosen do not change
+    response = self.cli.GET(url, url_params=params)
+    again = json.loads(response.read(), 'utf-8')
+    self.assertEqual(records['docs'], again['docs'])
+
+
+  def testGetTile(self):
+    url = urlparse.urljoin(self.serviceUrl,"tiles/0/0/0")
+    logging.debug("get tile url = %s" % url)
+    response = self.cli.GET(url)
+    self.assertEqual(response.status, 200)
+    world = json.loads(response.read(), 'utf-8')
+    self.assertEqual(world['numFound'], sum([cell[2] for cell in world['counts']]))
+    #the four tiles of the next zoom level hold the records of the world tile
+    total = 0
+    for x, y in [(0, 0), (1, 0), (0, 1), (1, 1)]:
+      url = urlparse.urljoin(self.serviceUrl,"tiles/1/%d/%d" % (x, y))
+      response = self.cli.GET(url)
+      total += json.loads(response.read(), 'utf-8')['numFound']
+    self.assertEqual(total, world['numFound'])
+    #a filtered tile is computed on request
+    url = urlparse.urljoin(self.serviceUrl,"tiles/0/0/0")
+    response = self.cli.GET(url, url_params={'filter':'stateProvince_s:Ogoou*'})
+    self.assertEqual(response.status, 200)
+    tile = json.loads(response.read(), 'utf-8')
+    self.assertTrue(tile['numFound'] <= world['numFound'])
+
+
+  def testGetRecordsF32(self):
+    params = {'start':0,
+              'count':100,
+              'fields':'lat,lng',
+              'filter':'*:*'}
+    url = urlparse.urljoin(self.serviceUrl,"records")
+    response = self.cli.GET(url, url_params=dict(params, format='columns'))
+    table = json.loads(response.read(), 'utf-8')
+    logging.debug("get records f32 url = %s" % url)
+    response = self.cli.GET(url, url_params=dict(params, format='f32'))
+    self.assertEqual(response.status, 200)
+    body = response.read()
+    n = struct.unpack('<I', body[:4])[0]
+    self.assertEqual((4 + n) % 4, 0)
+    header = json.loads(body[4:4 + n], 'utf-8')
+    self.assertEqual(header['fields'], ['lat', 'lng'])
+    self.assertEqual(header['types'], ['float32', 'float32'])
+    self.assertEqual(len(body), 4 + n + 8 * header['count'])
+    lat = array('f')
+    lat.fromstring(body[4 + n + header['offsets'][0]:4 + n + header['offsets'][0] + 4 * header['count']])
+    for i in xrange(0, header['count']):
+      self.assertAlmostEqual(lat[i], table['columns'][0][i], 4)
+
+
+  def testGetRecordsCursor(self):
+    params = {'count':5,
+              'fields':'id',
+              'filter':'*:*',
+              'cursor':'*'}
+    url = urlparse.urljoin(self.serviceUrl,"records")
+    seen = []
+    for page in xrange(0, 3):
+      response = self.cli.GET(url, url_params=params)
+      self.assertEqual(response.status, 200)
+      records = json.loads(response.read(), 'utf-8')
+      self.assertTrue(records.has_key('nextCursor'))
+      for rec in records['docs']:
+        self.assertFalse(rec['id'] in seen)
+        seen.append(rec['id'])
+      params['cursor'] = records['nextCursor']
+    self.assertEqual(len(seen), 15)
+
+
+  def testExportRecords(self):
+    params = {'fields':'id,genus_s',
+              'filter':'*:*',
+              'count':2500}
+    url = urlparse.urljoin(self.serviceUrl,"records/export")
+    logging.debug("export records url = %s" % url)
+    response = self.cli.GET(url, url_params=params)
+    self.assertEqual(response.status, 200)
+    lines = response.read().splitlines()
+    self.assertEqual(len(lines), 2500)
+    ids = set([json.loads(line, 'utf-8')['id'] for line in lines])
+    self.assertEqual(len(ids), 2500)
+    #csv has a header line
+    params['format'] = 'csv'
+    params['count'] = 10
+    response = self.cli.GET(url, url_params=params)
+    self.assertEqual(response.status, 200)
+    lines = response.read().splitlines()
+    self.assertEqual(lines[0], 'id,genus_s')
+    self.assertEqual(len(lines), 11)
+
+
+  def testExportArchive(self):
+    params = {'filter':'stateProvince_s:Ogoou*',
+              'format':'dwca'}
+    url = urlparse.urljoin(self.serviceUrl,"records/export")
+    logging.debug("export archive url = %s" % url)
+    response = self.cli.GET(url, url_params=params)
+    self.assertEqual(response.status, 200)
+    archive = zipfile.ZipFile(StringIO.StringIO(response.read()))
+    self.assertEqual(archive.testzip(), None)
+    self.assertTrue('http://rs.tdwg.org/dwc/terms/genus' in archive.read('meta.xml'))
+    lines = archive.read('occurrence.txt').splitlines()
+    self.assertEqual(lines[0].split('\t')[0], 'id')
+    self.assertTrue(len(lines) > 1)
+
+
+  def testGetSample(self):
+    params = {'n':20,
+              'fields':'id',
+              'filter':'*:*',
+              'seed':42}
+    url = urlparse.urljoin(self.serviceUrl,"records/sample")
+    logging.debug("get sample url = %s" % url)
+    response = self.cli.GET(url, url_params=params)
+    self.assertEqual(response.status, 200)
+    sample = json.loads(response.read(), 'utf-8')
+    self.assertEqual(sample['seed'], 42)
+    self.assertEqual(len(sample['docs']), 20)
+    #the same seed gives the same sample
+    response = self.cli.GET(url, url_params=params)
+    again = json.loads(response.read(), 'utf-8')
+    self.assertEqual(sample['docs'], again['docs'])
+
+
+  def testGetRecordsETag(self):
+    params = {'start':0,
+              'count':5,
+              'fields':'id',
+              'filter':'*:*'}
+    url = urlparse.urljoin(self.serviceUrl,"records")
+    response = self.cli.GET(url, url_params=params)
+    self.assertEqual(response.status, 200)
+    response.read()
+    etag = response.getheader('ETag')
+    self.assertTrue(etag is not None)
+    #an unchanged response is not sent again
+    response = self.cli.GET(url, url_params=params, headers={'If-None-Match': etag})
+    self.assertEqual(response.status, 304)
+    response.read()
+
+
+  def testGetCacheStats(self):
+    params = {'start':0,
+              'count':5,
+              'fields':'id',
+              'filter':'*:*'}
+    url = urlparse.urljoin(self.serviceUrl,"records")
+    self.cli.GET(url, url_params=params).read()
+    self.cli.GET(url, url_params=params).read()
+    url = urlparse.urljoin(self.serviceUrl,"cache")
+    logging.debug("get cache stats url = %s" % url)
+    response = self.cli.GET(url)
+    self.assertEqual(response.status, 200)
+    stats = json.loads(response.read(), 'utf-8')
+    self.assertTrue(stats.has_key('version'))
+    #the summary and field listing are refreshed in the background
+    self.assertTrue(stats['refresh'].has_key('summary'))
+    self.assertTrue(stats['refresh'].has_key('fields'))
+    #the repeated request is served from the cache
+    self.assertTrue(stats['records']['hits'] >= 1)
+    self.assertTrue(stats['records']['bytes'] <= stats['records']['maxbytes'])
+    self.assertTrue(stats['records']['l1ratio'] > 0)
+    self.assertTrue(stats['records']['executions'] + stats['records']['coalesced']
+                    <= stats['records']['misses'])
+
+
   def testGetRecordsUnicode(self):
     '''Simple unicode test - basically checks that text being passed through 
     the gateway is as expected from the original input to SOLR. 
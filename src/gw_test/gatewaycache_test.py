@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+'''Offline unit tests for the gateway caches.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License. You may obtain a copy
+of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+import unittest
+import logging
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'dwc_view_app', 'apps'))
+import gatewaycache
+
+
+class TestSingleFlight(unittest.TestCase):
+
+  def testConcurrentCallsRunOnce(self):
+    flights = gatewaycache.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    def compute():
+      calls.append(1)
+      started.set()
+      release.wait(5.0)
+      return 'value'
+    results = []
+    def caller():
+      results.append(flights.do('key', compute, name='test'))
+    leader = threading.Thread(target=caller)
+    leader.start()
+    started.wait(5.0)
+    followers = [threading.Thread(target=caller) for i in xrange(0, 5)]
+    for t in followers:
+      t.start()
+    #the followers are waiting on the running call
+    while flights.stats()['test']['coalesced'] < len(followers):
+      time.sleep(0.01)
+    release.set()
+    for t in [leader] + followers:
+      t.join()
+    self.assertEqual(len(calls), 1)
+    self.assertEqual(results, ['value'] * 6)
+    self.assertEqual(flights.stats()['test'], {'executions': 1, 'coalesced': 5})
+    self.assertEqual(flights.inflight(), 0)
+
+
+  def testErrorNotKept(self):
+    flights = gatewaycache.SingleFlight()
+    def fail():
+      raise ValueError('failed')
+    self.assertRaises(ValueError, flights.do, 'key', fail)
+    #a failed call is not remembered
+    self.assertEqual(flights.do('key', lambda: 1), 1)
+
+
+class StubVersions(object):
+  '''Stands in for an IndexVersionTracker.'''
+  def __init__(self, version='1'):
+    self.version = version
+
+  def current(self):
+    return self.version
+
+  def get(self):
+    return self.version
+
+
+class TestRefreshScheduler(unittest.TestCase):
+
+  def setUp(self):
+    self.versions = StubVersions()
+    self.scheduler = gatewaycache.RefreshScheduler(self.versions, ttl=60.0)
+    self.calls = 0
+    self.gate = threading.Event()
+    self.gate.set()
+
+
+  def compute(self):
+    self.gate.wait(5.0)
+    self.calls += 1
+    return self.calls
+
+
+  def waitForRefreshes(self, key, count):
+    deadline = time.time() + 5.0
+    while self.scheduler.stats()[key]['refreshes'] < count and time.time() < deadline:
+      time.sleep(0.01)
+
+
+  def testStaleServedThenRefreshed(self):
+    self.assertEqual(self.scheduler.get('key', self.compute), 1)
+    #the index changes, the value is due but is refreshed in the background
+    self.versions.version = '2'
+    self.gate.clear()
+    self.assertEqual(self.scheduler.get('key', self.compute), 1)
+    self.assertEqual(self.scheduler.get('key', self.compute), 1)
+    self.gate.set()
+    self.waitForRefreshes('key', 2)
+    self.assertEqual(self.scheduler.get('key', self.compute), 2)
+    self.assertEqual(self.scheduler.stats()['key']['version'], '2')
+    self.assertEqual(self.calls, 2)
+
+
+  def testStaleReadsUseWorkers(self):
+    #a burst of stale reads of many keys is refreshed by the pool of workers
+    self.scheduler = gatewaycache.RefreshScheduler(self.versions, ttl=60.0, workers=2)
+    for i in xrange(0, 20):
+      self.scheduler.get('key%d' % i, self.compute)
+    self.versions.version = '2'
+    self.gate.clear()
+    before = threading.activeCount()
+    for i in xrange(0, 20):
+      self.assertTrue(self.scheduler.get('key%d' % i) is not None)
+    self.assertTrue(threading.activeCount() <= before + 2)
+    self.gate.set()
+    for i in xrange(0, 20):
+      self.waitForRefreshes('key%d' % i, 2)
+    self.assertEqual(self.calls, 40)
+
+
+  def testFailedRefreshKeepsValue(self):
+    self.assertEqual(self.scheduler.get('key', self.compute), 1)
+    def fail():
+      raise ValueError('SOLR is down')
+    self.scheduler.register('key', None).compute = fail
+    self.versions.version = '2'
+    self.assertEqual(self.scheduler.get('key'), 1)
+    deadline = time.time() + 5.0
+    while self.scheduler.stats()['key']['errors'] == 0 and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(self.scheduler.stats()['key']['error'], 'SOLR is down')
+    self.assertEqual(self.scheduler.get('key'), 1)
+
+
+  def testSchedulerRefreshes(self):
+    self.scheduler = gatewaycache.RefreshScheduler(self.versions, ttl=60.0, tick=0.05)
+    self.scheduler.register('key', self.compute)
+    self.scheduler.start()
+    try:
+      self.waitForRefreshes('key', 1)
+      self.assertEqual(self.scheduler.get('key', wait=False), 1)
+      self.versions.version = '2'
+      self.waitForRefreshes('key', 2)
+      self.assertEqual(self.scheduler.get('key', wait=False), 2)
+    finally:
+      self.scheduler.stop()
+
+
+class TestCacheSnapshot(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.snapshot = gatewaycache.CacheSnapshot(os.path.join(self.directory, 'snapshot.db'))
+
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+
+  def testLoadSameVersion(self):
+    sections = {'refresh': {'summary': ('1', {'numFound': 10})},
+                'results': {'records': [('key', 'value')]}}
+    self.assertTrue(self.snapshot.save('1', sections))
+    self.assertEqual(self.snapshot.load('1'), sections)
+
+
+  def testVersionMismatch(self):
+    self.snapshot.save('1', {'refresh': {'summary': ('1', {'numFound': 10})}})
+    self.assertEqual(self.snapshot.load('2'), None)
+
+
+  def testNoSnapshot(self):
+    self.assertEqual(self.snapshot.load('1'), None)
+
+
+  def testNothingBeforeStart(self):
+    #no file is written and no thread started until start()
+    before = threading.activeCount()
+    gatewaycache.CacheSnapshot(os.path.join(self.directory, 'unused', 'snapshot.db'))
+    self.assertEqual(os.listdir(self.directory), [])
+    self.assertEqual(threading.activeCount(), before)
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  unittest.main()
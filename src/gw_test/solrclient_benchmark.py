@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+'''Benchmarks for the SOLR client library.
+
+These run offline against synthetic response bodies shaped like SOLR search
+responses for occurrence records, so they measure client side cost only.
+
+Usage::
+
+  python solrclient_benchmark.py [rows] [repeat]
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not 
+use this file except in compliance with the License. You may obtain a copy 
+of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0 
+'''
+
+import os
+import sys
+import time
+import random
+import StringIO
+import json
+import zlib
+import struct
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'dwc_view_app', 'apps'))
+import solrclient
+
+
+def makeDocs(nrows, seed=1):
+  rnd = random.Random(seed)
+  docs = []
+  for i in xrange(0, nrows):
+    docs.append({'id': [u'UAM.Fish.%d.' % i],
+                 'lat': [rnd.uniform(-60, 70)],
+                 'lng': [rnd.uniform(-180, 180)],
+                 'genus_s': [u'Genus%d' % rnd.randint(0, 500)],
+                 'sciName_s': [u'Genus%d species%d' % (rnd.randint(0, 500), rnd.randint(0, 50))],
+                 'stateProvince_s': [u'Ogooué-Ivindo'],
+                 'locality_t': [u'%d km N of somewhere' % rnd.randint(1, 100)],
+                 'year_i': [rnd.randint(1850, 2011)],
+                 'modified': u'2011-06-%02dT12:00:00Z' % rnd.randint(1, 28)})
+  return docs
+
+
+def makeBody(wt, docs):
+  rsp = {'responseHeader': {'status': 0, 'QTime': 12},
+         'response': {'numFound': 10000000, 'start': 0, 'docs': docs}}
+  if wt == 'json':
+    return json.dumps(rsp, separators=(',', ':'))
+  return repr(rsp)
+
+
+class BodyResponse(StringIO.StringIO):
+  '''Minimal stand in for an httplib response.'''
+  def isclosed(self):
+    return self.tell() >= self.len
+
+
+def timeit(func, repeat):
+  best = None
+  for i in xrange(0, repeat):
+    t0 = time.time()
+    func()
+    dt = time.time() - t0
+    if best is None or dt < best:
+      best = dt
+  return best
+
+
+def benchDecoders(nrows=1000, repeat=5):
+  '''Compare eval() of wt=python against the json decoders on one page.'''
+  docs = makeDocs(nrows)
+  pybody = makeBody('python', docs)
+  jsbody = makeBody('json', docs)
+  cases = [('eval wt=python', solrclient.SolrResponseDecoder(), pybody, False),
+           ('json wt=json', solrclient.SolrJSONDecoder(), jsbody, False),
+           ('streaming wt=json', solrclient.SolrStreamingJSONDecoder(), jsbody, True),
+          ]
+  print "Decoding a page of %d docs (%d / %d bytes python / json), best of %d" % \
+      (nrows, len(pybody), len(jsbody), repeat)
+  for name, decoder, body, stream in cases:
+    def run():
+      rsp = BodyResponse(body)
+      if stream:
+        n = 0
+        for doc in decoder.decodeDocs(rsp):
+          n += 1
+      else:
+        n = len(decoder.decode(rsp)['response']['docs'])
+      assert n == nrows
+    print "  %-20s %8.1f ms" % (name, timeit(run, repeat) * 1000.0)
+
+
+def benchFormats(nrows=1000, repeat=5):
+  '''Compare the size, encoding time (including tabulation) and parsing time of
+  a page of records as docs, rows (format=array) and columns 
+  (format=columns).'''
+  docs = makeDocs(nrows)
+  encode = json.JSONEncoder(separators=(',', ':')).encode
+  cases = [('docs (json)', lambda: {'docs': docs}),
+           ('rows (array)', lambda: dict(zip(('fields', 'rows'),
+                                             solrclient.tabulateDocs(docs)))),
+           ('columns', lambda: dict(zip(('fields', 'columns'),
+                                        solrclient.tabulateDocs(docs, bycolumn=True)))),
+          ]
+  print "Encoding and parsing a page of %d docs, best of %d" % (nrows, repeat)
+  print "  %-14s %10s %10s %10s %10s" % ('format', 'bytes', 'gzip', 'encode ms', 'parse ms')
+  for name, build in cases:
+    body = encode(build())
+    gz = len(zlib.compress(body, 6))
+    print "  %-14s %10d %10d %10.1f %10.1f" % (name, len(body), gz,
+                                               timeit(lambda: encode(build()), repeat) * 1000.0,
+                                               timeit(lambda: json.loads(body), repeat) * 1000.0)
+
+
+def benchPacked(nrows=100000, repeat=5):
+  '''Compare the size, encoding and decoding time of the lat and lng of 
+  records as JSON columns (format=columns) and packed float32 
+  (format=f32).'''
+  docs = makeDocs(nrows)
+  encode = json.JSONEncoder(separators=(',', ':')).encode
+  def packed():
+    names, columns = solrclient.tabulateDocs(docs, ['lat', 'lng'], bycolumn=True)
+    return solrclient.packColumns(columns, ['float32', 'float32'], {'fields': names})
+  def unpack(body):
+    n = struct.unpack('<I', body[:4])[0]
+    header = json.loads(body[4:4 + n])
+    columns = []
+    for offset in header['offsets']:
+      column = array('f')
+      column.fromstring(body[4 + n + offset:4 + n + offset + 4 * header['count']])
+      columns.append(column)
+    return columns
+  cases = [('columns', lambda: encode(dict(zip(('fields', 'columns'),
+                                              solrclient.tabulateDocs(docs, ['lat', 'lng'],
+                                                                      bycolumn=True)))),
+            json.loads),
+           ('f32', packed, unpack),
+          ]
+  print "Encoding and decoding lat,lng of %d docs, best of %d" % (nrows, repeat)
+  print "  %-14s %10s %10s %10s %10s" % ('format', 'bytes', 'gzip', 'encode ms', 'decode ms')
+  for name, build, parse in cases:
+    body = build()
+    gz = len(zlib.compress(body, 6))
+    print "  %-14s %10d %10d %10.1f %10.1f" % (name, len(body), gz,
+                                               timeit(build, repeat) * 1000.0,
+                                               timeit(lambda: parse(body), repeat) * 1000.0)
+
+
+if __name__ == '__main__':
+  nrows = 1000
+  repeat = 5
+  if len(sys.argv) > 1:
+    nrows = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    repeat = int(sys.argv[2])
+  benchDecoders(nrows, repeat)
+  benchFormats(nrows, repeat)
+  benchPacked(max(nrows, 100000), repeat)
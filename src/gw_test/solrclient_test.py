@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+'''Offline unit tests for the SOLR client library.
+
+These run without a SOLR server, against canned response bodies.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License. You may obtain a copy
+of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+'''
+
+import os
+import re
+import sys
+import unittest
+import logging
+import threading
+import StringIO
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'dwc_view_app', 'apps'))
+import solrclient
+
+
+class CannedResponse(StringIO.StringIO):
+  '''Minimal stand in for an httplib response.'''
+  def __init__(self, body, status=200):
+    StringIO.StringIO.__init__(self, body)
+    self.status = status
+
+  def isclosed(self):
+    return self.tell() >= self.len
+
+
+class StubClient(object):
+  '''Stands in for a SolrConnection, answering searches from a list of docs.'''
+  def __init__(self, ndocs):
+    self.docs = [{'id': 'doc%05d' % i} for i in xrange(0, ndocs)]
+    self.requests = []
+
+  def cursorSort(self, sort):
+    return 'id asc'
+
+  def search(self, params):
+    self.requests.append(params)
+    rows = int(params['rows'])
+    if 'cursorMark' in params:
+      #the cursor is the offset of the next record
+      start = params['cursorMark'] != '*' and int(params['cursorMark']) or 0
+      docs = self.docs[start:start + rows]
+      return {'response': {'numFound': len(self.docs), 'start': 0, 'docs': docs},
+              'nextCursorMark': str(start + len(docs))}
+    start = int(params.get('start', 0))
+    return {'response': {'numFound': len(self.docs), 'start': start,
+                         'docs': self.docs[start:start + rows]}}
+
+
+_range = re.compile(r'(\w+):\[(\S+) TO (\S+)([\]}])')
+
+def countRanges(docs, query):
+  '''Number of docs matching a conjunction of range queries, i.e. "lat:[0.0 TO 1.0} AND lng:[* TO *]".'''
+  count = 0
+  for doc in docs:
+    matched = True
+    for name, low, high, close in _range.findall(query):
+      value = doc.get(name)
+      if value is None or (low != '*' and value < float(low)):
+        matched = False
+      elif high != '*' and (value > float(high) or (close == '}' and value == float(high))):
+        matched = False
+    if matched:
+      count += 1
+  return count
+
+
+class TestConnectionPool(unittest.TestCase):
+
+  def setUp(self):
+    self.pool = solrclient.SolrConnectionPool('localhost:8983', maxsize=2, waittimeout=0.1)
+
+
+  def testReuse(self):
+    conn = self.pool.checkout()
+    self.pool.checkin(conn)
+    self.assertTrue(self.pool.checkout() is conn)
+    self.assertEqual(self.pool.created, 1)
+
+
+  def testDiscard(self):
+    conn = self.pool.checkout()
+    self.pool.checkin(conn, reuse=False)
+    self.assertFalse(self.pool.checkout() is conn)
+    self.assertEqual(self.pool.created, 2)
+
+
+  def testWaitTimeout(self):
+    self.pool.checkout()
+    self.pool.checkout()
+    try:
+      self.pool.checkout()
+      self.fail('Expected SolrException')
+    except solrclient.SolrException, e:
+      self.assertEqual(e.httpcode, 503)
+
+
+  def testWaitForCheckin(self):
+    self.pool.waittimeout = 5.0
+    conn = self.pool.checkout()
+    self.pool.checkout()
+    timer = threading.Timer(0.1, self.pool.checkin, (conn,))
+    timer.start()
+    self.assertTrue(self.pool.checkout() is conn)
+    timer.join()
+
+
+class TestSolrConnection(unittest.TestCase):
+
+  def setUp(self):
+    self.conn = solrclient.SolrConnection(host='localhost:8983', solrBase='/solr')
+
+
+  def testUpdateError(self):
+    #old style update errors are a 200 response with a non-zero status
+    body = '<result status="1">org.apache.lucene.queryParser.ParseException</result>'
+    self.conn.doPost = lambda url, body_, headers: CannedResponse(body)
+    self.assertRaises(solrclient.SolrException, self.conn.doUpdateXML, '<commit/>')
+
+
+  def testUpdateOK(self):
+    body = '<result status="0"></result>'
+    self.conn.doPost = lambda url, body_, headers: CannedResponse(body)
+    self.assertEqual(self.conn.doUpdateXML('<commit/>'), body)
+
+
+  def testGridOneRequest(self):
+    #points on the inner edges are counted once, on the outer edges too
+    docs = [{'lng': -180.0, 'lat': -90.0}, {'lng': 0.0, 'lat': 0.0}, {'lng': 180.0, 'lat': 90.0},
+            {'lng': 90.0, 'lat': -45.0}, {'lng': 10.0, 'lat': 100.0}]
+    requests = []
+    def search(params):
+      requests.append(params)
+      return {'facet_counts': {'facet_queries': dict([(query, countRanges(docs, query))
+                                                      for query in params['facet.query']])}}
+    self.conn.search = search
+    grid = self.conn.fieldGrid('lng', 'lat', [-180, -90, 180, 90], ncols=4, nrows=2)
+    self.assertEqual(len(requests), 1)
+    self.assertEqual(grid['z'], [[1, 0, 0, 1], [0, 0, 1, 1]])
+    self.assertEqual(grid['numFound'], 4)
+    self.assertEqual(grid['cols'], [-180.0, -90.0, 0.0, 90.0])
+    #large grids are split into requests of maxqueries cells
+    del requests[:]
+    chunked = self.conn.fieldGrid('lng', 'lat', [-180, -90, 180, 90], ncols=4, nrows=2,
+                                  maxqueries=3)
+    self.assertEqual(len(requests), 3)
+    self.assertEqual(chunked['z'], grid['z'])
+
+
+  def testHistogram2dEdges(self):
+    #values on and just above the inner edges are counted once
+    docs = [{'lng': 0.0, 'lat': 0.0}, {'lng': 1.0, 'lat': 1.0}, {'lng': 1.000005, 'lat': 2.0},
+            {'lng': 2.0, 'lat': 0.5}, {'lng': 4.0, 'lat': 4.0}]
+    self.conn.getftype = lambda name: float
+    self.conn.fieldsMinMax = lambda names, q, fq: {'lng': [0.0, 4.0], 'lat': [0.0, 4.0]}
+    def search(params):
+      return {'facet_counts': {'facet_queries': dict([(query, countRanges(docs, query))
+                                                      for query in params['facet.query']])}}
+    self.conn.search = search
+    result = self.conn.fieldHistogram2d('lng', 'lat', ncols=4, nrows=4)
+    self.assertEqual(result['z'], [[1, 0, 1, 0], [0, 1, 0, 0], [0, 1, 0, 0], [0, 0, 0, 1]])
+
+
+  def testRangeHistogramQueries(self):
+    #the bin queries of floating point bins select what the bins count
+    self.conn.getftype = lambda name: float
+    def search(params):
+      return {'facet_counts': {'facet_ranges': {params['facet.range']: {
+        'counts': ['0', 1, '1', 2, '2', 3], 'end': '3'}}}}
+    self.conn.search = search
+    bins = self.conn.fieldRangeHistogram('lat', nbins=3, minmax=[0.0, 3.0])
+    self.assertEqual([b[3] for b in bins],
+                     [u'lat:[* TO 1.0}', u'lat:[1.0 TO 2.0}', u'lat:[2.0 TO *]'])
+    #integer bins are inclusive of both bounds
+    self.conn.getftype = lambda name: int
+    bins = self.conn.fieldRangeHistogram('year_i', nbins=3, minmax=[0, 2])
+    self.assertEqual([b[3] for b in bins],
+                     [u'year_i:[* TO 0]', u'year_i:[1 TO 1]', u'year_i:[2 TO *]'])
+
+
+  def testSampleNeedsRandomField(self):
+    schemas = [{'schema': {'dynamicFields': {'*_s': {'type': 'string'}}}},
+               {'fields': {}},
+               {'schema': {'dynamicFields': {'random_*': {'type': 'random'}}}}]
+    requests = []
+    def doQuery(params, path):
+      requests.append(path)
+      return CannedResponse(json.dumps(schemas[len(requests) - 1]))
+    self.conn.doQuery = doQuery
+    self.conn.search = lambda params: {'response': {'numFound': 0, 'start': 0, 'docs': []}}
+    try:
+      self.conn.sample(10)
+      self.fail('Expected SolrException')
+    except solrclient.SolrException, e:
+      self.assertEqual(e.httpcode, 400)
+    #the schema is read once until the field listing is retrieved again
+    self.assertRaises(solrclient.SolrException, self.conn.sample, 10)
+    self.assertEqual(len(requests), 1)
+    self.conn.getFields(refresh=True)
+    self.assertEqual(self.conn.sample(10)['response']['numFound'], 0)
+    self.assertEqual(len(requests), 3)
+
+
+  def testAlphaHistogramShrunkIndex(self):
+    #the index lost terms between counting them and probing for the bin edges
+    terms = [u'a', u'b', u'c', u'd']
+    self.conn.getSolrType = lambda name: 'string'
+    self.conn.fieldTermCount = lambda name, q, fq: 10
+    self.conn.fieldTerms = lambda name, q, fq, offset=0, limit=1: \
+        [(t, 1) for t in terms[offset:offset + limit]]
+    def search(params):
+      return {'facet_counts': {'facet_queries':
+                               dict([(query, 1) for query in params['facet.query']])}}
+    self.conn.search = search
+    bins = self.conn.fieldAlphaHistogram('genus_s', nbins=5)
+    self.assertEqual([b[:2] for b in bins], [[u'a', u'b'], [u'c', u'c']])
+    self.assertEqual([b[3] for b in bins], [u'genus_s:[* TO "b"]', u'genus_s:["c" TO *]'])
+
+
+class TestStreamingDecoder(unittest.TestCase):
+
+  docs = [{'id': 'doc1', 'genus_s': [u'Abies'], 'lat': 12.5},
+          {'id': 'doc2', 'note': u'brackets ] and "docs": [ in a value, caf\u00e9'},
+          {'id': 'doc3', 'year_i': [1950, 1951], 'nested': {'a': [1, {'b': None}]}}]
+
+  #laid out as SOLR writes it, numFound and start ahead of the docs
+  def body(self):
+    return ('{"responseHeader":{"status":0,"QTime":1},'
+            '"response":{"numFound":42,"start":10,"docs":%s},'
+            '"facet_counts":{"facet_queries":{}}}' % json.dumps(self.docs))
+
+
+  def testChunkBoundaries(self):
+    #every chunk size splits the docs at a different place
+    body = self.body()
+    for chunksize in (1, 2, 3, 7, 16, 64, len(body)):
+      rsp = CannedResponse(body)
+      result = solrclient.SolrStreamingJSONDecoder(chunksize=chunksize).decodeDocs(rsp)
+      self.assertEqual((result.numFound, result.start), (42, 10))
+      self.assertEqual(list(result), self.docs)
+      #the rest of the response is drained so the connection can be reused
+      self.assertTrue(rsp.isclosed())
+
+
+  def testTruncated(self):
+    body = self.body()
+    body = body[:body.index('doc3')]
+    result = solrclient.SolrStreamingJSONDecoder(chunksize=5).decodeDocs(CannedResponse(body))
+    self.assertRaises((solrclient.SolrException, ValueError), list, result)
+
+
+class TestSubsampleIterator(unittest.TestCase):
+
+  def testFewerSamplesThanPage(self):
+    #fewer samples than a page gives the first page
+    client = StubClient(1000)
+    records = list(solrclient.SOLRSubsampleResponseIterator(client, '*:*', pagesize=100,
+                                                            nsamples=50, seed=1))
+    self.assertEqual(len(records), 100)
+    self.assertEqual(len(client.requests), 1)
+
+
+  def testSample(self):
+    client = StubClient(1000)
+    records = list(solrclient.SOLRSubsampleResponseIterator(client, '*:*', pagesize=100,
+                                                            nsamples=300, seed=1))
+    self.assertEqual(len(records), 300)
+    self.assertEqual(len(set([r['id'] for r in records])), 300)
+
+
+class TestPrefetchIterator(unittest.TestCase):
+
+  def testOffsetPages(self):
+    client = StubClient(1050)
+    records = list(solrclient.SOLRPrefetchResponseIterator(client, '*:*', pagesize=100,
+                                                           lookahead=3))
+    self.assertEqual([r['id'] for r in records], [d['id'] for d in client.docs])
+    #no page is requested past the end of the result set
+    self.assertEqual(len(client.requests), 11)
+
+
+  def testCursorPages(self):
+    client = StubClient(1000)
+    records = list(solrclient.SOLRPrefetchResponseIterator(client, '*:*', pagesize=100,
+                                                           cursor=True, lookahead=3))
+    self.assertEqual([r['id'] for r in records], [d['id'] for d in client.docs])
+    self.assertEqual([p['cursorMark'] for p in client.requests],
+                     ['*'] + [str(i) for i in xrange(100, 1000, 100)])
+
+
+  def testLookahead(self):
+    #at most lookahead pages are requested ahead of the page being read
+    client = StubClient(1000)
+    records = solrclient.SOLRPrefetchResponseIterator(client, '*:*', pagesize=100, lookahead=2)
+    for i in xrange(0, 150):
+      records.next()
+    self.assertTrue(len(client.requests) <= 4)
+    records.close()
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  unittest.main()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+'''Benchmarks for bounding box queries.
+
+Counts and lists the records in random map viewports with the gateway's in
+memory spatial index, offline against synthetic points, and optionally
+compares the two paths of a running gateway: /records?bbox= answered by
+the spatial index (GATEWAY_SPATIAL_INDEX = True) and the same box sent to
+SOLR as lat and lng range queries in the filter.
+
+Usage::
+
+  python spatialindex_benchmark.py [points] [repeat] [gateway url]
+
+i.e. python spatialindex_benchmark.py 1000000 5 http://localhost:8000/gateway/
+
+The offline run only times the index against a scan of the points in
+memory, not against SOLR.  Whether the index beats SOLR's range queries
+is only measured by the gateway comparison, which needs a running gateway
+with the spatial index enabled and its SOLR.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License. You may obtain a copy
+of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+'''
+
+import os
+import sys
+import time
+import random
+import urllib
+import urllib2
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'dwc_view_app', 'apps'))
+import spatialindex
+from solrclient_benchmark import timeit
+
+
+def makePoints(npoints, seed=1):
+  rnd = random.Random(seed)
+  return [(u'UAM.Fish.%d.' % i, rnd.uniform(-60, 70), rnd.uniform(-180, 180))
+          for i in xrange(0, npoints)]
+
+
+def makeBoxes(nboxes, seed=2):
+  '''Random viewports from a whole continent down to a few km across.'''
+  rnd = random.Random(seed)
+  boxes = []
+  for i in xrange(0, nboxes):
+    width = 360.0 / 2 ** rnd.randint(2, 12)
+    west = rnd.uniform(-180, 180 - width)
+    south = rnd.uniform(-60, 70 - width / 2)
+    boxes.append([west, south, west + width, south + width / 2])
+  return boxes
+
+
+def benchIndex(npoints=100000, repeat=5, nboxes=100):
+  '''Build time and memory of the index, and the time to count and to list the
+  first page of 1000 points of each viewport, against a scan of every point.'''
+  points = makePoints(npoints)
+  boxes = makeBoxes(nboxes)
+  t0 = time.time()
+  index = spatialindex.GridIndex(points)
+  build = time.time() - t0
+  size = (index.lats.itemsize * len(index.lats) * 2 + index.offsets.itemsize * len(index.offsets)
+          + sum([sys.getsizeof(i) for i in index.ids]) + sys.getsizeof(index.ids))
+  print "Spatial index of %d points: built in %.2f s, %d bytes" % (npoints, build, size)
+  print "Querying %d viewports, best of %d" % (nboxes, repeat)
+  def scan():
+    for west, south, east, north in boxes:
+      len([p for p in points if south <= p[1] <= north and west <= p[2] <= east])
+  for name, run in [('index count', lambda: [index.count(b) for b in boxes]),
+                    ('index page', lambda: [index.search(b, 0, 1000) for b in boxes]),
+                    ('scan count', scan)]:
+    print "  %-20s %8.2f ms/viewport" % (name, timeit(run, repeat) * 1000.0 / nboxes)
+
+
+def benchGateway(url, repeat=5, nboxes=20):
+  '''Time /records?bbox= against /records?filter= with the lat and lng ranges
+  of the same box on a running gateway.  Each round uses new viewports so the
+  gateway's result cache is not hit; SOLR's caches are.'''
+  url = url.rstrip('/') + '/records'
+  def fetch(params):
+    rsp = urllib2.urlopen('%s?%s' % (url, urllib.urlencode(params)))
+    return json.loads(rsp.read())['numFound']
+  print "Gateway %s, %d viewports, best of %d" % (url, nboxes, repeat)
+  for name in ('bbox', 'filter'):
+    rounds = []
+    for r in xrange(0, repeat):
+      boxes = makeBoxes(nboxes, seed=100 + r)
+      def run():
+        for box in boxes:
+          for count in (0, 1000):
+            params = {'fields': 'id,lat,lng', 'count': count}
+            if name == 'bbox':
+              params['bbox'] = ','.join([repr(v) for v in box])
+            else:
+              params['filter'] = 'lng:[%r TO %r] AND lat:[%r TO %r]' % (box[0], box[2],
+                                                                       box[1], box[3])
+            fetch(params)
+      rounds.append(timeit(run, 1))
+    print "  %-20s %8.2f ms/viewport (count and first 1000)" % (name,
+                                                                min(rounds) * 1000.0 / nboxes)
+
+
+if __name__ == '__main__':
+  npoints = 100000
+  repeat = 5
+  if len(sys.argv) > 1:
+    npoints = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    repeat = int(sys.argv[2])
+  benchIndex(npoints, repeat)
+  if len(sys.argv) > 3:
+    benchGateway(sys.argv[3], repeat)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+'''Offline unit tests for the gateway's spatial index and point thinning.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License. You may obtain a copy
+of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+'''
+
+import os
+import sys
+import random
+import unittest
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'dwc_view_app', 'apps'))
+import spatialindex
+
+
+def makePoints(npoints, seed=1):
+  rnd = random.Random(seed)
+  return [(u'UAM.Fish.%d.' % i, rnd.uniform(-90, 90), rnd.uniform(-180, 180))
+          for i in xrange(0, npoints)]
+
+
+class TestThinPoints(unittest.TestCase):
+
+  def testPerCell(self):
+    points = makePoints(5000)
+    total, kept = spatialindex.thinPoints(points, [-180, -90, 180, 90], ncols=8, nrows=4,
+                                          percell=3)
+    self.assertEqual(total, 5000)
+    cells = {}
+    for id, lat, lng in kept:
+      cell = (min(int((lat + 90) / 45), 3), min(int((lng + 180) / 45), 7))
+      cells[cell] = cells.get(cell, 0) + 1
+    self.assertEqual(len(cells), 32)
+    self.assertEqual(max(cells.values()), 3)
+
+
+  def testOrderIndependent(self):
+    #the same points are chosen whatever the order they are read in
+    points = makePoints(2000)
+    shuffled = points[:]
+    random.Random(2).shuffle(shuffled)
+    bbox = [-60, -30, 60, 30]
+    self.assertEqual(spatialindex.thinPoints(points, bbox, 16, 16, 2),
+                     spatialindex.thinPoints(shuffled, bbox, 16, 16, 2))
+
+
+  def testNested(self):
+    #the points kept for a percell are among those kept for a larger one
+    points = makePoints(2000)
+    bbox = [-180, -90, 180, 90]
+    one = set(spatialindex.thinPoints(points, bbox, 8, 8, 1)[1])
+    two = set(spatialindex.thinPoints(points, bbox, 8, 8, 2)[1])
+    self.assertTrue(one < two)
+
+
+  def testAntimeridian(self):
+    points = [('a', 0.0, 179.0), ('b', 0.0, -179.0), ('c', 0.0, 0.0)]
+    total, kept = spatialindex.thinPoints(points, [170, -10, -170, 10], 2, 1, 1)
+    self.assertEqual(total, 2)
+    self.assertEqual([p[0] for p in kept], ['a', 'b'])
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  unittest.main()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+'''Offline unit tests for the map tile pyramid.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License. You may obtain a copy
+of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+'''
+
+import os
+import sys
+import unittest
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'dwc_view_app', 'apps'))
+import tilepyramid
+
+
+class TestTilePyramid(unittest.TestCase):
+
+  def testTileOf(self):
+    #tiles include their western and southern edges
+    self.assertEqual(tilepyramid.tileOf(1, 0.0, 0.0), (1, 0))
+    self.assertEqual(tilepyramid.tileOf(1, -0.001, -0.001), (0, 1))
+    self.assertEqual(tilepyramid.tileOf(1, 89.0, 180.0), (1, 0))
+    north = tilepyramid.tileLatitude(3, 8)
+    west = tilepyramid.tileLongitude(5, 8)
+    self.assertEqual(tilepyramid.tileOf(3, north, west), (5, 2))
+    for z, x, y in [(0, 0, 0), (2, 1, 3), (5, 17, 9)]:
+      west, south, east, north = tilepyramid.tileBounds(z, x, y)
+      self.assertEqual(tilepyramid.tileOf(z, (south + north) / 2, (west + east) / 2), (x, y))
+
+
+  def testSparsePoints(self):
+    #a map of 2 x 2 tiles of 2 x 2 cells, rows counting from south to north
+    counts = [[0, 0, 5, 0],
+              [0, 0, 0, 0],
+              [2, 0, 0, 0],
+              [0, 1, 0, 0]]
+    pyramid = tilepyramid.TilePyramid(1, 2, counts)
+    self.assertEqual(pyramid.sparseTiles(3), [(0, 0, 3)])
+    self.assertEqual(pyramid.sparseTiles(5), [(0, 0, 3), (1, 1, 5)])
+    points = [['a', 60.0, -100.0], ['b', 30.0, -30.0], ['c', 70.0, -170.0]]
+    pyramid.addPoints(points)
+    self.assertEqual(pyramid.tilePoints(1, 0, 0), points)
+    self.assertEqual(pyramid.tilePoints(1, 1, 1), [])
+    self.assertEqual(pyramid.tilePoints(0, 0, 0), points)
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  unittest.main()